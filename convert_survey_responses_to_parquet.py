@@ -0,0 +1,79 @@
+# Databricks notebook source
+# MAGIC %md # Convert survey responses to Parquet
+
+# COMMAND ----------
+
+# MAGIC %md ## Flow:
+# MAGIC - connect to database, resolve namespace
+# MAGIC - resolve arguments
+# MAGIC - read the lookup, if the survey has one
+# MAGIC - convert the responses exported by get_survey_responses for process_timestamp, and their derived variables, to the Parquet datasets
+# MAGIC   partitioned by survey_id and process_timestamp
+# MAGIC - optionally, check the converted derived variables against the row-by-row reference engine on the same export
+
+# COMMAND ----------
+
+# DBTITLE 1,connect to database, resolve namespace
+# MAGIC %run ./../../../../includes/configuration
+
+# COMMAND ----------
+
+# MAGIC %run ./derived_variables_calculator
+
+# COMMAND ----------
+
+# MAGIC %run ./survey_responses_parquet
+
+# COMMAND ----------
+
+# DBTITLE 1,resolve arguments
+dbutils.widgets.removeAll()
+
+dbutils.widgets.text('mount_name','surveys-qualtrics-s3')
+mount_name = getArgument('mount_name')
+
+dbutils.widgets.text('survey_id','')
+survey_id = getArgument('survey_id')
+
+dbutils.widgets.text('process_timestamp','')
+process_timestamp = getArgument('process_timestamp')
+
+# lookup flatfile (csv), relative to the mount
+dbutils.widgets.text('derived_variables_lookup_path', f'surveys/qualtrics/derived_variables_lookup/{survey_id}.csv')
+derived_variables_lookup_path = getArgument('derived_variables_lookup_path')
+
+# 'true' to compare the derived variables with the reference engine (collects the export to the driver)
+dbutils.widgets.text('compare_with_row_engine','false')
+compare_with_row_engine = getArgument('compare_with_row_engine').lower() == 'true'
+
+# vars:
+mount_path = '/mnt/' + mount_name
+s3_path = f'surveys/qualtrics/{namespace}/{process_timestamp}/{survey_id}'
+parquet_root = f'{mount_path}/surveys/qualtrics/{namespace}/parquet'
+
+# COMMAND ----------
+
+# DBTITLE 1,read the lookup, if the survey has one
+import os
+
+df_derived_variables_lookup = None
+if(os.path.exists(f'/dbfs{mount_path}/{derived_variables_lookup_path}')):
+  df_derived_variables_lookup = read_derived_variables_lookup_csv(f'/dbfs{mount_path}/{derived_variables_lookup_path}')
+
+# COMMAND ----------
+
+# DBTITLE 1,convert the responses and their derived variables
+survey_responses_parquet_converter = SurveyResponsesParquetConverter(spark, parquet_root)
+n_responses = survey_responses_parquet_converter.convert(f'{mount_path}/{s3_path}/survey_responses.json', survey_id, process_timestamp, df_derived_variables_lookup)
+print(f'{n_responses} responses written to {parquet_root}')
+
+# COMMAND ----------
+
+# DBTITLE 1,check the derived variables against the reference engine
+if(compare_with_row_engine and df_derived_variables_lookup is not None):
+  differences = survey_responses_parquet_converter.compare_with_row_engine(f'{mount_path}/{s3_path}/survey_responses.json', df_derived_variables_lookup)
+  print(f'{len(differences)} differences with the reference engine')
+  for difference in differences[:20]:
+    print(difference)
+  if(len(differences) > 0):
+    raise Exception(f'The converted derived variables differ from the reference engine for {len(differences)} values')
@@ -10,6 +10,8 @@
 # MAGIC - set of instruction in a form a dataframe. In this version, the instructions will be prepared by a caller from a flatfile residing in S3
 # MAGIC 
 # MAGIC The output will be an extended dataframe with the new derived variables.
+# MAGIC Surveys of any size can be processed in bounded memory: SurveyResponsesJsonStreamReader reads the responses of an export file one at a time,
+# MAGIC and produce_derived_variables_dataframes yields the output batch by batch.
 # MAGIC The new derived variables will not be produced if the underlying data is missing, or conditions to resolve new variable value are not met and no else value provided
 
 # COMMAND ----------
@@ -22,92 +24,510 @@
 
 # COMMAND ----------
 
+# MAGIC %run ./derived_variables_calculator_vectorized_engine
+
+# COMMAND ----------
+
 # MAGIC %md ## Calculator top level classes
 
 # COMMAND ----------
 
+import copy
+import itertools
+import logging
+import re
+import sys
 import numpy as np
 import pandas as pd
 from pandas import DataFrame
-from typing import Iterator
-from pyspark.sql.functions import col, pandas_udf, struct, PandasUDFType
-from pyspark.sql.types import StructType, StructField, FloatType
+from typing import Iterable, Iterator
+import json
+from pyspark.sql import DataFrame as SparkDataFrame
+from pyspark.sql.functions import col, pandas_udf, struct, to_json, PandasUDFType
+from pyspark.sql.types import StructType, StructField, FloatType, StringType
+
+def iter_batches(iterable: Iterable, batch_size: int) -> Iterator[list]:
+    """
+    Lists of batch_size consecutive items of iterable (the last one shorter), consuming iterable only as the batches are requested.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+def read_derived_variables_lookup_csv(path: str) -> DataFrame:
+    """
+    Reads a lookup flatfile: every cell as a string, None for empty cells, pass_number as an int.
+    """
+    df_derived_variables_lookup = pd.read_csv(path, dtype=object)
+    df_derived_variables_lookup = df_derived_variables_lookup.astype(object).where(df_derived_variables_lookup.notna(), None)
+    df_derived_variables_lookup['pass_number'] = df_derived_variables_lookup['pass_number'].astype(int)
+    return df_derived_variables_lookup
+
+
+class SurveyResponsesJsonStreamReader:
+    """
+    Reads the responses of a survey_responses.json export ({"responses": [{...}, ...]}) one at a time, from a path or a text file object:
+    at most a chunk_size piece of the file and the response being decoded are held in memory, whatever the size of the file.
+    Only the keys of every response are kept (all of them when keys is None); the default keeps what the calculators need.
+    """
+    _responses_start = re.compile(r'"responses"\s*:\s*\[')
+
+    def __init__(self, source, chunk_size: int = 1024 * 1024, keys: tuple = ("responseId", "values")):
+        self.source = source
+        self.chunk_size = chunk_size
+        self.keys = keys
+
+    def __iter__(self) -> Iterator[dict]:
+        if hasattr(self.source, "read"):
+            yield from self._read_responses(self.source)
+        else:
+            with open(self.source, encoding="utf-8") as f:
+                yield from self._read_responses(f)
+
+    def batches(self, batch_size: int) -> Iterator[list]:
+        return iter_batches(self, batch_size)
+
+    def _read_responses(self, f) -> Iterator[dict]:
+        decoder = json.JSONDecoder()
+        buffer = ""
+        while True:
+            chunk = f.read(self.chunk_size)
+            buffer += chunk
+            match = self._responses_start.search(buffer)
+            if match is not None:
+                position = match.end()
+                is_eof = False
+                break
+            if chunk == "":
+                raise ValueError('No "responses" array in the file')
+            # keep enough of the tail for a '"responses": [' split across chunks
+            buffer = buffer[-64:]
+
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position < len(buffer) and buffer[position] == "]":
+                return
+            try:
+                if position == len(buffer):
+                    raise json.JSONDecodeError("Need more data", buffer, position)
+                response_dict, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if is_eof:
+                    raise
+                chunk = f.read(self.chunk_size)
+                is_eof = chunk == ""
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            if self.keys is not None:
+                response_dict = {key: response_dict[key] for key in self.keys if key in response_dict}
+            yield response_dict
+
 
 class SurveyDerivedVariablesCalculator:
     
     @staticmethod
-    def produce_derived_variables_dataframe(df_derived_variables_lookup: DataFrame, list_of_response_dictionaries: list) -> DataFrame:
+    def produce_derived_variables_dataframes(df_derived_variables_lookup: DataFrame, responses: Iterable, batch_size: int = 10000,
+                                             rule_scheduling: RuleScheduling = RuleScheduling.PASS_NUMBER, vectorized: bool = False,
+                                             max_workers: int = None, mp_context=None) -> Iterator[DataFrame]:
+        """
+        Yields the output of produce_derived_variables_dataframe (or of its vectorized variant) for every batch_size responses of responses,
+        any iterable of response dictionaries such as a SurveyResponsesJsonStreamReader: only one batch of responses is in memory at a time.
+        The lookup is compiled once for all the batches. With max_workers, the row engine runs on a ParallelSurveyDerivedVariablesCalculator
+        whose workers are started once for all the batches, in processes of mp_context (required then, see ParallelSurveyDerivedVariablesCalculator).
+        """
+        if max_workers is not None and not vectorized:
+            if mp_context is None:
+                raise ValueError("max_workers requires mp_context, see ParallelSurveyDerivedVariablesCalculator")
+            with ParallelSurveyDerivedVariablesCalculator(df_derived_variables_lookup, rule_scheduling, max_workers, mp_context=mp_context) as parallel_calculator:
+                for list_of_response_dictionaries in iter_batches(responses, batch_size):
+                    yield parallel_calculator.produce_derived_variables_dataframe(list_of_response_dictionaries)
+            return
+        rule_plan = RulePlan(df_derived_variables_lookup, rule_scheduling)
+        for list_of_response_dictionaries in iter_batches(responses, batch_size):
+            if vectorized:
+                yield SurveyDerivedVariablesCalculator.produce_derived_variables_dataframe_vectorized_using_rule_plan(rule_plan, list_of_response_dictionaries)
+            else:
+                yield SurveyDerivedVariablesCalculator.produce_derived_variables_dataframe_using_rule_plan(rule_plan, list_of_response_dictionaries)
+
+    @staticmethod
+    def produce_derived_variables_dataframe(df_derived_variables_lookup: DataFrame, list_of_response_dictionaries: list,
+                                            rule_scheduling: RuleScheduling = RuleScheduling.PASS_NUMBER, tracer: DerivedVariablesTracer = None) -> DataFrame:
+        rule_plan = RulePlan(df_derived_variables_lookup, rule_scheduling, tracer=tracer)
+        return SurveyDerivedVariablesCalculator.produce_derived_variables_dataframe_using_rule_plan(rule_plan, list_of_response_dictionaries)
+
+    @staticmethod
+    def produce_derived_variables_dataframe_parallel(df_derived_variables_lookup: DataFrame, list_of_response_dictionaries: list, max_workers: int = None,
+                                                     chunk_size: int = 1000, rule_scheduling: RuleScheduling = RuleScheduling.PASS_NUMBER,
+                                                     tracer: DerivedVariablesTracer = None, *, mp_context) -> DataFrame:
+        """
+        produce_derived_variables_dataframe on max_workers processes of mp_context, see ParallelSurveyDerivedVariablesCalculator.
+        """
+        with ParallelSurveyDerivedVariablesCalculator(df_derived_variables_lookup, rule_scheduling, max_workers, chunk_size, tracer,
+                                                      mp_context=mp_context) as parallel_calculator:
+            return parallel_calculator.produce_derived_variables_dataframe(list_of_response_dictionaries)
+
+    @staticmethod
+    def produce_derived_variables_dataframe_using_rule_plan(rule_plan: RulePlan, list_of_response_dictionaries: list) -> DataFrame:
         result = []
         for response_dict in list_of_response_dictionaries:
-            single_response_survey_derived_variable_calculator = SingleResponseSurveyDerivedVariablesCalculator(df_derived_variables_lookup, response_dict)
-            single_response_survey_derived_variable_calculator.is_printing_output_messages = True
+            single_response_survey_derived_variable_calculator = SingleResponseSurveyDerivedVariablesCalculator(rule_plan, response_dict)
             single_response_survey_derived_variable_calculator.produce_derived_variables()
             result.append(response_dict)
         return pd.DataFrame.from_dict(result)
     
+    @staticmethod
+    def produce_derived_variables_dataframe_vectorized(df_derived_variables_lookup: DataFrame, list_of_response_dictionaries: list,
+                                                       rule_scheduling: RuleScheduling = RuleScheduling.PASS_NUMBER) -> DataFrame:
+        rule_plan = RulePlan(df_derived_variables_lookup, rule_scheduling)
+        return SurveyDerivedVariablesCalculator.produce_derived_variables_dataframe_vectorized_using_rule_plan(rule_plan, list_of_response_dictionaries)
+
+    @staticmethod
+    def produce_derived_variables_dataframe_vectorized_using_rule_plan(rule_plan: RulePlan, list_of_response_dictionaries: list) -> DataFrame:
+        response_columns = ResponseColumns.from_response_dictionaries(list_of_response_dictionaries)
+        BatchSurveyDerivedVariablesCalculator(rule_plan, response_columns).produce_derived_variables()
+        response_columns.update_response_dictionaries(list_of_response_dictionaries, rule_plan.var_names)
+        return pd.DataFrame.from_dict(list_of_response_dictionaries)
+
+    @staticmethod
+    def compare_vectorized_with_row_engine(df_derived_variables_lookup: DataFrame, list_of_response_dictionaries: list) -> list:
+        """
+        Parity check of the vectorized engine against the row-by-row reference engine.
+        Both engines run on their own copy of the responses; returns (response index, new variable, reference value, vectorized value) for every difference.
+        """
+        rule_plan = RulePlan(df_derived_variables_lookup)
+        reference_responses = copy.deepcopy(list_of_response_dictionaries)
+        for response_dict in reference_responses:
+            SingleResponseSurveyDerivedVariablesCalculator(rule_plan, response_dict).produce_derived_variables()
+
+        vectorized_responses = copy.deepcopy(list_of_response_dictionaries)
+        response_columns = ResponseColumns.from_response_dictionaries(vectorized_responses)
+        BatchSurveyDerivedVariablesCalculator(rule_plan, response_columns).produce_derived_variables()
+        response_columns.update_response_dictionaries(vectorized_responses, rule_plan.var_names)
+
+        differences = []
+        for i, (reference_response, vectorized_response) in enumerate(zip(reference_responses, vectorized_responses)):
+            for var_name in rule_plan.var_names:
+                reference_value = reference_response["values"].get(var_name)
+                vectorized_value = vectorized_response["values"].get(var_name)
+                if reference_value != vectorized_value and not (pd.isna(reference_value) is True and pd.isna(vectorized_value) is True):
+                    differences.append((i, var_name, reference_value, vectorized_value))
+        return differences
+
+    @staticmethod
+    def explain_single_response(df_derived_variables_lookup: DataFrame, response_dict: dict, output_format: TraceOutputFormat = TraceOutputFormat.TEXT) -> dict:
+        """
+        Produces the derived variables of one response and prints every step of every rule evaluated for it, whatever the configured log level.
+        """
+        explain_logger = logging.getLogger("derived_variables_calculator.explain")
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        explain_logger.addHandler(handler)
+        explain_logger.setLevel(logging.DEBUG)
+        explain_logger.propagate = False
+        try:
+            rule_plan = RulePlan(df_derived_variables_lookup, tracer=DerivedVariablesTracer(logger=explain_logger, output_format=output_format))
+            SingleResponseSurveyDerivedVariablesCalculator(rule_plan, response_dict).produce_derived_variables()
+        finally:
+            explain_logger.removeHandler(handler)
+        return response_dict
+
     @staticmethod
     def produce_derived_variables_dataframe_for_single_response_row(df_derived_variables_lookup: DataFrame, response_dict: dict) -> dict:                
-        single_response_survey_derived_variable_calculator = SingleResponseSurveyDerivedVariablesCalculator(df_derived_variables_lookup, response_dict)
-        single_response_survey_derived_variable_calculator.is_printing_output_messages = True
-        single_response_survey_derived_variable_calculator.produce_derived_variables()        
+        SurveyDerivedVariablesCalculator.explain_single_response(df_derived_variables_lookup, response_dict)
         return pd.DataFrame.from_dict(response_dict)
       
 class SingleResponseSurveyDerivedVariablesCalculator:
-    def __init__(self, df_derived_variables_lookup: DataFrame, row_response_dict: dict):
-        self.df_derived_variables_lookup = df_derived_variables_lookup
+    def __init__(self, rule_plan: RulePlan, row_response_dict: dict):
+        self.rule_plan = rule_plan
         self.row_response_dict = row_response_dict
-        self._is_printing_output_messages = False
+        # the calculators read the values through TypedResponseValues; a dictionary is wrapped once per response rather than once per rule
+        self.row_response = {"responseId": row_response_dict.get("responseId"), "values": Calculator.as_typed_values(row_response_dict["values"])}
 
-    @property
-    def is_printing_output_messages(self):
-        return self._is_printing_output_messages
+    def produce_derived_variables(self):
+        self.rule_plan.tracer.begin_response(self.row_response_dict)
+        try:
+            self.evaluate_rule_plan()
+        finally:
+            self.rule_plan.tracer.end_response()
 
-    @is_printing_output_messages.setter
-    def is_printing_output_messages(self, value):
-        self._is_printing_output_messages = value
+    def evaluate_rule_plan(self):
+        var_names_not_found = set()
 
-    def print_output_message(self, message):
-        if self._is_printing_output_messages:
-            print(message)
+        for pass_number, var_blocks in self.rule_plan.passes:
+            for var_name, calculators in var_blocks:
+                if var_name in var_names_not_found:
+                    continue
 
-    def produce_derived_variables(self):
-        var_names = self.df_derived_variables_lookup["new_variable"].unique()
-        var_names = [x for x in var_names if x is not None]
-        var_names_working_copy = np.ndarray.copy(np.asarray(var_names))
-        factory = CalculatorFactory()
-        max_pass_number = max(set(self.df_derived_variables_lookup["pass_number"]))
-
-        for pass_number in range(0, max_pass_number + 1):
-            for var_name in var_names_working_copy:
-                df_derived_variables_lookup_one_var_block_of_rows = self.df_derived_variables_lookup.loc[(self.df_derived_variables_lookup["new_variable"] == var_name) & (self.df_derived_variables_lookup["pass_number"] == pass_number)]
-                
-                for i in df_derived_variables_lookup_one_var_block_of_rows.index:
-                    variable_lookup_row = df_derived_variables_lookup_one_var_block_of_rows.loc[i]
-                    calculator = factory.create_calculator(variable_lookup_row)
-
-                    if calculator is None:
-                        raise Exception(f"action: {variable_lookup_row['action']}; detail: {variable_lookup_row['detail']}; pass_number: {pass_number}")
-
-                    calculator.is_printing_output_messages = self._is_printing_output_messages
-                    calculation_result = calculator.produce_new_var(self.row_response_dict)
+                for calculator in calculators:
+                    calculation_result = calculator.produce_new_var(self.row_response)
 
                     if calculation_result[0] == PostCalculationInstruction.MOVE_TO_NEXT_VAR__VALUE_RESOLVED:
-                        self.row_response_dict["values"][variable_lookup_row["new_variable"]] = calculation_result[1]
+                        self.row_response["values"][calculator.new_var_name] = calculation_result[1]
                         break
                     elif calculation_result[0] == PostCalculationInstruction.MOVE_TO_NEXT_RULE__KEYS_EXIST_CONDITIONS_NOT_MET:
-#                         self.row_response_dict["values"][variable_lookup_row["new_variable"]] = ""
+#                         self.row_response_dict["values"][calculator.new_var_name] = ""
                         continue
                     elif calculation_result[0] == PostCalculationInstruction.MOVE_TO_NEXT_VAR__UNDERLYING_DATA_NOT_FOUND:
-                        var_names_working_copy = var_names_working_copy[var_names_working_copy != var_name]
-#                         self.row_response_dict["values"][variable_lookup_row["new_variable"]] = ""
+                        var_names_not_found.add(var_name)
+#                         self.row_response_dict["values"][calculator.new_var_name] = ""
                         break
                     elif calculation_result[0] == PostCalculationInstruction.MOVE_TO_NEXT_VAR__WILL_ATTEMPT_TO_CALCULATE_ON_THE_NEXT_PASS:
-                        is_removing_var_name_from_var_names_working_copy = False
-#                         self.row_response_dict["values"][variable_lookup_row["new_variable"]] = ""
+#                         self.row_response_dict["values"][calculator.new_var_name] = ""
                         break
                     elif calculation_result[0] == PostCalculationInstruction.STOP__ALL_DONE:
-#                         self.row_response_dict["values"][variable_lookup_row["new_variable"]] = ""
+#                         self.row_response_dict["values"][calculator.new_var_name] = ""
                         return
                     else:
                         raise ValueError(f"Unsupported case: PostCalculationInstruction  = {calculation_result[0]}")
-              
+
+# COMMAND ----------
+
+# MAGIC %md ## Parallel calculation on a single node
+
+# COMMAND ----------
+
+from concurrent.futures import ProcessPoolExecutor
+
+
+class ParallelSurveyDerivedVariablesCalculator:
+    """
+    Runs the row engine on a pool of worker processes, for surveys too big for one core but not worth a Spark job (and for local runs):
+    the responses are cut into chunks of chunk_size consecutive responses, evaluated by max_workers processes (os.cpu_count() when None),
+    and the derived variables are merged back into the responses in their order.
+    The compiled RulePlan is sent to every worker once, by the pool initializer; a chunk sends its responses and gets back their derived variables only.
+    The pool is started on first use and reused until close (or the end of a with block), so that batches of a stream pay for the workers once.
+    mp_context (a multiprocessing context) is a required keyword argument: there is no default start method.
+    Notebook-defined classes cannot be imported by a spawned worker, so the workers have to be forked (multiprocessing.get_context("fork")),
+    which is only safe in a process without other threads: a local Python process, or a task on a Spark executor (e.g. inside mapInPandas). Do not fork the Databricks driver: its JVM gateway
+    and logging threads may hold locks at the time of the fork, and the workers can deadlock on them; use SparkSurveyDerivedVariablesCalculator there.
+    """
+    _worker_rule_plan = None
+
+    def __init__(self, df_derived_variables_lookup: DataFrame, rule_scheduling: RuleScheduling = RuleScheduling.PASS_NUMBER, max_workers: int = None,
+                 chunk_size: int = 1000, tracer: DerivedVariablesTracer = None, *, mp_context):
+        self.rule_plan = RulePlan(df_derived_variables_lookup, rule_scheduling, tracer=tracer)
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.mp_context = mp_context
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    @staticmethod
+    def _initialize_worker(rule_plan: RulePlan):
+        ParallelSurveyDerivedVariablesCalculator._worker_rule_plan = rule_plan
+
+    @staticmethod
+    def _produce_derived_variables_chunk(list_of_response_dictionaries: list) -> list:
+        """
+        Runs in a worker: returns the derived variables of every response of the chunk, as {new variable: value}.
+        """
+        rule_plan = ParallelSurveyDerivedVariablesCalculator._worker_rule_plan
+        result = []
+        for response_dict in list_of_response_dictionaries:
+            SingleResponseSurveyDerivedVariablesCalculator(rule_plan, response_dict).produce_derived_variables()
+            values = response_dict["values"]
+            result.append({var_name: values[var_name] for var_name in rule_plan.var_names if var_name in values})
+        return result
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=self.mp_context,
+                                                 initializer=ParallelSurveyDerivedVariablesCalculator._initialize_worker, initargs=(self.rule_plan,))
+        return self._executor
+
+    def produce_derived_variables(self, list_of_response_dictionaries: list):
+        """
+        Adds the derived variables to the "values" of every response, as SingleResponseSurveyDerivedVariablesCalculator does.
+        """
+        chunks = [list_of_response_dictionaries[i:i + self.chunk_size] for i in range(0, len(list_of_response_dictionaries), self.chunk_size)]
+        chunk_results = self._get_executor().map(ParallelSurveyDerivedVariablesCalculator._produce_derived_variables_chunk, chunks)
+        for response_dict, derived_values in zip(list_of_response_dictionaries, itertools.chain.from_iterable(chunk_results)):
+            response_dict["values"].update(derived_values)
+
+    def produce_derived_variables_dataframe(self, list_of_response_dictionaries: list) -> DataFrame:
+        self.produce_derived_variables(list_of_response_dictionaries)
+        return pd.DataFrame.from_dict(list_of_response_dictionaries)
+
+# COMMAND ----------
+
+# MAGIC %md ## Distributed calculation on Spark
+
+# COMMAND ----------
+
+class SparkSurveyDerivedVariablesCalculator:
+    """
+    Runs the derived variables calculation on the executors: the lookup rules are broadcast once, every task compiles them into a RulePlan
+    and evaluates its partition of responses with the vectorized batch engine through mapInPandas.
+    """
+
+    @staticmethod
+    def derived_variables_schema(rule_plan: RulePlan, response_id_column: str) -> StructType:
+        fields = [StructField(response_id_column, StringType(), True)]
+        fields += [StructField(var_name, StringType(), True) for var_name in rule_plan.var_names]
+        return StructType(fields)
+
+    @staticmethod
+    def produce_derived_variables_spark_dataframe(df_derived_variables_lookup: DataFrame, sdf_responses: SparkDataFrame,
+                                                  response_id_column: str = "responseId", values_column: str = "values",
+                                                  rule_scheduling: RuleScheduling = RuleScheduling.PASS_NUMBER) -> SparkDataFrame:
+        """
+        sdf_responses holds one row per response: the response id and its values, either as a struct/map column or as a JSON string.
+        Null fields of a struct/map are left out of the values, as the keys a response did not answer are left out of the Qualtrics export.
+        Returns one row per response with the response id and one string column per derived variable (null where no value was produced).
+        """
+        spark_session = sdf_responses.sparkSession
+        rule_plan = RulePlan(df_derived_variables_lookup, rule_scheduling)
+        var_names = rule_plan.var_names
+        schema = SparkSurveyDerivedVariablesCalculator.derived_variables_schema(rule_plan, response_id_column)
+        broadcast_lookup = spark_session.sparkContext.broadcast(df_derived_variables_lookup)
+
+        if sdf_responses.schema[values_column].dataType != StringType():
+            sdf_responses = sdf_responses.withColumn(values_column, to_json(col(values_column)))
+        sdf_responses = sdf_responses.select(col(response_id_column).cast(StringType()), col(values_column))
+
+        def produce_derived_variables_for_partition(iterator):
+            partition_rule_plan = RulePlan(broadcast_lookup.value, rule_scheduling)
+            for pdf_responses in iterator:
+                list_of_response_dictionaries = [{"values": json.loads(x) if x is not None else {}} for x in pdf_responses[values_column]]
+                response_columns = ResponseColumns.from_response_dictionaries(list_of_response_dictionaries)
+                BatchSurveyDerivedVariablesCalculator(partition_rule_plan, response_columns).produce_derived_variables()
+                yield SparkSurveyDerivedVariablesCalculator.derived_variables_pandas_dataframe(
+                    response_columns, var_names, pdf_responses[response_id_column].to_numpy(), response_id_column)
+
+        return sdf_responses.mapInPandas(produce_derived_variables_for_partition, schema)
+
+    @staticmethod
+    def derived_variables_pandas_dataframe(response_columns: ResponseColumns, var_names: list, response_ids, response_id_column: str) -> DataFrame:
+        """
+        One row per response: the response id and one string column per derived variable (None where no value was produced).
+        """
+        pdf_derived_variables = pd.DataFrame({response_id_column: response_ids})
+        for var_name in var_names:
+            derived_values = np.full(response_columns.n_rows, None, dtype=object)
+            is_present = response_columns.present(var_name)
+            derived_values[is_present] = [str(x) for x in response_columns.values(var_name)[is_present]]
+            pdf_derived_variables[var_name] = derived_values
+        return pdf_derived_variables
+
+# COMMAND ----------
+
+# MAGIC %md ## Incremental calculation
+
+# COMMAND ----------
+
+class IncrementalSurveyDerivedVariablesCalculator:
+    """
+    Produces the derived variables of the responses of an incremental export only (the responses new or changed since the previous continuation token)
+    and upserts them by response id into the existing output, so that a run costs in proportion to the new responses rather than to the survey's size.
+    Derived variables only depend on their own response, so the upserted rows are those a full recalculation would produce, as long as the lookup
+    did not change: after changing the lookup, recalculate the full output once.
+    The output is created (or recalculated, once dropped) from a full export, made without a continuation token: the first export of the survey,
+    or any other one holding all its responses.
+    """
+
+    @staticmethod
+    def latest_responses(list_of_response_dictionaries: list, response_id_column: str = "responseId") -> list:
+        """
+        Keeps the last occurrence of every response id, in the order of the first one.
+        """
+        latest_by_response_id = {}
+        for response_dict in list_of_response_dictionaries:
+            latest_by_response_id[response_dict[response_id_column]] = response_dict
+        return list(latest_by_response_id.values())
+
+    @staticmethod
+    def produce_delta_derived_variables_dataframe(df_derived_variables_lookup: DataFrame, list_of_response_dictionaries: list,
+                                                  response_id_column: str = "responseId",
+                                                  rule_scheduling: RuleScheduling = RuleScheduling.PASS_NUMBER) -> DataFrame:
+        """
+        Returns one row per response id of the delta: the response id and one string column per derived variable, as SparkSurveyDerivedVariablesCalculator does.
+        """
+        rule_plan = RulePlan(df_derived_variables_lookup, rule_scheduling)
+        return IncrementalSurveyDerivedVariablesCalculator.produce_delta_derived_variables_dataframe_using_rule_plan(
+            rule_plan, list_of_response_dictionaries, response_id_column)
+
+    @staticmethod
+    def produce_delta_derived_variables_dataframe_using_rule_plan(rule_plan: RulePlan, list_of_response_dictionaries: list,
+                                                                  response_id_column: str = "responseId") -> DataFrame:
+        """
+        produce_delta_derived_variables_dataframe with a compiled lookup, to compile it once for all the batches of a delta.
+        """
+        delta_responses = IncrementalSurveyDerivedVariablesCalculator.latest_responses(list_of_response_dictionaries, response_id_column)
+        response_columns = ResponseColumns.from_response_dictionaries(delta_responses)
+        BatchSurveyDerivedVariablesCalculator(rule_plan, response_columns).produce_derived_variables()
+        response_ids = np.array([x[response_id_column] for x in delta_responses], dtype=object)
+        return SparkSurveyDerivedVariablesCalculator.derived_variables_pandas_dataframe(response_columns, rule_plan.var_names, response_ids, response_id_column)
+
+    @staticmethod
+    def upsert_dataframe(df_existing: DataFrame, df_delta: DataFrame, response_id_column: str = "responseId") -> DataFrame:
+        """
+        Rows of df_delta replace the rows of df_existing with the same response id; the other rows of both are kept.
+        """
+        if df_existing is None or len(df_existing) == 0:
+            return df_delta.reset_index(drop=True)
+        df_kept = df_existing[~df_existing[response_id_column].isin(df_delta[response_id_column])]
+        return pd.concat([df_kept, df_delta], ignore_index=True)
+
+    @staticmethod
+    def upsert_spark_table(sdf_delta: SparkDataFrame, table_name: str, response_id_column: str = "responseId", allow_schema_change: bool = False,
+                           is_full_export: bool = False):
+        """
+        Merges sdf_delta into the Delta table table_name by response id.
+        A missing table is created from sdf_delta only when it holds the responses of a full export (is_full_export): created from the responses
+        of an incremental export, it would silently miss all the older ones, so a ValueError is raised instead.
+        The columns of the table are those of the lookup of the run that created it. When the columns of sdf_delta differ (the lookup added or removed
+        derived variables), the rows of the other responses would be left inconsistent, so a ValueError is raised: drop the table and create it again
+        from a full export.
+        With allow_schema_change, the MERGE runs with Delta schema evolution (spark.databricks.delta.schema.autoMerge.enabled) instead:
+        added variables become new columns, null for the responses not in sdf_delta, and removed variables keep their values.
+        """
+        spark_session = sdf_delta.sparkSession
+        if not spark_session.catalog.tableExists(table_name):
+            if not is_full_export:
+                raise ValueError(f"{table_name} does not exist and the responses are those of an incremental export: create it from a full export first")
+            sdf_delta.write.format("delta").saveAsTable(table_name)
+            return
+        table_columns = spark_session.table(table_name).columns
+        added_columns = [x for x in sdf_delta.columns if x not in table_columns]
+        removed_columns = [x for x in table_columns if x not in sdf_delta.columns]
+        is_schema_changed = len(added_columns) > 0 or len(removed_columns) > 0
+        if is_schema_changed and not allow_schema_change:
+            raise ValueError(f"The derived variables of {table_name} do not match the lookup (added: {added_columns}, removed: {removed_columns}): "
+                             "drop the table and create it again from a full export, or upsert with allow_schema_change")
+
+        delta_view_name = "derived_variables_delta"
+        sdf_delta.createOrReplaceTempView(delta_view_name)
+        auto_merge_key = "spark.databricks.delta.schema.autoMerge.enabled"
+        previous_auto_merge = spark_session.conf.get(auto_merge_key, None)
+        if is_schema_changed:
+            spark_session.conf.set(auto_merge_key, "true")
+        try:
+            spark_session.sql(f"""
+                MERGE INTO {table_name} AS target
+                USING {delta_view_name} AS delta
+                ON target.`{response_id_column}` = delta.`{response_id_column}`
+                WHEN MATCHED THEN UPDATE SET *
+                WHEN NOT MATCHED THEN INSERT *
+            """)
+        finally:
+            if is_schema_changed:
+                if previous_auto_merge is None:
+                    spark_session.conf.unset(auto_merge_key)
+                else:
+                    spark_session.conf.set(auto_merge_key, previous_auto_merge)
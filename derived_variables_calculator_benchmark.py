@@ -0,0 +1,351 @@
+# Databricks notebook source
+# MAGIC %md # Derived Variables Calculator Benchmark
+
+# COMMAND ----------
+
+# MAGIC %md ## Overview
+# MAGIC This notebook measures how the row engine of the Derived Variables Calculator scales with:
+# MAGIC - rule count and pass depth of the lookup
+# MAGIC - response count and missing-data rate of the survey
+# MAGIC
+# MAGIC Synthetic lookups use every (action, detail) combination registered in the calculator registry, and synthetic responses are shaped like
+# MAGIC the Qualtrics JSON export (`{"responseId": ..., "values": {...}}`).
+# MAGIC Every scenario reports end to end time, rows/sec, peak memory, time per pass and time per calculator class.
+# MAGIC With a result cache size, every scenario is also timed with a CalculatorResultCache, whose hit rates show how often the low-cardinality
+# MAGIC answers of the synthetic survey repeat the inputs of a rule.
+# MAGIC Results are emitted as JSON, so that regressions can be tracked across releases.
+
+# COMMAND ----------
+
+# MAGIC %run ./derived_variables_calculator
+
+# COMMAND ----------
+
+# DBTITLE 1,Synthetic survey generators
+import copy
+import itertools
+import json
+import platform
+import random
+import time
+import tracemalloc
+from datetime import datetime
+import pandas as pd
+from pandas import DataFrame
+
+
+class SyntheticSurveyGenerator:
+    """
+    Generates lookup dataframes and responses that fit each other.
+    Questions are Likert scales (ints 1-5, keys QID1, QID2, ...), multi-selects (lists of ints, keys QID1_MS, ...) and texts (keys QID1_TEXT, ...).
+    Every key of a response is dropped with probability missing_rate. The same seed always produces the same lookup and responses.
+    """
+    multi_conditional_details = ["equal,less_than", "greater_than_equal,is_in", "less_than_equal,greater_than,equal", "is_in,is_null"]
+    text_values = ["yes", "no", "a,b", "a,b,c", ""]
+
+    def __init__(self, n_likert_questions: int = 20, n_multi_select_questions: int = 5, n_text_questions: int = 5, seed: int = 0,
+                 registry: CalculatorRegistry = None):
+        self.likert_keys = [f"QID{i}" for i in range(1, n_likert_questions + 1)]
+        self.multi_select_keys = [f"QID{i}_MS" for i in range(1, n_multi_select_questions + 1)]
+        self.text_keys = [f"QID{i}_TEXT" for i in range(1, n_text_questions + 1)]
+        self.seed = seed
+        self.registry = registry if registry is not None else calculator_registry
+
+    # ===============================================================================
+    # Lookup
+    # ===============================================================================
+
+    @staticmethod
+    def _lookup_row(pass_number, new_variable, action, detail, key_a=None, value_a=None, value_a2=None, key_b=None, value_b=None,
+                    key_c=None, value_c=None, key_d=None, value_d=None, fill_with_this=None, else_value=None) -> dict:
+        return {"pass_number": pass_number, "new_variable": new_variable, "action": action, "detail": detail,
+                "survey_id_a": key_a, "survey_id_a_value_1": value_a, "survey_id_a_value_2": value_a2,
+                "survey_id_b": key_b, "survey_id_b_value": value_b, "survey_id_c": key_c, "survey_id_c_value": value_c,
+                "survey_id_d": key_d, "survey_id_d_value": value_d, "fill_with_this": fill_with_this, "else": else_value}
+
+    def action_and_detail_combinations(self) -> list:
+        """
+        Every registered (action, detail), in registration order.
+        Multi conditional actions take any detail: each of them is given one of multi_conditional_details.
+        """
+        combinations = []
+        multi_conditional_details = itertools.cycle(self.multi_conditional_details)
+        for action, detail in self.registry.registered():
+            if detail == ANY_DETAIL:
+                detail = next(multi_conditional_details) if str(action).startswith("multi_conditional") else None
+            combinations.append((action, detail))
+        return combinations
+
+    def _rule(self, pass_number: int, i: int, action, detail, likert_keys: list) -> dict:
+        def likert(offset=0):
+            return likert_keys[(i + offset) % len(likert_keys)]
+
+        def keys(pool, n):
+            return ",".join(pool[(i + j) % len(pool)] for j in range(n))
+
+        new_variable = f"dv_{pass_number}_{i}_{action}"
+        rule = SyntheticSurveyGenerator._lookup_row
+        if action is None or str(action).startswith("recode"):
+            return rule(pass_number, new_variable, action, detail, key_a=likert())
+        if action in ("conditional", "conditional_2", "conditional_3"):
+            if detail == "is_in":
+                return rule(pass_number, new_variable, action, detail, key_a=likert(), value_a="1,2", fill_with_this="yes", else_value="no")
+            if detail == "between_including":
+                return rule(pass_number, new_variable, action, detail, key_a=likert(), value_a="2", value_a2="4", fill_with_this="yes", else_value="no")
+            if detail == "is_null":
+                return rule(pass_number, new_variable, action, detail, key_a=keys(self.text_keys, 1), fill_with_this="yes", else_value="no")
+            if detail == "equal_string":
+                return rule(pass_number, new_variable, action, detail, key_a=keys(self.text_keys, 1), value_a="yes", fill_with_this="yes", else_value="no")
+            return rule(pass_number, new_variable, action, detail, key_a=likert(), value_a="3", fill_with_this="yes", else_value="no")
+        if str(action).startswith("multi_conditional"):
+            conditions = str(detail).split(",")
+            values = ["1,2" if x == "is_in" else "3" for x in conditions] + [None] * (4 - len(conditions))
+            keys_abcd = [likert(j) for j in range(len(conditions))] + [None] * (4 - len(conditions))
+            return rule(pass_number, new_variable, action, detail, key_a=keys_abcd[0], value_a=values[0], key_b=keys_abcd[1], value_b=values[1],
+                        key_c=keys_abcd[2], value_c=values[2], key_d=keys_abcd[3], value_d=values[3], fill_with_this="yes", else_value="no")
+        if str(action).startswith("sum"):
+            return rule(pass_number, new_variable, action, detail, key_a=keys(self.multi_select_keys, 2))
+        if action == "subtraction":
+            return rule(pass_number, new_variable, action, detail, key_a=likert(), key_b=likert(1))
+        if str(action).startswith("mean"):
+            # five keys, so that Calculator_Mean_N_Or_More never takes the mean of no values
+            return rule(pass_number, new_variable, action, detail, key_a=",".join(likert(j) for j in range(5)))
+        if action == "merge":
+            return rule(pass_number, new_variable, action, detail, key_a=keys(self.text_keys, 1), key_b=keys(self.text_keys[1:] + self.text_keys[:1], 1))
+        if action == "product":
+            return rule(pass_number, new_variable, action, detail, key_a=likert(), value_a="2")
+        if action == "count":
+            return rule(pass_number, new_variable, action, detail, key_a=keys(self.text_keys, 1))
+        raise ValueError(f"No synthetic rule for action {action}, detail {detail}")
+
+    def generate_lookup(self, n_rules: int, n_passes: int = 1) -> DataFrame:
+        """
+        n_rules rules, one new variable each, spread evenly over passes 0..n_passes-1.
+        Every pass starts with the recodes, and the other rules cycle through action_and_detail_combinations across passes
+        (every combination is used once n_rules reaches their number). Likert-reading rules of a pass read the recoded variables of the previous pass,
+        so that pass depth is also dependency depth.
+        """
+        combinations = self.action_and_detail_combinations()
+        recodes = [x for x in combinations if str(x[0]).startswith("recode")]
+        others = itertools.cycle([x for x in combinations if not str(x[0]).startswith("recode")])
+        rows = []
+        likert_keys = self.likert_keys
+        for pass_number in range(n_passes):
+            n_rules_in_pass = n_rules // n_passes + (1 if pass_number < n_rules % n_passes else 0)
+            recoded_keys = []
+            for j in range(n_rules_in_pass):
+                action, detail = recodes[j] if j < len(recodes) else next(others)
+                row = self._rule(pass_number, len(rows), action, detail, likert_keys)
+                if str(action).startswith("recode"):
+                    recoded_keys.append(row["new_variable"])
+                rows.append(row)
+            if len(recoded_keys) > 0:
+                likert_keys = recoded_keys
+        return pd.DataFrame(rows, columns=list(SyntheticSurveyGenerator._lookup_row(None, None, None, None).keys()), dtype=object)
+
+    # ===============================================================================
+    # Responses
+    # ===============================================================================
+
+    def generate_responses(self, n_responses: int, missing_rate: float = 0.0) -> list:
+        """
+        Responses shaped like the Qualtrics JSON export: {"responseId": ..., "values": {...}} with a few metadata fields and every question.
+        """
+        rng = random.Random(self.seed)
+        list_of_response_dictionaries = []
+        for i in range(n_responses):
+            values = {"status": 0, "progress": 100, "finished": 1, "startDate": "2021-01-01T00:00:00Z", "recordedDate": "2021-01-01T00:10:00Z"}
+            for key in self.likert_keys:
+                values[key] = rng.randint(1, 5)
+            for key in self.multi_select_keys:
+                values[key] = sorted(rng.sample(range(1, 6), rng.randint(0, 3)))
+            for key in self.text_keys:
+                values[key] = rng.choice(self.text_values)
+            if missing_rate > 0:
+                values = {key: value for key, value in values.items() if rng.random() >= missing_rate}
+            list_of_response_dictionaries.append({"responseId": f"R_{i:012d}", "values": values})
+        return list_of_response_dictionaries
+
+# COMMAND ----------
+
+# DBTITLE 1,Benchmark
+class DerivedVariablesBenchmark:
+    """
+    Times the row engine for a grid of scenarios (rule count x pass depth x response count x missing rate).
+    For every scenario:
+    - seconds, rows_per_sec: best of repeat end to end runs of SurveyDerivedVariablesCalculator.produce_derived_variables_dataframe_using_rule_plan
+    - peak_memory_bytes: peak traced by tracemalloc over one more run (tracemalloc slows the run down, so it is not timed)
+    - passes, calculators: time spent in Calculator.produce_new_var per pass and per calculator class, over one more instrumented run
+    - result_cache (when result_cache_max_size is given): the same end to end timing with a CalculatorResultCache of that size,
+      its speedup and the hit rates of the cache, overall and per calculator class
+    Every run evaluates a fresh copy of the responses; compiling the RulePlan is timed separately.
+    """
+    def __init__(self, generator: SyntheticSurveyGenerator = None, repeat: int = 3, rule_scheduling: RuleScheduling = RuleScheduling.PASS_NUMBER,
+                 result_cache_max_size: int = None):
+        self.generator = generator if generator is not None else SyntheticSurveyGenerator()
+        self.repeat = repeat
+        self.rule_scheduling = rule_scheduling
+        self.result_cache_max_size = result_cache_max_size
+
+    def _time_end_to_end(self, rule_plan: RulePlan, list_of_response_dictionaries: list, result_cache: CalculatorResultCache = None) -> float:
+        best = None
+        for _ in range(self.repeat):
+            responses = copy.deepcopy(list_of_response_dictionaries)
+            if result_cache is not None:
+                # every run starts cold, as a job does
+                result_cache.clear()
+            start = time.perf_counter()
+            SurveyDerivedVariablesCalculator.produce_derived_variables_dataframe_using_rule_plan(rule_plan, responses)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def _measure_peak_memory(self, rule_plan: RulePlan, list_of_response_dictionaries: list) -> int:
+        responses = copy.deepcopy(list_of_response_dictionaries)
+        tracemalloc.start()
+        try:
+            SurveyDerivedVariablesCalculator.produce_derived_variables_dataframe_using_rule_plan(rule_plan, responses)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def _profile_calculators(self, df_derived_variables_lookup: DataFrame, list_of_response_dictionaries: list) -> (list, list):
+        """
+        Evaluates a separately compiled plan whose calculators accumulate the time spent in produce_new_var, per pass and per calculator class.
+        """
+        rule_plan = RulePlan(df_derived_variables_lookup, self.rule_scheduling)
+        seconds_by_pass = {}
+        stats_by_class = {}
+
+        def timed(produce_new_var, pass_number, class_stats):
+            def produce_new_var_timed(row_response):
+                start = time.perf_counter()
+                try:
+                    return produce_new_var(row_response)
+                finally:
+                    elapsed = time.perf_counter() - start
+                    seconds_by_pass[pass_number] += elapsed
+                    class_stats[0] += 1
+                    class_stats[1] += elapsed
+            return produce_new_var_timed
+
+        for pass_number, var_blocks in rule_plan.passes:
+            seconds_by_pass[pass_number] = 0.0
+            for var_name, calculators in var_blocks:
+                for calculator in calculators:
+                    class_stats = stats_by_class.setdefault(type(calculator).__name__, [0, 0.0, 0])
+                    class_stats[2] += 1
+                    calculator.produce_new_var = timed(calculator.produce_new_var, pass_number, class_stats)
+
+        SurveyDerivedVariablesCalculator.produce_derived_variables_dataframe_using_rule_plan(rule_plan, copy.deepcopy(list_of_response_dictionaries))
+
+        passes = [{"pass_number": int(pass_number), "seconds": seconds} for pass_number, seconds in seconds_by_pass.items()]
+        calculators = [{"calculator": class_name, "rules": n_rules, "evaluations": n_evaluations, "seconds": seconds,
+                        "evaluations_per_sec": n_evaluations / seconds if seconds > 0 else None}
+                       for class_name, (n_evaluations, seconds, n_rules) in sorted(stats_by_class.items(), key=lambda x: -x[1][1])]
+        return passes, calculators
+
+    def _time_result_cache(self, df_derived_variables_lookup: DataFrame, list_of_response_dictionaries: list, seconds_without_cache: float) -> dict:
+        result_cache = CalculatorResultCache(self.result_cache_max_size)
+        rule_plan = RulePlan(df_derived_variables_lookup, self.rule_scheduling, result_cache=result_cache)
+        seconds = self._time_end_to_end(rule_plan, list_of_response_dictionaries, result_cache)
+        # the statistics of the last run only
+        result_cache.clear()
+        result_cache.reset_stats()
+        SurveyDerivedVariablesCalculator.produce_derived_variables_dataframe_using_rule_plan(rule_plan, copy.deepcopy(list_of_response_dictionaries))
+        stats = result_cache.stats()
+        stats_by_class = {}
+        for rule_stats in stats["rules"]:
+            class_stats = stats_by_class.setdefault(rule_stats["calculator"], [0, 0])
+            class_stats[0] += rule_stats["hits"]
+            class_stats[1] += rule_stats["misses"]
+        return {
+            "max_size": self.result_cache_max_size,
+            "seconds": seconds,
+            "rows_per_sec": len(list_of_response_dictionaries) / seconds if seconds > 0 else None,
+            "speedup": seconds_without_cache / seconds if seconds > 0 else None,
+            "hit_rate": stats["hit_rate"],
+            "evictions": stats["evictions"],
+            "calculators": [{"calculator": class_name, "hits": hits, "misses": misses, "hit_rate": hits / (hits + misses) if hits + misses > 0 else None}
+                            for class_name, (hits, misses) in sorted(stats_by_class.items(), key=lambda x: -x[1][0])],
+        }
+
+    def run_scenario(self, n_rules: int, n_passes: int, n_responses: int, missing_rate: float) -> dict:
+        df_derived_variables_lookup = self.generator.generate_lookup(n_rules, n_passes)
+        list_of_response_dictionaries = self.generator.generate_responses(n_responses, missing_rate)
+
+        start = time.perf_counter()
+        rule_plan = RulePlan(df_derived_variables_lookup, self.rule_scheduling)
+        compile_seconds = time.perf_counter() - start
+
+        seconds = self._time_end_to_end(rule_plan, list_of_response_dictionaries)
+        peak_memory_bytes = self._measure_peak_memory(rule_plan, list_of_response_dictionaries)
+        passes, calculators = self._profile_calculators(df_derived_variables_lookup, list_of_response_dictionaries)
+        result_cache = None
+        if self.result_cache_max_size is not None:
+            result_cache = self._time_result_cache(df_derived_variables_lookup, list_of_response_dictionaries, seconds)
+        return {
+            "n_rules": n_rules,
+            "n_passes": n_passes,
+            "n_responses": n_responses,
+            "missing_rate": missing_rate,
+            "compile_seconds": compile_seconds,
+            "seconds": seconds,
+            "rows_per_sec": n_responses / seconds if seconds > 0 else None,
+            "peak_memory_bytes": peak_memory_bytes,
+            "passes": passes,
+            "calculators": calculators,
+            "result_cache": result_cache,
+        }
+
+    def run(self, rule_counts: list, pass_depths: list, response_counts: list, missing_rates: list) -> dict:
+        scenarios = []
+        for n_rules, n_passes, n_responses, missing_rate in itertools.product(rule_counts, pass_depths, response_counts, missing_rates):
+            derived_variables_logger.info("Benchmark scenario: %s rules, %s passes, %s responses, missing rate %s", n_rules, n_passes, n_responses, missing_rate)
+            scenarios.append(self.run_scenario(n_rules, n_passes, n_responses, missing_rate))
+        return {
+            "benchmark": "derived_variables_row_engine",
+            "created_at": datetime.now().isoformat(),
+            "environment": {"python": platform.python_version(), "pandas": pd.__version__, "numpy": np.__version__, "platform": platform.platform()},
+            "rule_scheduling": self.rule_scheduling.name,
+            "repeat": self.repeat,
+            "result_cache_max_size": self.result_cache_max_size,
+            "seed": self.generator.seed,
+            "scenarios": scenarios,
+        }
+
+    @staticmethod
+    def to_json(results: dict) -> str:
+        return json.dumps(results, indent=2)
+
+# COMMAND ----------
+
+# DBTITLE 1,resolve arguments
+dbutils.widgets.text('rule_counts', '50,200')
+rule_counts = [int(x) for x in getArgument('rule_counts').split(',')]
+
+dbutils.widgets.text('pass_depths', '1,4')
+pass_depths = [int(x) for x in getArgument('pass_depths').split(',')]
+
+dbutils.widgets.text('response_counts', '1000,10000')
+response_counts = [int(x) for x in getArgument('response_counts').split(',')]
+
+dbutils.widgets.text('missing_rates', '0,0.2')
+missing_rates = [float(x) for x in getArgument('missing_rates').split(',')]
+
+# '' to skip the runs with a result cache
+dbutils.widgets.text('result_cache_max_size', '100000')
+result_cache_max_size = int(getArgument('result_cache_max_size')) if getArgument('result_cache_max_size') != '' else None
+
+dbutils.widgets.text('output_path', '')
+output_path = getArgument('output_path')
+
+# COMMAND ----------
+
+# DBTITLE 1,run the benchmark, save the results as JSON
+benchmark_results = DerivedVariablesBenchmark(result_cache_max_size=result_cache_max_size).run(rule_counts, pass_depths, response_counts, missing_rates)
+benchmark_results_json = DerivedVariablesBenchmark.to_json(benchmark_results)
+
+if(output_path != ''):
+  dbutils.fs.put(output_path, benchmark_results_json, True)
+print(benchmark_results_json)
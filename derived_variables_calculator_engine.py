@@ -5,17 +5,27 @@
 
 # MAGIC %md ## Overview
 # MAGIC This notebook contains the internals for the Derived Variables Calculator, such as:
+# MAGIC - typed response values (the conversions of raw response values read by the calculators), and the parser of multi-select values
 # MAGIC - abstract Calculator
 # MAGIC - concrete Calculator implemetations
-# MAGIC - Calculator factory
+# MAGIC - multi conditional Calculator (detail compiled into a predicate tree)
+# MAGIC - Calculator registry (and the factory using it)
+# MAGIC - Calculator result cache (LRU memo of evaluations, for responses with identical source values)
+# MAGIC - Rule plan (lookup dataframe compiled once into grouped, ordered Calculators)
 # MAGIC - enums
+# MAGIC - tracer (lazy, level-gated logging of calculator evaluations)
 
 # COMMAND ----------
 
-# DBTITLE 1,Definitions for Calculator, enums
+# DBTITLE 1,Definitions for Calculator, enums, tracing
 from enum import Enum
 import numpy as np
 import ast
+import functools
+import json
+import logging
+import random
+import re
 
 class PostCalculationInstruction(Enum):
     MOVE_TO_NEXT_VAR__VALUE_RESOLVED = 1
@@ -23,15 +33,322 @@ class PostCalculationInstruction(Enum):
     MOVE_TO_NEXT_VAR__UNDERLYING_DATA_NOT_FOUND = 3
     MOVE_TO_NEXT_VAR__WILL_ATTEMPT_TO_CALCULATE_ON_THE_NEXT_PASS = 4
     STOP__ALL_DONE = 5
-    
+
+
+derived_variables_logger = logging.getLogger("derived_variables_calculator")
+
+
+class TraceOutputFormat(Enum):
+    TEXT = 1
+    JSON_LINES = 2
+
+
+class DerivedVariablesTracer:
+    """
+    Lazy, level-gated tracing of calculator evaluations.
+    Whether a response is traced is decided once, in begin_response: the logger must be enabled for the trace level, and the response must be
+    listed in response_ids or picked with probability sample_rate. When neither response_ids nor sample_rate is given, every response is traced.
+    Calculators check is_tracing before building a message, and messages are %-formatted only when they are emitted,
+    so with tracing off an evaluation costs one attribute check per message.
+    TraceOutputFormat.JSON_LINES emits one JSON object per message, with the response id, derived variable and evaluator.
+    """
+    def __init__(self, logger: logging.Logger = derived_variables_logger, level: int = logging.DEBUG, sample_rate: float = None,
+                 response_ids: set = None, output_format: TraceOutputFormat = TraceOutputFormat.TEXT):
+        self.logger = logger
+        self.level = level
+        self.sample_rate = sample_rate
+        self.response_ids = set(response_ids) if response_ids is not None else None
+        self.output_format = output_format
+        self.is_tracing = False
+        self._response_id = None
+
+    def begin_response(self, row_response: dict):
+        self._response_id = row_response.get("responseId")
+        if not self.logger.isEnabledFor(self.level):
+            self.is_tracing = False
+        elif self.response_ids is None and self.sample_rate is None:
+            self.is_tracing = True
+        else:
+            self.is_tracing = (self.response_ids is not None and self._response_id in self.response_ids) \
+                              or (self.sample_rate is not None and random.random() < self.sample_rate)
+
+    def end_response(self):
+        self.is_tracing = False
+        self._response_id = None
+
+    def trace(self, calculator, message: str, *args):
+        if self.output_format == TraceOutputFormat.JSON_LINES:
+            self.logger.log(self.level, "%s", json.dumps({
+                "response_id": self._response_id,
+                "new_variable": calculator.new_var_name,
+                "evaluator": type(calculator).__name__,
+                "message": message % args if args else message}, default=str))
+        else:
+            self.logger.log(self.level, message, *args)
+
+
+default_derived_variables_tracer = DerivedVariablesTracer()
+
 from abc import ABC, abstractmethod
-from pandas import Series
+from collections.abc import Mapping
+import pandas as pd
+from pandas import DataFrame, Series
+
+
+class TypedResponseValues(Mapping):
+    """
+    The "values" of a response, read by the calculators through typed accessors, one per conversion the calculators apply to a raw value.
+    Every accessor raises KeyError when the key is not in the response, and raises (or returns None) exactly as the conversion it stands for.
+    The accessors of this class convert the raw value on every call; ResponseColumnsRowValues reads them from a response table instead,
+    where every raw value is converted once for all the rules reading it.
+    """
+    __slots__ = ()
+
+    def string_value(self, key) -> str:
+        """str(value)"""
+        return str(self[key])
+
+    def float_of_string_value(self, key) -> float:
+        """float(str(value)); None when Calculator.isfloat(str(value)) is False"""
+        value = str(self[key])
+        return float(value) if Calculator.isfloat(value) else None
+
+    def float_value(self, key) -> float:
+        """float(value)"""
+        return float(self[key])
+
+    def int_value(self, key) -> int:
+        """int(value)"""
+        return int(self[key])
+
+    def numeric_string_value(self, key) -> int:
+        """int(str(value)); None when str(value).isnumeric() is False"""
+        value = str(self[key])
+        return int(value) if value.isnumeric() else None
+
+    def list_of_floats_value(self, key) -> list:
+        """the items of value, as floats (Calculator.convert_str_to_list)"""
+        return Calculator.convert_str_to_list(self[key])
+
+
+class DictResponseValues(TypedResponseValues):
+    """
+    TypedResponseValues over the "values" dictionary of a response, read and written in place.
+    The accessors are repeated here on the dictionary itself: this is the path of the row engine, where every call counts.
+    """
+    __slots__ = ("_values",)
+
+    def __init__(self, values: dict):
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def keys(self):
+        return self._values.keys()
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def string_value(self, key) -> str:
+        return str(self._values[key])
+
+    def float_of_string_value(self, key) -> float:
+        value = str(self._values[key])
+        return float(value) if Calculator.isfloat(value) else None
+
+    def float_value(self, key) -> float:
+        return float(self._values[key])
+
+    def int_value(self, key) -> int:
+        return int(self._values[key])
+
+
+class MultiSelectValueParser:
+    """
+    Parses multi-select answers ("1,2,5", "[1, 2]", [1, 2], 3) into the list of their items as floats, as added by Calculator_Sum.
+    Strings of comma separated numbers, bracketed or not, are split and converted directly; every other value (quoted or nested items, hex or
+    underscored numbers, ...) goes through ast.literal_eval as it always did, so that it is accepted, or rejected with the same error, as before.
+    The items of the last cache_size distinct strings are cached (0 disables the cache): answers repeat across responses.
+    """
+    _number = re.compile(r"[+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?")
+    # "01" is not a Python literal
+    _int_with_leading_zero = re.compile(r"[+-]?0+[1-9][0-9]*")
+    _whitespace = " \t\n"
+
+    def __init__(self, cache_size: int = 65536):
+        self.cache_size = cache_size
+        self._parse_string = functools.lru_cache(maxsize=cache_size)(self._parse_string_uncached) if cache_size > 0 else self._parse_string_uncached
+
+    @staticmethod
+    def _split_numbers(value: str) -> tuple:
+        """
+        Items of a string of comma separated numbers, as floats; None when the string is anything else.
+        """
+        content = value
+        if "[" in value:
+            value = value.strip(" ")
+            if not (value.startswith("[") and value.endswith("]")) or value.count("[") != 1 or value.count("]") != 1:
+                return None
+            content = value[1:-1]
+        whitespace = MultiSelectValueParser._whitespace
+        if content.strip(whitespace) == "":
+            return ()
+        tokens = content.split(",")
+        # a trailing comma is valid in a list literal
+        if len(tokens) > 1 and tokens[-1].strip(whitespace) == "":
+            tokens.pop()
+        items = []
+        for token in tokens:
+            token = token.strip(whitespace)
+            if MultiSelectValueParser._number.fullmatch(token) is None:
+                return None
+            if "." in token or "e" in token or "E" in token:
+                items.append(float(token))
+            elif MultiSelectValueParser._int_with_leading_zero.fullmatch(token) is not None:
+                return None
+            else:
+                # float(int()) rather than float(): the literal "-0" is the int 0
+                items.append(float(int(token)))
+        return tuple(items)
+
+    @staticmethod
+    def _literal_eval(value) -> list:
+        if "[" not in str(value):
+            value = "[" + str(value) + "]"
+        return [float(x) for x in ast.literal_eval(value)]
+
+    @staticmethod
+    def _parse_string_uncached(value: str) -> tuple:
+        items = MultiSelectValueParser._split_numbers(value)
+        if items is None:
+            items = tuple(MultiSelectValueParser._literal_eval(value))
+        return items
+
+    def parse(self, value) -> list:
+        if isinstance(value, list):
+            return [float(x) for x in value]
+        if type(value) is str:
+            return list(self._parse_string(value))
+        return MultiSelectValueParser._literal_eval(value)
+
+    @staticmethod
+    def _items_matrix(list_of_items: list) -> np.ndarray:
+        width = max((len(items) for items in list_of_items), default=0)
+        items_matrix = np.zeros((len(list_of_items), width), dtype=np.float64)
+        for j, items in enumerate(list_of_items):
+            items_matrix[j, :len(items)] = items
+        return items_matrix
+
+    def split_column(self, values: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Vectorized variant of parse for a column of values: the items of every value as a row of a float matrix (padded with zeros
+        to the longest value), the count of items of every value, and a mask of the values parse accepts (for the others, parse raises).
+        The strings of the column are factorized first, so that every distinct string is parsed once, however many rows hold it;
+        other values (lists, numbers) are parsed one by one.
+        """
+        n_values = len(values)
+        is_string = np.fromiter((type(x) is str for x in values), dtype=bool, count=n_values)
+        unique_items = []
+        is_unique_parsed = []
+        codes = np.zeros(0, dtype=np.int64)
+        if is_string.any():
+            codes, unique_strings = pd.factorize(values[is_string])
+            for value in unique_strings:
+                try:
+                    unique_items.append(self._parse_string(value))
+                    is_unique_parsed.append(True)
+                except Exception:
+                    unique_items.append(())
+                    is_unique_parsed.append(False)
+        other_rows = np.flatnonzero(~is_string)
+        other_items = []
+        is_other_parsed = []
+        for value in values[other_rows].tolist():
+            try:
+                other_items.append(self.parse(value))
+                is_other_parsed.append(True)
+            except Exception:
+                other_items.append(())
+                is_other_parsed.append(False)
+
+        unique_items_matrix = MultiSelectValueParser._items_matrix(unique_items)
+        other_items_matrix = MultiSelectValueParser._items_matrix(other_items)
+        items_matrix = np.zeros((n_values, max(unique_items_matrix.shape[1], other_items_matrix.shape[1])), dtype=np.float64)
+        counts = np.zeros(n_values, dtype=np.int64)
+        is_parsed = np.zeros(n_values, dtype=bool)
+        if len(unique_items) > 0:
+            items_matrix[is_string, :unique_items_matrix.shape[1]] = unique_items_matrix[codes]
+            counts[is_string] = np.fromiter((len(x) for x in unique_items), dtype=np.int64, count=len(unique_items))[codes]
+            is_parsed[is_string] = np.array(is_unique_parsed, dtype=bool)[codes]
+        if len(other_items) > 0:
+            items_matrix[other_rows, :other_items_matrix.shape[1]] = other_items_matrix
+            counts[other_rows] = [len(x) for x in other_items]
+            is_parsed[other_rows] = is_other_parsed
+        return items_matrix, counts, is_parsed
+
+
+default_multi_select_value_parser = MultiSelectValueParser()
+
+
+class CalculatorRule:
+    """
+    Snapshot of a lookup row taken when its Calculator is created, with the rule constants converted once:
+    evaluating the rule for a response needs neither pandas access nor parsing of the lookup values.
+    """
+    __slots__ = ("key_a", "value_a", "value_a2", "key_b", "value_b", "key_c", "value_c", "key_d", "value_d",
+                 "action", "detail", "new_var_name", "new_var_value", "else_value",
+                 "str_value_a", "str_value_a2", "float_value_a", "values_a", "keys_a", "unique_keys_a", "else_result")
+
+    def __init__(self, row_variable_lookup: Series):
+        self.key_a = row_variable_lookup["survey_id_a"]
+        self.value_a = row_variable_lookup["survey_id_a_value_1"]
+        self.value_a2 = row_variable_lookup["survey_id_a_value_2"]
+        self.key_b = row_variable_lookup["survey_id_b"]
+        self.value_b = row_variable_lookup["survey_id_b_value"]
+        self.key_c = row_variable_lookup["survey_id_c"]
+        self.value_c = row_variable_lookup["survey_id_c_value"]
+        self.key_d = row_variable_lookup["survey_id_d"]
+        self.value_d = row_variable_lookup["survey_id_d_value"]
+        self.action = row_variable_lookup["action"]
+        self.detail = row_variable_lookup["detail"]
+        self.new_var_name = row_variable_lookup["new_variable"]
+        self.new_var_value = row_variable_lookup["fill_with_this"]
+        self.else_value = row_variable_lookup["else"]
+
+        # str(value_a), float(str(value_a)) (None when it is not a number) and the comma separated values of value_a, as compared by the conditional calculators
+        self.str_value_a = str(self.value_a)
+        self.str_value_a2 = str(self.value_a2)
+        self.float_value_a = float(self.str_value_a) if Calculator.isfloat(self.str_value_a) else None
+        self.values_a = frozenset(self.str_value_a.split(","))
+        # comma separated keys of key_a, as read by sum, mean, ...; unique_keys_a without duplicates
+        self.keys_a = tuple(self.key_a.split(",")) if isinstance(self.key_a, str) else ()
+        self.unique_keys_a = tuple(dict.fromkeys(self.keys_a))
+        # result of Calculator.handle_else_value, which depends on the rule only
+        if self.else_value is not None and not Calculator.isfloat(self.else_value):
+            self.else_result = (PostCalculationInstruction.MOVE_TO_NEXT_VAR__VALUE_RESOLVED, self.else_value)
+        else:
+            self.else_result = (PostCalculationInstruction.MOVE_TO_NEXT_RULE__KEYS_EXIST_CONDITIONS_NOT_MET, "")
 
 
 class Calculator(ABC):
     def __init__(self, row_variable_lookup: Series):
         self._row_variable_lookup = row_variable_lookup
-        self._is_printing_output_messages = True
+        self._rule = CalculatorRule(row_variable_lookup)
+        self._tracer = default_derived_variables_tracer
+        self._result_cache = None
         self._divider = "---------------------------------------------------------------------------------------------------------------------------------------------------------------------"
 
     # ===============================================================================
@@ -39,112 +356,148 @@ class Calculator(ABC):
     # ===============================================================================
 
     @property
-    def is_printing_output_messages(self):
-        return self._is_printing_output_messages
+    def tracer(self):
+        return self._tracer
+
+    @tracer.setter
+    def tracer(self, value: DerivedVariablesTracer):
+        self._tracer = value
+
+    @property
+    def result_cache(self):
+        """
+        CalculatorResultCache memoizing the results of this rule; None (the default) evaluates every response.
+        """
+        return self._result_cache
+
+    @result_cache.setter
+    def result_cache(self, value):
+        self._result_cache = value
 
-    @is_printing_output_messages.setter
-    def is_printing_output_messages(self, value):
-        self._is_printing_output_messages = value
+    @property
+    def is_tracing(self) -> bool:
+        return self._tracer.is_tracing
 
     @property
     def row_variable_lookup(self):
         return self._row_variable_lookup
 
+    @property
+    def rule(self) -> CalculatorRule:
+        return self._rule
+
     @property
     def key_a(self):
-        return self._row_variable_lookup["survey_id_a"]
+        return self._rule.key_a
 
     @property
     def value_a(self):
-        return self._row_variable_lookup["survey_id_a_value_1"]
+        return self._rule.value_a
 
     @property
     def value_a2(self):
-        return self._row_variable_lookup["survey_id_a_value_2"]
+        return self._rule.value_a2
 
     @property
     def key_b(self):
-        return self._row_variable_lookup["survey_id_b"]
+        return self._rule.key_b
 
     @property
     def value_b(self):
-        return self._row_variable_lookup["survey_id_b_value"]
+        return self._rule.value_b
 
     @property
     def key_c(self):
-        return self._row_variable_lookup["survey_id_c"]
+        return self._rule.key_c
 
     @property
     def value_c(self):
-        return self._row_variable_lookup["survey_id_c_value"]
+        return self._rule.value_c
 
     @property
     def key_d(self):
-        return self._row_variable_lookup["survey_id_d"]
+        return self._rule.key_d
 
     @property
     def value_d(self):
-        return self._row_variable_lookup["survey_id_d_value"]
+        return self._rule.value_d
 
     @property
     def action(self):
-        return self._row_variable_lookup["action"]
+        return self._rule.action
 
     @property
     def detail(self):
-        return self._row_variable_lookup["detail"]
+        return self._rule.detail
 
     @property
     def new_var_name(self):
-        return self._row_variable_lookup["new_variable"]
+        return self._rule.new_var_name
 
     @property
     def new_var_value(self):
-        return self._row_variable_lookup["fill_with_this"]
+        return self._rule.new_var_value
 
     @property
     def else_value(self):
-        return self._row_variable_lookup["else"]
+        return self._rule.else_value
+
+    @property
+    def source_keys(self) -> list:
+        """
+        Response keys the rule reads: survey_id_a..d, with comma-separated lists (as used by sum, mean, ...) split into separate keys.
+        """
+        source_keys = []
+        for key in [self.key_a, self.key_b, self.key_c, self.key_d]:
+            if isinstance(key, str):
+                source_keys += [x for x in key.split(",") if x not in source_keys]
+        return source_keys
 
     # ===============================================================================
     # Utility methods
     # ===============================================================================
 
     def actual_value_in_response_a(self, row_response: tuple):
-        return row_response["values"][self.key_a]
+        return row_response["values"][self._rule.key_a]
+
+    @staticmethod
+    def as_typed_values(values) -> TypedResponseValues:
+        return DictResponseValues(values) if isinstance(values, dict) else values
+
+    @staticmethod
+    def typed_values(row_response: tuple) -> TypedResponseValues:
+        return Calculator.as_typed_values(row_response["values"])
 
     def handle_new_var_value(self) -> (PostCalculationInstruction, str):
-        self.print_output_message(f"Resolved to {self.new_var_value}")
-        return PostCalculationInstruction.MOVE_TO_NEXT_VAR__VALUE_RESOLVED, self.new_var_value
-
-    def handle_else_value(self) -> (PostCalculationInstruction, str):        
-        # if self.else_value is not None:
-        # isfloat(actual_value_in_the_response)
-#         if self.else_value is not None and not np.isnan(self.else_value):
-        if self.else_value is not None and not self.isfloat(self.else_value):
-            # I've never seen else value being provided.
-            self.print_output_message(f"Resolved to {self.else_value}")
-            return PostCalculationInstruction.MOVE_TO_NEXT_VAR__VALUE_RESOLVED, self.else_value
-        else:
-            self.print_output_message(f"condition not met")
-            return PostCalculationInstruction.MOVE_TO_NEXT_RULE__KEYS_EXIST_CONDITIONS_NOT_MET, ""
+        if self._tracer.is_tracing:
+            self.trace("Resolved to %s", self._rule.new_var_value)
+        return PostCalculationInstruction.MOVE_TO_NEXT_VAR__VALUE_RESOLVED, self._rule.new_var_value
+
+    def handle_else_value(self) -> (PostCalculationInstruction, str):
+        # resolved to the else value when it is provided and not a number (CalculatorRule.else_result)
+        if self._tracer.is_tracing:
+            if self._rule.else_result[0] == PostCalculationInstruction.MOVE_TO_NEXT_VAR__VALUE_RESOLVED:
+                self.trace("Resolved to %s", self._rule.else_value)
+            else:
+                self.trace("condition not met")
+        return self._rule.else_result
 
-    def print_top(self):
-        self.print_output_message(self._divider)
-        self.print_output_message(f"Derived variable name: {self.new_var_name}")
-        self.print_output_message(f"Evaluator: {type(self).__name__}")
-        self.print_output_message(f"action: {self.action}; detail: {self.detail}")
+    def trace_top(self):
+        self.trace("%s", self._divider)
+        self.trace("Derived variable name: %s", self.new_var_name)
+        self.trace("Evaluator: %s", type(self).__name__)
+        self.trace("action: %s; detail: %s", self.action, self.detail)
 
-    def print_bottom(self):
-        self.print_output_message(self._divider)
+    def trace_bottom(self):
+        self.trace("%s", self._divider)
 
-    def print_key_not_found_error(self, e: KeyError):
-        self.print_output_message(f"KeyError exception in {(type(self)).__name__}: Key {e} does not exist.")
-        self.print_output_message(self._divider)
+    def trace_key_not_found_error(self, e: KeyError):
+        self.trace("KeyError exception in %s: Key %s does not exist.", (type(self)).__name__, e)
+        self.trace("%s", self._divider)
 
-    def print_output_message(self, message: str):
-        if self.is_printing_output_messages:
-            print(message)
+    def trace(self, message: str, *args):
+        if self._tracer.is_tracing:
+            self._tracer.trace(self, message, *args)
     
     @staticmethod
     def isfloat(value):
@@ -156,15 +509,10 @@ class Calculator(ABC):
     
     @staticmethod
     def convert_str_to_list(value):
-        if isinstance(value, list):
-            new_list = []
-            for x in value:
-                new_list.append(float(x))
-            return new_list
-        else:
-            if "[" not in str(value):
-                value = "[" + str(value) + "]"
-            return ast.literal_eval(value)
+        """
+        Items of a multi-select value, as floats (see MultiSelectValueParser).
+        """
+        return default_multi_select_value_parser.parse(value)
       
     @staticmethod
     def check_key(d, key):      
@@ -188,13 +536,21 @@ class Calculator(ABC):
 
                 :rtype: (PostCalculationInstruction, str)
                 """
+        if self._result_cache is not None and not self._tracer.is_tracing:
+            return self._result_cache.produce_new_var(self, row_response)
+        return self.produce_new_var_uncached(row_response)
+
+    def produce_new_var_uncached(self, row_response: tuple) -> (PostCalculationInstruction, str):
         try:
-            self.print_top()
+            if self._tracer.is_tracing:
+                self.trace_top()
             result = self.evaluate(row_response)
-            self.print_bottom()
+            if self._tracer.is_tracing:
+                self.trace_bottom()
             return result
         except KeyError as e:
-            self.print_key_not_found_error(e)
+            if self._tracer.is_tracing:
+                self.trace_key_not_found_error(e)
             return PostCalculationInstruction.MOVE_TO_NEXT_VAR__UNDERLYING_DATA_NOT_FOUND, ""
 
     @abstractmethod
@@ -211,14 +567,17 @@ class Calculator__Conditional_Equal(Calculator):
         super().__init__(row_variable_lookup)
 
     def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response = str(super().actual_value_in_response_a(row_response))
-        value_to_compare_with = str(super().value_a)
-        super().print_output_message(
-            f"Calculator__Conditional_Equal; key_to_find: {super().key_a}; "
-            f"formula: if actual_value_in_the_response == value_to_compare_with then new_var_value else else_value; "
-            f"if {actual_value_in_the_response} == {value_to_compare_with} then {super().new_var_value} else {super().else_value}")
-        if super().isfloat(actual_value_in_the_response) and super().isfloat(value_to_compare_with):
-            if float(actual_value_in_the_response) == float(value_to_compare_with):
+        values = super().typed_values(row_response)
+        actual_value_in_the_response = values.float_of_string_value(self._rule.key_a)
+        value_to_compare_with = self._rule.float_value_a
+        if super().is_tracing:
+            super().trace(
+                "Calculator__Conditional_Equal; key_to_find: %s; "
+                "formula: if actual_value_in_the_response == value_to_compare_with then new_var_value else else_value; "
+                "if %s == %s then %s else %s",
+                super().key_a, values.string_value(self._rule.key_a), self._rule.str_value_a, super().new_var_value, super().else_value)
+        if value_to_compare_with is not None and actual_value_in_the_response is not None:
+            if actual_value_in_the_response == value_to_compare_with:
                 return super().handle_new_var_value()
             else:
                 return super().handle_else_value()
@@ -230,12 +589,14 @@ class Calculator__Conditional_EqualString(Calculator):
         super().__init__(row_variable_lookup)
 
     def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response = super().actual_value_in_response_a(row_response)
-        value_to_compare_with = super().value_a
-        super().print_output_message(
-            f"Calculator__Conditional_EqualString; key_to_find: {super().key_a}; "
-            f"formula: if actual_value_in_the_response == value_to_compare_with then new_var_value else else_value; "
-            f"if {actual_value_in_the_response} == {value_to_compare_with} then {super().new_var_value} else {super().else_value}")
+        actual_value_in_the_response = row_response["values"][self._rule.key_a]
+        value_to_compare_with = self._rule.value_a
+        if super().is_tracing:
+            super().trace(
+                "Calculator__Conditional_EqualString; key_to_find: %s; "
+                "formula: if actual_value_in_the_response == value_to_compare_with then new_var_value else else_value; "
+                "if %s == %s then %s else %s",
+                super().key_a, actual_value_in_the_response, value_to_compare_with, super().new_var_value, super().else_value)
 
         if actual_value_in_the_response == value_to_compare_with:
             return super().handle_new_var_value()
@@ -248,13 +609,16 @@ class Calculator__Conditional_GreaterThan(Calculator):
         super().__init__(row_variable_lookup)
 
     def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response = str(super().actual_value_in_response_a(row_response))
-        value_to_compare_with = str(super().value_a)
-        super().print_output_message(f"Calculator__Conditional_GreaterThan; key_to_find: {super().key_a}; "
-                                     f"formula: if actual_value_in_the_response > value_to_compare_with then new_var_value else else_value; "
-                                     f"if {actual_value_in_the_response} > {value_to_compare_with} then {super().new_var_value} else {super().else_value}")
-        if super().isfloat(actual_value_in_the_response) and super().isfloat(value_to_compare_with):
-            if float(actual_value_in_the_response) > float(value_to_compare_with):
+        values = super().typed_values(row_response)
+        actual_value_in_the_response = values.float_of_string_value(self._rule.key_a)
+        value_to_compare_with = self._rule.float_value_a
+        if super().is_tracing:
+            super().trace("Calculator__Conditional_GreaterThan; key_to_find: %s; "
+                          "formula: if actual_value_in_the_response > value_to_compare_with then new_var_value else else_value; "
+                          "if %s > %s then %s else %s",
+                          super().key_a, values.string_value(self._rule.key_a), self._rule.str_value_a, super().new_var_value, super().else_value)
+        if value_to_compare_with is not None and actual_value_in_the_response is not None:
+            if actual_value_in_the_response > value_to_compare_with:
                 return super().handle_new_var_value()
             else:
                 return super().handle_else_value()
@@ -266,14 +630,17 @@ class Calculator_Conditional_GreaterThanEqual(Calculator):
         super().__init__(row_variable_lookup)
 
     def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response = str(super().actual_value_in_response_a(row_response))
-        value_to_compare_with = str(super().value_a)
-        super().print_output_message(
-            f"Calculator_Conditional_GreaterThanEqual; key_to_find: {super().key_a}; "
-            f"formula: if actual_value_in_the_response >= value_to_compare_with then new_var_value else else_value; "
-            f"if {actual_value_in_the_response} >= {value_to_compare_with} then {super().new_var_value} else {super().else_value}")
-        if super().isfloat(actual_value_in_the_response) and super().isfloat(value_to_compare_with):
-            if float(actual_value_in_the_response) >= float(value_to_compare_with):
+        values = super().typed_values(row_response)
+        actual_value_in_the_response = values.float_of_string_value(self._rule.key_a)
+        value_to_compare_with = self._rule.float_value_a
+        if super().is_tracing:
+            super().trace(
+                "Calculator_Conditional_GreaterThanEqual; key_to_find: %s; "
+                "formula: if actual_value_in_the_response >= value_to_compare_with then new_var_value else else_value; "
+                "if %s >= %s then %s else %s",
+                super().key_a, values.string_value(self._rule.key_a), self._rule.str_value_a, super().new_var_value, super().else_value)
+        if value_to_compare_with is not None and actual_value_in_the_response is not None:
+            if actual_value_in_the_response >= value_to_compare_with:
                 return super().handle_new_var_value()
             else:
                 return super().handle_else_value()
@@ -285,15 +652,16 @@ class Calculator__Conditional_IsIn(Calculator):
         super().__init__(row_variable_lookup)
 
     def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response = str(super().actual_value_in_response_a(row_response))
-        value_to_compare_with = str(super().value_a)
-        list_to_use_for_comparison = value_to_compare_with.split(",")
-        super().print_output_message(
-            f"Calculator__Conditional_IsIn; key_to_find: {super().key_a}; "
-            f"formula: if actual_value_in_the_response is in the values provided by comma separated value_to_compare_with then new_var_value else else_value; "
-            f"actual value: {actual_value_in_the_response}; Value to compare with: {value_to_compare_with} then {super().new_var_value} else {super().else_value}")
-
-        if actual_value_in_the_response in list_to_use_for_comparison:
+        actual_value_in_the_response = super().typed_values(row_response).string_value(self._rule.key_a)
+        values_to_compare_with = self._rule.values_a
+        if super().is_tracing:
+            super().trace(
+                "Calculator__Conditional_IsIn; key_to_find: %s; "
+                "formula: if actual_value_in_the_response is in the values provided by comma separated value_to_compare_with then new_var_value else else_value; "
+                "actual value: %s; Value to compare with: %s then %s else %s",
+                super().key_a, actual_value_in_the_response, self._rule.str_value_a, super().new_var_value, super().else_value)
+
+        if actual_value_in_the_response in values_to_compare_with:
             return super().handle_new_var_value()
         else:
             return super().handle_else_value()
@@ -304,13 +672,16 @@ class Calculator_Conditional_LessThan(Calculator):
         super().__init__(row_variable_lookup)
 
     def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response = str(super().actual_value_in_response_a(row_response))
-        value_to_compare_with = str(super().value_a)
-        super().print_output_message(f"Calculator_Conditional_LessThan; key_to_find: {super().key_a}; "
-                                     f"formula: if actual_value_in_the_response < value_to_compare_with then new_var_value else else_value; "
-                                     f"if {actual_value_in_the_response} < {value_to_compare_with} then {super().new_var_value} else {super().else_value}")
-        if super().isfloat(actual_value_in_the_response) and super().isfloat(value_to_compare_with):
-            if float(actual_value_in_the_response) < float(value_to_compare_with):
+        values = super().typed_values(row_response)
+        actual_value_in_the_response = values.float_of_string_value(self._rule.key_a)
+        value_to_compare_with = self._rule.float_value_a
+        if super().is_tracing:
+            super().trace("Calculator_Conditional_LessThan; key_to_find: %s; "
+                          "formula: if actual_value_in_the_response < value_to_compare_with then new_var_value else else_value; "
+                          "if %s < %s then %s else %s",
+                          super().key_a, values.string_value(self._rule.key_a), self._rule.str_value_a, super().new_var_value, super().else_value)
+        if value_to_compare_with is not None and actual_value_in_the_response is not None:
+            if actual_value_in_the_response < value_to_compare_with:
                 return super().handle_new_var_value()
             else:
                 return super().handle_else_value()
@@ -322,13 +693,16 @@ class Calculator_Conditional_LessThanEqual(Calculator):
         super().__init__(row_variable_lookup)
 
     def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response = str(super().actual_value_in_response_a(row_response))
-        value_to_compare_with = str(super().value_a)
-        super().print_output_message(f"Calculator_Conditional_LessThanEqual; key_to_find: {super().key_a}; formula: "
-                                     f"if actual_value_in_the_response <= value_to_compare_with then new_var_value else else_value; "
-                                     f"if {actual_value_in_the_response} <= {value_to_compare_with} then {super().new_var_value} else {super().else_value}")
-        if super().isfloat(actual_value_in_the_response) and super().isfloat(value_to_compare_with):
-            if float(actual_value_in_the_response) <= float(value_to_compare_with):
+        values = super().typed_values(row_response)
+        actual_value_in_the_response = values.float_of_string_value(self._rule.key_a)
+        value_to_compare_with = self._rule.float_value_a
+        if super().is_tracing:
+            super().trace("Calculator_Conditional_LessThanEqual; key_to_find: %s; formula: "
+                          "if actual_value_in_the_response <= value_to_compare_with then new_var_value else else_value; "
+                          "if %s <= %s then %s else %s",
+                          super().key_a, values.string_value(self._rule.key_a), self._rule.str_value_a, super().new_var_value, super().else_value)
+        if value_to_compare_with is not None and actual_value_in_the_response is not None:
+            if actual_value_in_the_response <= value_to_compare_with:
                 return super().handle_new_var_value()
             else:
                 return super().handle_else_value()
@@ -340,16 +714,19 @@ class Calculator_Mean(Calculator):
         super().__init__(row_variable_lookup)
 
     def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        super().print_output_message("Calculator_Mean: find mean from values mapped to keys in comma-separated list coming from survey_id_a")
-        super().print_output_message(f"Here are the keys: {super().key_a}")
-        list_of_keys_to_use_for_sum = super().key_a.split(",")
+        super().trace("Calculator_Mean: find mean from values mapped to keys in comma-separated list coming from survey_id_a")
+        if super().is_tracing:
+            super().trace("Here are the keys: %s", super().key_a)
+        values = super().typed_values(row_response)
         values_to_mean = []
-        for s in list_of_keys_to_use_for_sum:
-            values_to_mean.append(float(row_response["values"][s]))
-        super().print_output_message(f"values_to_mean: {values_to_mean}")
+        for s in self._rule.keys_a:
+            values_to_mean.append(values.float_value(s))
+        if super().is_tracing:
+            super().trace("values_to_mean: %s", values_to_mean)
         result = statistics.mean(values_to_mean)
-        super().print_output_message(f"result: {result}")
-        super().print_bottom()
+        if super().is_tracing:
+            super().trace("result: %s", result)
+        super().trace_bottom()
         return PostCalculationInstruction.MOVE_TO_NEXT_VAR__VALUE_RESOLVED, result
 
 
@@ -359,23 +736,27 @@ class Calculator_Mean_N_Or_More(Calculator):
         self._max_count_of_missing_values = max_count_of_missing_values
 
     def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        super().print_output_message("Calculator_Mean_N_Or_More: find mean from values mapped to keys in comma-separated list coming from survey_id_a.")
-        super().print_output_message(f"If {self._max_count_of_missing_values} or more values are missing, empty results will be returned.")
-        super().print_output_message(f"Here are the keys: {super().key_a}")
-        list_of_keys_to_use_for_mean = super().key_a.split(",")
-        expected_count = len(list_of_keys_to_use_for_mean)
+        super().trace("Calculator_Mean_N_Or_More: find mean from values mapped to keys in comma-separated list coming from survey_id_a.")
+        if super().is_tracing:
+            super().trace("If %s or more values are missing, empty results will be returned.", self._max_count_of_missing_values)
+        if super().is_tracing:
+            super().trace("Here are the keys: %s", super().key_a)
+        list_of_keys_to_use_for_mean = self._rule.keys_a
+        values = super().typed_values(row_response)
         values_to_mean = []
         for s in list_of_keys_to_use_for_mean:
-            if super().check_key(row_response["values"], s):
-                if row_response["values"][s] is not None:
-                    values_to_mean.append(int(row_response["values"][s]))
-        super().print_output_message(f"values_to_mean: {values_to_mean}")
+            if super().check_key(values, s):
+                if values[s] is not None:
+                    values_to_mean.append(values.int_value(s))
+        if super().is_tracing:
+            super().trace("values_to_mean: %s", values_to_mean)
         if (len(list_of_keys_to_use_for_mean) - len(values_to_mean)) >= self._max_count_of_missing_values:
             result = ""
         else:
             result = statistics.mean(values_to_mean)
-        super().print_output_message(f"result: {result}")
-        super().print_bottom()
+        if super().is_tracing:
+            super().trace("result: %s", result)
+        super().trace_bottom()
         return PostCalculationInstruction.MOVE_TO_NEXT_VAR__VALUE_RESOLVED, result
 
 
@@ -384,26 +765,30 @@ class Calculator_Mean_SkipNA(Calculator):
         super().__init__(row_variable_lookup)
 
     def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        super().print_output_message("Calculator_Mean_SkipNA: find mean from values mapped to keys in comma-separated list coming from survey_id_a, skip na")
-        super().print_output_message(f"Here are the keys: {super().key_a}")
-        list_of_keys_to_use_for_sum = super().key_a.split(",")
+        super().trace("Calculator_Mean_SkipNA: find mean from values mapped to keys in comma-separated list coming from survey_id_a, skip na")
+        if super().is_tracing:
+            super().trace("Here are the keys: %s", super().key_a)
+        values = super().typed_values(row_response)
         values_to_mean = []
-        for s in list_of_keys_to_use_for_sum:
-            print(type(row_response["values"][s]))
-            print(row_response["values"][s])
-            if (str(row_response["values"][s])).isnumeric():
-                if row_response["values"][s] != -99:
-                    values_to_mean.append(float(row_response["values"][s]))
+        for s in self._rule.keys_a:
+            if super().is_tracing:
+                super().trace("value for %s: %s (%s)", s, values[s], type(values[s]))
+            if values.string_value(s).isnumeric():
+                if values[s] != -99:
+                    values_to_mean.append(values.float_value(s))
             else:
-                super().print_output_message(f"value for {s} is not numeric, returning an empty result")
-                super().print_output_message(f"result: ")
+                if super().is_tracing:
+                    super().trace("value for %s is not numeric, returning an empty result", s)
+                super().trace("result: ")
                 return PostCalculationInstruction.MOVE_TO_NEXT_VAR__VALUE_RESOLVED, ""
-        super().print_output_message(f"values_to_mean: {values_to_mean}")
+        if super().is_tracing:
+            super().trace("values_to_mean: %s", values_to_mean)
         if len(values_to_mean) > 0:
             result = statistics.mean(values_to_mean)
         else:
             result = ""
-        super().print_output_message(f"result: {result}")
+        if super().is_tracing:
+            super().trace("result: %s", result)
         return PostCalculationInstruction.MOVE_TO_NEXT_VAR__VALUE_RESOLVED, result
 
 
@@ -412,158 +797,31 @@ class Calculator_Merge(Calculator):
         super().__init__(row_variable_lookup)
 
     def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        super().print_output_message("Calculator_Merge: concatenates string values from two fields")
-        super().print_output_message(f"Values come from these fields: {super().key_a} and {super().key_b}")
+        super().trace("Calculator_Merge: concatenates string values from two fields")
+        if super().is_tracing:
+            super().trace("Values come from these fields: %s and %s", super().key_a, super().key_b)
 
-        value_1 = str(row_response["values"][super().key_a])
-        value_2 = str(row_response["values"][super().key_b])
+        values = super().typed_values(row_response)
+        value_1 = values.string_value(self._rule.key_a)
+        value_2 = values.string_value(self._rule.key_b)
         result = value_1 + value_2
-        super().print_output_message(f"result: {result}")
+        if super().is_tracing:
+            super().trace("result: %s", result)
         return PostCalculationInstruction.MOVE_TO_NEXT_VAR__VALUE_RESOLVED, result
 
 
-class Calculator__MultiConditionalAnd_Equal_IsNull(Calculator):
-    def __init__(self, row_variable_lookup: tuple):
-        super().__init__(row_variable_lookup)
-
-    def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response_1 = str(row_response["values"][super().key_a])
-        value_to_compare_with_1 = str(super().value_a)
-        actual_value_in_the_response_2 = str(row_response["values"][super().key_b])
-        super().print_output_message(
-            f"Calculator__MultiConditionalAnd_Equal_IsNull; key_to_find_1: {super().key_a}, key_to_find_2: {super().key_b}; "
-            f"formula: if actual_value_in_the_response1 == value_to_compare_with_1 and actual_value_in_the_response2 is null then new_var_value else else_value; "
-            f"if {actual_value_in_the_response_1} == {value_to_compare_with_1} and {actual_value_in_the_response_2} is None then {super().new_var_value} else {super().else_value}")
-        if super().isfloat(actual_value_in_the_response_1) and super().isfloat(value_to_compare_with_1):
-            if float(actual_value_in_the_response_1) == float(value_to_compare_with_1) and actual_value_in_the_response_2 is None:
-                return super().handle_new_var_value()
-            else:
-                return super().handle_else_value()
-        return PostCalculationInstruction.MOVE_TO_NEXT_VAR__UNDERLYING_DATA_NOT_FOUND, ""
-
-
-class Calculator__MultiConditional_Equal_Equal(Calculator):
-    def __init__(self, row_variable_lookup: tuple):
-        super().__init__(row_variable_lookup)
-
-    def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response_1 = str(row_response["values"][super().key_a])
-        value_to_compare_with_1 = str(super().value_a)
-        actual_value_in_the_response_2 = str(row_response["values"][super().key_b])
-        value_to_compare_with_2 = str(super().value_b)
-        super().print_output_message(
-            f"Calculator__MultiConditional_Equal_Equal; key_to_find_1: {super().key_a}, key_to_find_2: {super().key_b}; "
-            f"formula: if actual_value_in_the_response1 == value_to_compare_with_1 and actual_value_in_the_response2 == value_to_compare_with_2 then new_var_value else else_value; "
-            f"if {actual_value_in_the_response_1} == {value_to_compare_with_1} and {actual_value_in_the_response_2} == {value_to_compare_with_2} then {super().new_var_value} else {super().else_value}")
-        if super().isfloat(actual_value_in_the_response_1) and super().isfloat(value_to_compare_with_1) and super().isfloat(actual_value_in_the_response_2) and super().isfloat(value_to_compare_with_2):
-            if float(actual_value_in_the_response_1) == float(value_to_compare_with_1) and float(actual_value_in_the_response_2) == float(value_to_compare_with_2):
-                return super().handle_new_var_value()
-            else:
-                return super().handle_else_value()
-        return PostCalculationInstruction.MOVE_TO_NEXT_VAR__UNDERLYING_DATA_NOT_FOUND, ""
-
-
-class Calculator__MultiConditional_Equal_GreaterThan(Calculator):
-    def __init__(self, row_variable_lookup: tuple):
-        super().__init__(row_variable_lookup)
-
-    def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response_1 = str(row_response["values"][super().key_a])
-        value_to_compare_with_1 = str(super().value_a)
-        actual_value_in_the_response_2 = str(row_response["values"][super().key_b])
-        value_to_compare_with_2 = str(super().value_b)
-
-        super().print_output_message(
-            f"Calculator__MultiConditional_Equal_GreaterThan; key_to_find_1: {super().key_a}, key_to_find_2: {super().key_b}; "
-            f"formula: if actual_value_in_the_response1 == value_to_compare_with_1 and actual_value_in_the_response2 > value_to_compare_with_2 then new_var_value else else_value; "
-            f"if {actual_value_in_the_response_1} == {value_to_compare_with_1} and {actual_value_in_the_response_2} > {value_to_compare_with_2} then {super().new_var_value} else {super().else_value}")
-
-        if super().isfloat(actual_value_in_the_response_1) and super().isfloat(value_to_compare_with_1) and super().isfloat(actual_value_in_the_response_2) and super().isfloat(value_to_compare_with_2):
-            if float(actual_value_in_the_response_1) == float(value_to_compare_with_1) and float(actual_value_in_the_response_2) > float(value_to_compare_with_2):
-                return super().handle_new_var_value()
-            else:
-                return super().handle_else_value()
-        return PostCalculationInstruction.MOVE_TO_NEXT_VAR__UNDERLYING_DATA_NOT_FOUND, ""
-
-
-class Calculator__MultiConditional_Equal_IsNull(Calculator):
-    def __init__(self, row_variable_lookup: tuple):
-        super().__init__(row_variable_lookup)
-
-    def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response_1 = str(row_response["values"][super().key_a])
-        value_to_compare_with_1 = str(super().value_a)
-        actual_value_in_the_response_2 = str(row_response["values"][super().key_b])
-
-        super().print_output_message(
-            f"Calculator__MultiConditional_Equal_IsNull; key_to_find_1: {super().key_a}, key_to_find_2: {super().key_b}; "
-            f"formula: if actual_value_in_the_response1 == value_to_compare_with_1 and actual_value_in_the_response2 is None then new_var_value else else_value; "
-            f"if {actual_value_in_the_response_1} == {value_to_compare_with_1} and {actual_value_in_the_response_2} is None then {super().new_var_value} else {super().else_value}")
-
-        if super().isfloat(actual_value_in_the_response_1) and super().isfloat(value_to_compare_with_1):
-            if float(actual_value_in_the_response_1) == float(value_to_compare_with_1) and "".__eq__(actual_value_in_the_response_2):               
-              return super().handle_new_var_value()
-            else:
-              return super().handle_else_value()
-        return PostCalculationInstruction.MOVE_TO_NEXT_VAR__UNDERLYING_DATA_NOT_FOUND, ""
-
-
-class Calculator__MultiConditionalAnd_Equal_Equal(Calculator):
-    def __init__(self, row_variable_lookup: tuple):
-        super().__init__(row_variable_lookup)
-
-    def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response_1 = str(row_response["values"][super().key_a])
-        value_to_compare_with_1 = str(super().value_a)
-        actual_value_in_the_response_2 = str(row_response["values"][super().key_b])
-        value_to_compare_with_2 = str(super().value_b)
-
-        super().print_output_message(
-            f"Calculator__MultiConditionalAnd_Equal_Equal; key_to_find_1: {super().key_a}, key_to_find_2: {super().key_b}; "
-            f"formula: if actual_value_in_the_response1 == value_to_compare_with_1 and actual_value_in_the_response2 == value_to_compare_with_2 then new_var_value else else_value; "
-            f"if {actual_value_in_the_response_1} == {value_to_compare_with_1} and {actual_value_in_the_response_2} == {value_to_compare_with_2} then {super().new_var_value} else {super().else_value}")
-
-        if super().isfloat(actual_value_in_the_response_1) and super().isfloat(value_to_compare_with_1) and super().isfloat(actual_value_in_the_response_2) and super().isfloat(value_to_compare_with_2):
-            if float(actual_value_in_the_response_1) == float(value_to_compare_with_1) and float(actual_value_in_the_response_2) == float(value_to_compare_with_2):
-                return super().handle_new_var_value()
-            else:
-                return super().handle_else_value()
-        return PostCalculationInstruction.MOVE_TO_NEXT_VAR__UNDERLYING_DATA_NOT_FOUND, ""
-
-
-class Calculator__MultiConditionalAnd_LessThan_Equal(Calculator):
-    def __init__(self, row_variable_lookup: tuple):
-        super().__init__(row_variable_lookup)
-
-    def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response_1 = str(row_response["values"][super().key_a])
-        value_to_compare_with_1 = str(super().value_a)
-        actual_value_in_the_response_2 = str(row_response["values"][super().key_b])
-        value_to_compare_with_2 = str(super().value_b)
-
-        super().print_output_message(
-            f"Calculator__MultiConditionalAnd_LessThan_Equal; key_to_find_1: {super().key_a}, key_to_find_2: {super().key_b} ; "
-            f"formula: if actual_value_in_the_response1 < value_to_compare_with_1 and actual_value_in_the_response2 == value_to_compare_with_2 then new_var_value else else_value; "
-            f"if {actual_value_in_the_response_1} < {value_to_compare_with_1} and {actual_value_in_the_response_2} == {value_to_compare_with_2} then {super().new_var_value} else {super().else_value}")
-        
-        if super().isfloat(actual_value_in_the_response_1) and super().isfloat(value_to_compare_with_1) and super().isfloat(actual_value_in_the_response_2) and super().isfloat(value_to_compare_with_2):
-            if float(actual_value_in_the_response_1) < float(value_to_compare_with_1) and float(actual_value_in_the_response_2) == float(value_to_compare_with_2):
-                return super().handle_new_var_value()
-            else:
-                return super().handle_else_value()
-        return PostCalculationInstruction.MOVE_TO_NEXT_VAR__UNDERLYING_DATA_NOT_FOUND, ""
-
-
 class Calculator__None(Calculator):
     def __init__(self, row_variable_lookup: tuple):
         super().__init__(row_variable_lookup)
 
     def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        super().print_output_message("Calculator__None: concatenates string values from two fields")
-        super().print_output_message(f"Values come from these fields: {super().key_a}")
-        value_1 = str(row_response["values"][super().key_a])
+        super().trace("Calculator__None: concatenates string values from two fields")
+        if super().is_tracing:
+            super().trace("Values come from these fields: %s", super().key_a)
+        value_1 = super().typed_values(row_response).string_value(self._rule.key_a)
         result = value_1
-        super().print_output_message(f"result: {result}")
+        if super().is_tracing:
+            super().trace("result: %s", result)
         return PostCalculationInstruction.MOVE_TO_NEXT_VAR__VALUE_RESOLVED, result
 
 
@@ -596,12 +854,14 @@ class Calculator_Recode(Calculator):
         super().__init__(row_variable_lookup)
 
     def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        super().print_output_message("Calculator_Recode: 6 - value")
-        super().print_output_message(f"6 - {super().key_a}")
-        value_1 = str(row_response["values"][super().key_a])
-        if value_1.isnumeric():
-            result = 6 - int(value_1)
-        super().print_output_message(f"result: {result}")
+        super().trace("Calculator_Recode: 6 - value")
+        if super().is_tracing:
+            super().trace("6 - %s", super().key_a)
+        value_1 = super().typed_values(row_response).numeric_string_value(self._rule.key_a)
+        if value_1 is not None:
+            result = 6 - value_1
+        if super().is_tracing:
+            super().trace("result: %s", result)
         return PostCalculationInstruction.MOVE_TO_NEXT_VAR__VALUE_RESOLVED, result
 
 
@@ -610,12 +870,14 @@ class Calculator_Recode_2(Calculator):
         super().__init__(row_variable_lookup)
 
     def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        super().print_output_message("Calculator_Recode_2: 7 - value + 1")
-        super().print_output_message(f"8 - {super().key_a}")
-        value_1 = str(row_response["values"][super().key_a])
-        if value_1.isnumeric():
-            result = 6 - int(value_1)
-        super().print_output_message(f"result: {result}")
+        super().trace("Calculator_Recode_2: 7 - value + 1")
+        if super().is_tracing:
+            super().trace("8 - %s", super().key_a)
+        value_1 = super().typed_values(row_response).numeric_string_value(self._rule.key_a)
+        if value_1 is not None:
+            result = 6 - value_1
+        if super().is_tracing:
+            super().trace("result: %s", result)
         return PostCalculationInstruction.MOVE_TO_NEXT_VAR__VALUE_RESOLVED, result
 
 
@@ -624,12 +886,14 @@ class Calculator_Recode_3(Calculator):
         super().__init__(row_variable_lookup)
 
     def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        super().print_output_message("Calculator_Recode: 5 - value + 1")
-        super().print_output_message(f"6 - {super().key_a}")
-        value_1 = str(row_response["values"][super().key_a])
-        if value_1.isnumeric():
-            result = 6 - int(value_1)
-        super().print_output_message(f"result: {result}")
+        super().trace("Calculator_Recode: 5 - value + 1")
+        if super().is_tracing:
+            super().trace("6 - %s", super().key_a)
+        value_1 = super().typed_values(row_response).numeric_string_value(self._rule.key_a)
+        if value_1 is not None:
+            result = 6 - value_1
+        if super().is_tracing:
+            super().trace("result: %s", result)
         return PostCalculationInstruction.MOVE_TO_NEXT_VAR__VALUE_RESOLVED, result
 
 
@@ -638,13 +902,16 @@ class Calculator_Subtraction(Calculator):
         super().__init__(row_variable_lookup)
 
     def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        super().print_output_message(f"Calculator_Subtraction: subtract value contained in field {super().key_b} from value contained in field {super().key_a}")
+        if super().is_tracing:
+            super().trace("Calculator_Subtraction: subtract value contained in field %s from value contained in field %s", super().key_b, super().key_a)
 
-        value_1 = float(row_response["values"][super().key_a])
-        value_2 = float(row_response["values"][super().key_b])
+        values = super().typed_values(row_response)
+        value_1 = values.float_value(self._rule.key_a)
+        value_2 = values.float_value(self._rule.key_b)
 
         result = value_1 - value_2
-        super().print_output_message(f"result: {result}")
+        if super().is_tracing:
+            super().trace("result: %s", result)
         return PostCalculationInstruction.MOVE_TO_NEXT_VAR__VALUE_RESOLVED, result
 
 
@@ -653,203 +920,69 @@ class Calculator_Sum(Calculator):
         super().__init__(row_variable_lookup)
 
     def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        super().print_output_message("Calculator_Sum: add values in comma-separated list coming from survey_id_a")
-        super().print_output_message(f"Values come from these fields: {super().key_a}")
-        list_of_keys_to_use_for_sum = list(set(super().key_a.split(",")))
-
+        super().trace("Calculator_Sum: add values in comma-separated list coming from survey_id_a")
+        if super().is_tracing:
+            super().trace("Values come from these fields: %s", super().key_a)
+        values = super().typed_values(row_response)
         values_to_add = []
-        for x in list_of_keys_to_use_for_sum:
-            if super().check_key(row_response["values"], x):
-                for s in super().convert_str_to_list(row_response["values"][x]):
-                    values_to_add.append(float(s))
-        super().print_output_message(f"values_to_add: {values_to_add}")
+        for x in self._rule.unique_keys_a:
+            if super().check_key(values, x):
+                values_to_add.extend(values.list_of_floats_value(x))
+        if super().is_tracing:
+            super().trace("values_to_add: %s", values_to_add)
         result = ""
         if len(values_to_add) > 0:
             result = sum(values_to_add)
-        super().print_output_message(f"result: {result}")
+        if super().is_tracing:
+            super().trace("result: %s", result)
         return PostCalculationInstruction.MOVE_TO_NEXT_VAR__VALUE_RESOLVED, result
 
 
-class Calculator__MultiConditionalAnd_Equal4(Calculator):
-    def __init__(self, row_variable_lookup: tuple):
-        super().__init__(row_variable_lookup)
-
-    def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response_1 = float(row_response["values"][super().key_a])
-        value_to_compare_with_1 = float(super().value_a)
-        actual_value_in_the_response_2 = float(row_response["values"][super().key_b])
-        value_to_compare_with_2 = float(super().value_b)
-        actual_value_in_the_response_3 = float(row_response["values"][super().key_c])
-        value_to_compare_with_3 = float(super().value_c)
-        actual_value_in_the_response_4 = float(row_response["values"][super().key_d])
-        value_to_compare_with_4 = float(super().value_d)
-        super().print_output_message(
-            f"Calculator__MultiConditionalAnd_Equal4; key_to_find_1: {super().key_a}, key_to_find_2: {super().key_b}, key_to_find_3: {super().key_c}, key_to_find_4: {super().key_d}; "
-            f"formula: if actual_value_in_the_response1 == value_to_compare_with_1 "
-            f" and actual_value_in_the_response2 == value_to_compare_with_2 "
-            f" and actual_value_in_the_response3 == value_to_compare_with_3 "
-            f" and actual_value_in_the_response4 == value_to_compare_with_4 "
-            f"then new_var_value else else_value; "
-            f"if {actual_value_in_the_response_1} == {value_to_compare_with_1} "
-            f"and {actual_value_in_the_response_2} == {value_to_compare_with_2} "
-            f"and {actual_value_in_the_response_3} == {value_to_compare_with_3} "
-            f"and {actual_value_in_the_response_4} == {value_to_compare_with_4} "
-            f"then {super().new_var_value} else {super().else_value}")
-        if actual_value_in_the_response_1 == value_to_compare_with_1 \
-                and actual_value_in_the_response_2 == value_to_compare_with_2 \
-                and actual_value_in_the_response_3 == value_to_compare_with_3 \
-                and actual_value_in_the_response_4 == value_to_compare_with_4:
-            return super().handle_new_var_value()
-        else:
-            return super().handle_else_value()
-
-
-class Calculator__MultiConditionalAnd_IsIn_Equal_Equal(Calculator):
-    def __init__(self, row_variable_lookup: tuple):
-        super().__init__(row_variable_lookup)
-
-    def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response_1 = float(row_response["values"][super().key_a])
-        value_to_compare_with_1 = str(super().value_a)
-        list_to_use_for_comparison = value_to_compare_with_1.split(",")
-
-        actual_value_in_the_response_2 = float(row_response["values"][super().key_b])
-        value_to_compare_with_2 = float(super().value_b)
-
-        actual_value_in_the_response_3 = float(row_response["values"][super().key_c])
-        value_to_compare_with_3 = float(super().value_c)
-        super().print_output_message(
-            f"Calculator__MultiConditionalAnd_IsIn_Equal_Equal; key_to_find_1: {super().key_a}, key_to_find_2: {super().key_b}, key_to_find_3: {super().key_c}; "
-            f"formula: if actual_value_in_the_response1 in list_to_use_for_comparison "
-            f" and actual_value_in_the_response2 == value_to_compare_with_2 "
-            f" and actual_value_in_the_response3 == value_to_compare_with_3 "
-            f"then new_var_value else else_value; "
-            f"if {actual_value_in_the_response_1} in {list_to_use_for_comparison} "
-            f"and {actual_value_in_the_response_2} == {value_to_compare_with_2} "
-            f"and {actual_value_in_the_response_3} == {value_to_compare_with_3} "
-            f"then {super().new_var_value} else {super().else_value}")
-        if actual_value_in_the_response_1 in list_to_use_for_comparison \
-                and actual_value_in_the_response_2 == value_to_compare_with_2 \
-                and actual_value_in_the_response_3 == value_to_compare_with_3:
-            return super().handle_new_var_value()
-        else:
-            return super().handle_else_value()
-
-
 class Calculator__Conditional_Between_Including(Calculator):
     def __init__(self, row_variable_lookup: tuple):
         super().__init__(row_variable_lookup)
 
     def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response = str(super().actual_value_in_response_a(row_response))
-        value_to_compare_with_1 = str(super().value_a)
-        value_to_compare_with_2 = str(super().value_a2)
-        super().print_output_message(
-            f"Calculator__Conditional_Between_Including; key_to_find: {super().key_a}; "
-            f"formula: if actual_value_in_the_response >= value_to_compare_with_1 "
-            f"and actual_value_in_the_response <= value_to_compare_with_2"
-            f"then new_var_value else else_value; "
-            f"if {actual_value_in_the_response} >= {value_to_compare_with_1} and "
-            f"{actual_value_in_the_response} <= {value_to_compare_with_2}"
-            f" then {super().new_var_value} else {super().else_value}")
+        actual_value_in_the_response = super().typed_values(row_response).string_value(self._rule.key_a)
+        value_to_compare_with_1 = self._rule.str_value_a
+        value_to_compare_with_2 = self._rule.str_value_a2
+        if super().is_tracing:
+            super().trace(
+                "Calculator__Conditional_Between_Including; key_to_find: %s; "
+                "formula: if actual_value_in_the_response >= value_to_compare_with_1 "
+                "and actual_value_in_the_response <= value_to_compare_with_2"
+                "then new_var_value else else_value; "
+                "if %s >= %s and "
+                "%s <= %s"
+                " then %s else %s",
+                super().key_a, actual_value_in_the_response, value_to_compare_with_1, actual_value_in_the_response, value_to_compare_with_2, super().new_var_value, super().else_value)
         if value_to_compare_with_1 <= actual_value_in_the_response <= value_to_compare_with_2:
             return super().handle_new_var_value()
         else:
             return super().handle_else_value()
 
 
-class Calculator__MultiConditionalAnd_Equal_GreaterThan(Calculator):
-    def __init__(self, row_variable_lookup: tuple):
-        super().__init__(row_variable_lookup)
-
-    def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response_1 = row_response["values"][super().key_a]
-        value_to_compare_with_1 = super().value_a
-        actual_value_in_the_response_2 = row_response["values"][super().key_b]
-        value_to_compare_with_2 = super().value_b
-
-        super().print_output_message(
-            f"Calculator__MultiConditionalAnd_Equal_GreaterThan; key_to_find_1: {super().key_a}, key_to_find_2: {super().key_b}; "
-            f"formula: if actual_value_in_the_response1 == value_to_compare_with_1 and actual_value_in_the_response2 > value_to_compare_with_2 then new_var_value else else_value; "
-            f"if {actual_value_in_the_response_1} == {value_to_compare_with_1} and {actual_value_in_the_response_2} > {value_to_compare_with_2} then {super().new_var_value} else {super().else_value}")
-
-        if super().isfloat(actual_value_in_the_response_1) and super().isfloat(value_to_compare_with_1) and super().isfloat(actual_value_in_the_response_2) and super(value_to_compare_with_2).isfloat():
-            if float(actual_value_in_the_response_1) == float(value_to_compare_with_1) and float(actual_value_in_the_response_2) > float(value_to_compare_with_2):
-                return super().handle_new_var_value()
-            else:
-                return super().handle_else_value()
-        else:
-            return PostCalculationInstruction.MOVE_TO_NEXT_VAR__UNDERLYING_DATA_NOT_FOUND, ""
-
-
-class Calculator__MultiConditionalAnd_IsIn_IsIn(Calculator):
-    def __init__(self, row_variable_lookup: tuple):
-        super().__init__(row_variable_lookup)
-
-    def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response_1 = float(row_response["values"][super().key_a])
-        value_to_compare_with_1 = str(super().value_a)
-        list_to_use_for_comparison_1 = value_to_compare_with_1.split(",")
-
-        actual_value_in_the_response_2 = float(row_response["values"][super().key_b])
-        value_to_compare_with_2 = str(super().value_b)
-        list_to_use_for_comparison_2 = value_to_compare_with_2.split(",")
-
-        super().print_output_message(
-            f"Calculator__MultiConditionalAnd_IsIn_IsIn; key_to_find_1: {super().key_a}, key_to_find_2: {super().key_b};"
-            f"formula: if actual_value_in_the_response1 in list_to_use_for_comparison_1 "
-            f" and actual_value_in_the_response2 in list_to_use_for_comparison_2 "
-            f"then new_var_value else else_value; "
-            f"if {actual_value_in_the_response_1} in {list_to_use_for_comparison_1} "
-            f"and {actual_value_in_the_response_2} in {list_to_use_for_comparison_2} "
-            f"then {super().new_var_value} else {super().else_value}")
-        if actual_value_in_the_response_1 in list_to_use_for_comparison_1 \
-                and actual_value_in_the_response_2 in list_to_use_for_comparison_2:
-            return super().handle_new_var_value()
-        else:
-            return super().handle_else_value()
-
-
-class Calculator__MultiConditionalAnd_GreaterThanEqual_GreaterThan(Calculator):
-    def __init__(self, row_variable_lookup: tuple):
-        super().__init__(row_variable_lookup)
-
-    def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response_1 = row_response["values"][super().key_a]
-        value_to_compare_with_1 = super().value_a
-        actual_value_in_the_response_2 = row_response["values"][super().key_b]
-        value_to_compare_with_2 = super().value_b
-        super().print_output_message(
-            f"Calculator__MultiConditionalAnd_Equal_GreaterThan; key_to_find_1: {super().key_a}, key_to_find_2: {super().key_b}; "
-            f"formula: if actual_value_in_the_response1 == value_to_compare_with_1 and actual_value_in_the_response2 > value_to_compare_with_2 then new_var_value else else_value; "
-            f"if {actual_value_in_the_response_1} == {value_to_compare_with_1} and {actual_value_in_the_response_2} > {value_to_compare_with_2} then {super().new_var_value} else {super().else_value}")
-
-        if super().isfloat(actual_value_in_the_response_1) and super().isfloat(value_to_compare_with_1) and super().isfloat(actual_value_in_the_response_2) and super().isfloat(value_to_compare_with_2):
-            if float(actual_value_in_the_response_1) == float(value_to_compare_with_1) and float(actual_value_in_the_response_2) > float(value_to_compare_with_2):
-                return super().handle_new_var_value()
-            else:
-                return super().handle_else_value()
-        else:
-            return PostCalculationInstruction.MOVE_TO_NEXT_VAR__UNDERLYING_DATA_NOT_FOUND, ""
-
-
 class Calculator__Product(Calculator):
     def __init__(self, row_variable_lookup: tuple):
         super().__init__(row_variable_lookup)
 
     def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response = str(super().actual_value_in_response_a(row_response))
-        value_to_multiply_by = str(super().value_a)
-        super().print_output_message(
-            f"Calculator__Product; key_to_find: {super().key_a}; "
-            f"formula: returns actual_value_in_the_response * value_to_multiply_by"
-            f"{actual_value_in_the_response} * {value_to_multiply_by}")
-
-        if super().isfloat(actual_value_in_the_response) and super().isfloat(value_to_multiply_by):
-            result = float(actual_value_in_the_response) * float(value_to_multiply_by)
+        values = super().typed_values(row_response)
+        actual_value_in_the_response = values.float_of_string_value(self._rule.key_a)
+        value_to_multiply_by = self._rule.float_value_a
+        if super().is_tracing:
+            super().trace(
+                "Calculator__Product; key_to_find: %s; "
+                "formula: returns actual_value_in_the_response * value_to_multiply_by"
+                "%s * %s",
+                super().key_a, values.string_value(self._rule.key_a), self._rule.str_value_a)
+
+        if actual_value_in_the_response is not None and value_to_multiply_by is not None:
+            result = actual_value_in_the_response * value_to_multiply_by
         else:
             result = ""
-        super().print_output_message(f"result: {result}")
+        if super().is_tracing:
+            super().trace("result: %s", result)
         return PostCalculationInstruction.MOVE_TO_NEXT_VAR__VALUE_RESOLVED, result
 
 
@@ -858,11 +991,13 @@ class Calculator__Conditional_IsNull(Calculator):
         super().__init__(row_variable_lookup)
 
     def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response_1 = str(row_response["values"][super().key_a])
-        super().print_output_message(
-            f"Calculator__Conditional_IsNull; key_to_find_1: {super().key_a}; "
-            f"formula: if actual_value_in_the_response1 is null then new_var_value else else_value; "
-            f"if {actual_value_in_the_response_1} is None then {super().new_var_value} else {super().else_value}")        
+        actual_value_in_the_response_1 = super().typed_values(row_response).string_value(self._rule.key_a)
+        if super().is_tracing:
+            super().trace(
+                "Calculator__Conditional_IsNull; key_to_find_1: %s; "
+                "formula: if actual_value_in_the_response1 is null then new_var_value else else_value; "
+                "if %s is None then %s else %s",
+                super().key_a, actual_value_in_the_response_1, super().new_var_value, super().else_value)        
         if actual_value_in_the_response_1 is None:
             return super().handle_new_var_value()
         else:
@@ -870,322 +1005,564 @@ class Calculator__Conditional_IsNull(Calculator):
         return PostCalculationInstruction.MOVE_TO_NEXT_VAR__UNDERLYING_DATA_NOT_FOUND, ""
       
       
-class Calculator__MultiConditionalAnd_IsIn_Equal(Calculator):
+class Calculator__Count(Calculator):
     def __init__(self, row_variable_lookup: tuple):
         super().__init__(row_variable_lookup)
 
     def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response_1 = float(row_response["values"][super().key_a])
-        value_to_compare_with_1 = str(super().value_a)
-        list_to_use_for_comparison = value_to_compare_with_1.split(",")
-
-        actual_value_in_the_response_2 = float(row_response["values"][super().key_b])
-        value_to_compare_with_2 = float(super().value_b)
-        
-        super().print_output_message(
-            f"Calculator__MultiConditionalAnd_IsIn_Equal; key_to_find_1: {super().key_a}, key_to_find_2: {super().key_b};"
-            f"formula: if actual_value_in_the_response1 in list_to_use_for_comparison "
-            f" and actual_value_in_the_response2 == value_to_compare_with_2 "
-            f"then new_var_value else else_value; "
-            f"if {actual_value_in_the_response_1} in {list_to_use_for_comparison} "
-            f"and {actual_value_in_the_response_2} == {value_to_compare_with_2} "
-            f"then {super().new_var_value} else {super().else_value}")
-        if actual_value_in_the_response_1 in list_to_use_for_comparison \
-                and actual_value_in_the_response_2 == value_to_compare_with_2:
-            return super().handle_new_var_value()
-        else:
-            return super().handle_else_value()
-      
+        actual_value_in_the_response = super().typed_values(row_response).string_value(self._rule.key_a).split(",")
+        if super().is_tracing:
+            super().trace(
+                "Calculator__Count; key_to_find: %s; "
+                "formula: returns count of items in the list",
+                super().key_a)
 
-class Calculator__MultiConditionalAnd_Equal_LessThan_LessThen(Calculator):
-    def __init__(self, row_variable_lookup: tuple):
-        super().__init__(row_variable_lookup)
-
-    def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response_1 = row_response["values"][super().key_a]
-        value_to_compare_with_1 = super().value_a
-        actual_value_in_the_response_2 = row_response["values"][super().key_b]
-        value_to_compare_with_2 = super().value_b
-        actual_value_in_the_response_3 = row_response["values"][super().key_c]
-        value_to_compare_with_3 = super().value_c
-        super().print_output_message(
-            f"Calculator__MultiConditionalAnd_Equal_LessThan_LessThen; key_to_find_1: {super().key_a}, key_to_find_2: {super().key_b}, key_to_find_3: {super().key_c}; "
-            f"formula: if actual_value_in_the_response1 == value_to_compare_with_1 and actual_value_in_the_response2 < value_to_compare_with_2 and actual_value_in_the_response3 < value_to_compare_with_3 then new_var_value else else_value; "
-            f"if {actual_value_in_the_response_1} == {value_to_compare_with_1} and {actual_value_in_the_response_2} < {value_to_compare_with_2} and {actual_value_in_the_response_3} < {value_to_compare_with_3} then {super().new_var_value} else {super().else_value}")
-
-        if super().isfloat(actual_value_in_the_response_1) and super().isfloat(value_to_compare_with_1) and super().isfloat(actual_value_in_the_response_2) and super().isfloat(value_to_compare_with_2) and super().isfloat(actual_value_in_the_response_3) and super().isfloat(value_to_compare_with_3):
-            if float(actual_value_in_the_response_1) == float(value_to_compare_with_1) and float(actual_value_in_the_response_2) < float(value_to_compare_with_2) and float(actual_value_in_the_response_3) < float(value_to_compare_with_3):
-                return super().handle_new_var_value()
-            else:
-                return super().handle_else_value()
+        if not type(actual_value_in_the_response) == list:
+            result = 0
         else:
-            return PostCalculationInstruction.MOVE_TO_NEXT_VAR__UNDERLYING_DATA_NOT_FOUND, "" 
+            result = len(actual_value_in_the_response)
 
+        if super().is_tracing:
+            super().trace("result: %s", result)
+        return PostCalculationInstruction.MOVE_TO_NEXT_VAR__VALUE_RESOLVED, result     
+  
 
-class Calculator__MultiConditionalAnd_Equal_GreaterThanEqual(Calculator):
-    def __init__(self, row_variable_lookup: tuple):
-        super().__init__(row_variable_lookup)
+# COMMAND ----------
 
-    def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response_1 = row_response["values"][super().key_a]
-        value_to_compare_with_1 = super().value_a
-        actual_value_in_the_response_2 = row_response["values"][super().key_b]
-        value_to_compare_with_2 = super().value_b
-
-        super().print_output_message(
-            f"Calculator__MultiConditionalAnd_Equal_GreaterThanEqual; key_to_find_1: {super().key_a}, key_to_find_2: {super().key_b}; "
-            f"formula: if actual_value_in_the_response1 == value_to_compare_with_1 and actual_value_in_the_response2 >= value_to_compare_with_2 then new_var_value else else_value; "
-            f"if {actual_value_in_the_response_1} == {value_to_compare_with_1} and {actual_value_in_the_response_2} >= {value_to_compare_with_2} then {super().new_var_value} else {super().else_value}")
-
-        if super().isfloat(actual_value_in_the_response_1) and super().isfloat(value_to_compare_with_1) and super().isfloat(actual_value_in_the_response_2) and super(value_to_compare_with_2).isfloat():
-            if float(actual_value_in_the_response_1) == float(value_to_compare_with_1) and float(actual_value_in_the_response_2) >= float(value_to_compare_with_2):
-                return super().handle_new_var_value()
-            else:
-                return super().handle_else_value()
+# DBTITLE 1,Multi Conditional Calculator
+import operator
+
+
+class ConditionOperator(Enum):
+    EQUAL = "equal"
+    GREATER_THAN = "greater_than"
+    GREATER_THAN_EQUAL = "greater_than_equal"
+    LESS_THAN = "less_than"
+    LESS_THAN_EQUAL = "less_than_equal"
+    IS_IN = "is_in"
+    IS_NULL = "is_null"
+
+
+class ConditionPredicate:
+    """
+    Leaf of a predicate tree: one condition on the value of one key of the response.
+    The value to compare with is converted when the rule is compiled: a float, or a frozenset of floats for is_in.
+    Numeric conditions can only be evaluated on values where float(str(value)) succeeds; is_null is met by None and "".
+    """
+    _comparisons = {
+        ConditionOperator.EQUAL: (operator.eq, np.equal, "=="),
+        ConditionOperator.GREATER_THAN: (operator.gt, np.greater, ">"),
+        ConditionOperator.GREATER_THAN_EQUAL: (operator.ge, np.greater_equal, ">="),
+        ConditionOperator.LESS_THAN: (operator.lt, np.less, "<"),
+        ConditionOperator.LESS_THAN_EQUAL: (operator.le, np.less_equal, "<="),
+    }
+
+    def __init__(self, key: str, condition_operator: ConditionOperator, value_to_compare_with=None):
+        self.key = key
+        self.condition_operator = condition_operator
+        if condition_operator == ConditionOperator.IS_NULL:
+            self.value_to_compare_with = None
+        elif condition_operator == ConditionOperator.IS_IN:
+            self.value_to_compare_with = frozenset(float(x) for x in str(value_to_compare_with).split(","))
         else:
-            return PostCalculationInstruction.MOVE_TO_NEXT_VAR__UNDERLYING_DATA_NOT_FOUND, ""
+            self.value_to_compare_with = float(str(value_to_compare_with))
 
+    @property
+    def keys(self) -> list:
+        return [self.key]
 
-class Calculator__MultiConditionalAnd_Equal_LessThan(Calculator):
-    def __init__(self, row_variable_lookup: tuple):
-        super().__init__(row_variable_lookup)
-
-    def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response_1 = row_response["values"][super().key_a]
-        value_to_compare_with_1 = super().value_a
-        actual_value_in_the_response_2 = row_response["values"][super().key_b]
-        value_to_compare_with_2 = super().value_b
-
-        super().print_output_message(
-            f"Calculator__MultiConditionalAnd_Equal_LessThan; key_to_find_1: {super().key_a}, key_to_find_2: {super().key_b}; "
-            f"formula: if actual_value_in_the_response1 == value_to_compare_with_1 and actual_value_in_the_response2 < value_to_compare_with_2 then new_var_value else else_value; "
-            f"if {actual_value_in_the_response_1} == {value_to_compare_with_1} and {actual_value_in_the_response_2} < {value_to_compare_with_2} then {super().new_var_value} else {super().else_value}")
-
-        if super().isfloat(actual_value_in_the_response_1) and super().isfloat(value_to_compare_with_1) and super().isfloat(actual_value_in_the_response_2) and super(value_to_compare_with_2).isfloat():
-            if float(actual_value_in_the_response_1) == float(value_to_compare_with_1) and float(actual_value_in_the_response_2) < float(value_to_compare_with_2):
-                return super().handle_new_var_value()
-            else:
-                return super().handle_else_value()
+    def evaluate(self, values) -> (bool, bool):
+        """
+        Returns (is_evaluable, is_met) for the values of one response; raises KeyError when the key is not in the response.
+        """
+        values = Calculator.as_typed_values(values)
+        if self.condition_operator == ConditionOperator.IS_NULL:
+            actual_value = values[self.key]
+            return True, actual_value is None or actual_value == ""
+        actual_value = values.float_of_string_value(self.key)
+        if actual_value is None:
+            return False, False
+        if self.condition_operator == ConditionOperator.IS_IN:
+            return True, actual_value in self.value_to_compare_with
+        return True, self._comparisons[self.condition_operator][0](actual_value, self.value_to_compare_with)
+
+    def evaluate_columns(self, response_columns, rows: np.ndarray) -> (np.ndarray, np.ndarray):
+        """
+        Vectorized evaluate for the given rows of ResponseColumns; rows where the key is not present are not evaluable.
+        """
+        is_present = response_columns.present(self.key)[rows]
+        if self.condition_operator == ConditionOperator.IS_NULL:
+            actual_values = response_columns.values(self.key)[rows]
+            is_null = np.fromiter((x is None or (isinstance(x, str) and x == "") for x in actual_values), dtype=bool, count=len(rows))
+            return is_present, is_null
+        actual_values, is_float = response_columns.floats_of_strings(self.key)
+        actual_values = actual_values[rows]
+        if self.condition_operator == ConditionOperator.IS_IN:
+            is_met = np.isin(actual_values, np.fromiter(self.value_to_compare_with, dtype=np.float64))
         else:
-            return PostCalculationInstruction.MOVE_TO_NEXT_VAR__UNDERLYING_DATA_NOT_FOUND, ""
+            is_met = self._comparisons[self.condition_operator][1](actual_values, self.value_to_compare_with)
+        return is_present & is_float[rows], is_met
 
+    def __str__(self):
+        if self.condition_operator == ConditionOperator.IS_NULL:
+            return f"{self.key} is null"
+        if self.condition_operator == ConditionOperator.IS_IN:
+            return f"{self.key} in {sorted(self.value_to_compare_with)}"
+        return f"{self.key} {self._comparisons[self.condition_operator][2]} {self.value_to_compare_with}"
 
-class Calculator__MultiConditionalAnd_LessThan_GreaterThanEqual(Calculator):
-    def __init__(self, row_variable_lookup: tuple):
-        super().__init__(row_variable_lookup)
 
-    def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response_1 = row_response["values"][super().key_a]
-        value_to_compare_with_1 = super().value_a
-        actual_value_in_the_response_2 = row_response["values"][super().key_b]
-        value_to_compare_with_2 = super().value_b
-
-        super().print_output_message(
-            f"Calculator__MultiConditionalAnd_LessThan_GreaterThanEqual; key_to_find_1: {super().key_a}, key_to_find_2: {super().key_b}; "
-            f"formula: if actual_value_in_the_response1 < value_to_compare_with_1 and actual_value_in_the_response2 >= value_to_compare_with_2 then new_var_value else else_value; "
-            f"if {actual_value_in_the_response_1} < {value_to_compare_with_1} and {actual_value_in_the_response_2} >= {value_to_compare_with_2} then {super().new_var_value} else {super().else_value}")
-
-        if super().isfloat(actual_value_in_the_response_1) and super().isfloat(value_to_compare_with_1) and super().isfloat(actual_value_in_the_response_2) and super(value_to_compare_with_2).isfloat():
-            if float(actual_value_in_the_response_1) < float(value_to_compare_with_1) and float(actual_value_in_the_response_2) >= float(value_to_compare_with_2):
-                return super().handle_new_var_value()
-            else:
-                return super().handle_else_value()
-        else:
-            return PostCalculationInstruction.MOVE_TO_NEXT_VAR__UNDERLYING_DATA_NOT_FOUND, ""
+class AllConditionsPredicate:
+    """
+    Node of a predicate tree, met when all its child predicates are met.
+    All children are evaluated, so a key missing from the response is reported whatever the other conditions are.
+    """
+    def __init__(self, predicates: list):
+        self.predicates = predicates
 
+    @property
+    def keys(self) -> list:
+        return [key for predicate in self.predicates for key in predicate.keys]
+
+    def evaluate(self, values) -> (bool, bool):
+        is_evaluable, is_met = True, True
+        for predicate in self.predicates:
+            is_predicate_evaluable, is_predicate_met = predicate.evaluate(values)
+            is_evaluable = is_evaluable and is_predicate_evaluable
+            is_met = is_met and is_predicate_met
+        return is_evaluable, is_evaluable and is_met
+
+    def evaluate_columns(self, response_columns, rows: np.ndarray) -> (np.ndarray, np.ndarray):
+        is_evaluable = np.ones(len(rows), dtype=bool)
+        is_met = np.ones(len(rows), dtype=bool)
+        for predicate in self.predicates:
+            is_predicate_evaluable, is_predicate_met = predicate.evaluate_columns(response_columns, rows)
+            is_evaluable &= is_predicate_evaluable
+            is_met &= is_predicate_met
+        return is_evaluable, is_evaluable & is_met
+
+    def __str__(self):
+        return " and ".join(str(predicate) for predicate in self.predicates)
 
-class Calculator__MultiConditionalAnd_LessThan_LessThan(Calculator):
+    @staticmethod
+    def parse(detail: str, keys: list, values_to_compare_with: list):
+        """
+        Parses a comma separated detail such as "equal,less_than,less_than": the n-th condition applies to the n-th key (key_a, key_b, ...)
+        and its value (value_a, value_b, ...).
+        """
+        condition_operators = [x.strip() for x in str(detail).split(",")]
+        if len(condition_operators) > len(keys):
+            raise ValueError(f"Detail {detail} has more conditions than the {len(keys)} supported keys")
+        predicates = []
+        for condition_operator, key, value_to_compare_with in zip(condition_operators, keys, values_to_compare_with):
+            try:
+                condition_operator = ConditionOperator(condition_operator)
+            except ValueError:
+                raise ValueError(f"Unsupported condition {condition_operator} in detail {detail}")
+            if not isinstance(key, str):
+                raise ValueError(f"Missing key for condition {condition_operator.value} in detail {detail}")
+            try:
+                predicates.append(ConditionPredicate(key, condition_operator, value_to_compare_with))
+            except ValueError:
+                raise ValueError(f"Value {value_to_compare_with} of key {key} is not numeric, as required by condition {condition_operator.value} in detail {detail}")
+        return AllConditionsPredicate(predicates)
+
+
+class Calculator__MultiConditional(Calculator):
+    """
+    Calculator of every multi conditional action: the detail is compiled into a predicate tree once, when the calculator is created.
+    Resolves to new_var_value when all the conditions are met, to the else value otherwise, and reports the underlying data as not found
+    when a key is missing or a value cannot be compared as a number.
+    """
     def __init__(self, row_variable_lookup: tuple):
         super().__init__(row_variable_lookup)
+        try:
+            self.predicate = AllConditionsPredicate.parse(self.detail, [self.key_a, self.key_b, self.key_c, self.key_d],
+                                                          [self.value_a, self.value_b, self.value_c, self.value_d])
+        except ValueError as e:
+            raise ValueError(f"Derived variable {self.new_var_name}, action {self.action}: {e}")
 
     def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response_1 = row_response["values"][super().key_a]
-        value_to_compare_with_1 = super().value_a
-        actual_value_in_the_response_2 = row_response["values"][super().key_b]
-        value_to_compare_with_2 = super().value_b
-
-        super().print_output_message(
-            f"Calculator__MultiConditionalAnd_LessThan_LessThan; key_to_find_1: {super().key_a}, key_to_find_2: {super().key_b}; "
-            f"formula: if actual_value_in_the_response1 < value_to_compare_with_1 and actual_value_in_the_response2 < value_to_compare_with_2 then new_var_value else else_value; "
-            f"if {actual_value_in_the_response_1} < {value_to_compare_with_1} and {actual_value_in_the_response_2} < {value_to_compare_with_2} then {super().new_var_value} else {super().else_value}")
-
-        if super().isfloat(actual_value_in_the_response_1) and super().isfloat(value_to_compare_with_1) and super().isfloat(actual_value_in_the_response_2) and super(value_to_compare_with_2).isfloat():
-            if float(actual_value_in_the_response_1) < float(value_to_compare_with_1) and float(actual_value_in_the_response_2) < float(value_to_compare_with_2):
-                return super().handle_new_var_value()
-            else:
-                return super().handle_else_value()
-        else:
+        is_evaluable, is_met = self.predicate.evaluate(super().typed_values(row_response))
+        if super().is_tracing:
+            super().trace(
+                "Calculator__MultiConditional; keys to find: %s; "
+                "formula: if %s then new_var_value else else_value; "
+                "values: %s; then %s else %s",
+                self.predicate.keys, self.predicate, [row_response["values"][key] for key in self.predicate.keys], super().new_var_value, super().else_value)
+        if not is_evaluable:
             return PostCalculationInstruction.MOVE_TO_NEXT_VAR__UNDERLYING_DATA_NOT_FOUND, ""
+        if is_met:
+            return super().handle_new_var_value()
+        return super().handle_else_value()
 
 
-class Calculator__MultiConditionalAnd_Equal_Equal_Equal(Calculator):
-    def __init__(self, row_variable_lookup: tuple):
-        super().__init__(row_variable_lookup)
+# COMMAND ----------
 
-    def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response_1 = row_response["values"][super().key_a]
-        value_to_compare_with_1 = super().value_a
-        actual_value_in_the_response_2 = row_response["values"][super().key_b]
-        value_to_compare_with_2 = super().value_b
-        actual_value_in_the_response_3 = row_response["values"][super().key_c]
-        value_to_compare_with_3 = super().value_c
-        super().print_output_message(
-            f"Calculator__MultiConditionalAnd_Equal_Equal_Equal; key_to_find_1: {super().key_a}, key_to_find_2: {super().key_b}, key_to_find_3: {super().key_c}; "
-            f"formula: if actual_value_in_the_response1 == value_to_compare_with_1 and actual_value_in_the_response2 == value_to_compare_with_2 and actual_value_in_the_response3 == value_to_compare_with_3 then new_var_value else else_value; "
-            f"if {actual_value_in_the_response_1} == {value_to_compare_with_1} and {actual_value_in_the_response_2} == {value_to_compare_with_2} and {actual_value_in_the_response_3} == {value_to_compare_with_3} then {super().new_var_value} else {super().else_value}")
-
-        if super().isfloat(actual_value_in_the_response_1) and super().isfloat(value_to_compare_with_1) and super().isfloat(actual_value_in_the_response_2) and super().isfloat(value_to_compare_with_2) and super().isfloat(actual_value_in_the_response_3) and super().isfloat(value_to_compare_with_3):
-            if float(actual_value_in_the_response_1) == float(value_to_compare_with_1) and float(actual_value_in_the_response_2) == float(value_to_compare_with_2) and float(actual_value_in_the_response_3) == float(value_to_compare_with_3):
-                return super().handle_new_var_value()
-            else:
-                return super().handle_else_value()
-        else:
-            return PostCalculationInstruction.MOVE_TO_NEXT_VAR__UNDERLYING_DATA_NOT_FOUND, ""
+# DBTITLE 1,Calculator Registry
+ANY_DETAIL = "*"
 
 
-class Calculator__Count(Calculator):
-    def __init__(self, row_variable_lookup: tuple):
-        super().__init__(row_variable_lookup)
+class CalculatorRegistry:
+    """
+    Maps (action, detail) of a lookup row to the function creating its Calculator, so that finding the calculator for a rule is a dictionary lookup.
+    Actions whose calculator does not depend on the detail are registered with ANY_DETAIL.
+    New calculator types are added with register, either directly or as a class decorator:
 
-    def evaluate(self, row_response: tuple) -> (PostCalculationInstruction, str):
-        actual_value_in_the_response = (str(super().actual_value_in_response_a(row_response))).split(",")
-        super().print_output_message(
-            f"Calculator__Count; key_to_find: {super().key_a}; "
-            f"formula: returns count of items in the list")
+        @calculator_registry.register("my_action", "my_detail")
+        class Calculator_MyCalculator(Calculator):
+            ...
+    """
+    def __init__(self):
+        self._create_calculator_by_action_and_detail = {}
 
-        if not type(actual_value_in_the_response) == list:
-            result = 0
-        else:
-            result = len(actual_value_in_the_response)
+    def register(self, action, detail=ANY_DETAIL, create_calculator=None):
+        """
+        create_calculator is called with the lookup row and returns a Calculator; a Calculator class can be passed as is.
+        """
+        if create_calculator is None:
+            def decorator(calculator_class):
+                self.register(action, detail, calculator_class)
+                return calculator_class
+            return decorator
+        self._create_calculator_by_action_and_detail[(action, detail)] = create_calculator
+        return create_calculator
+
+    def registered(self) -> list:
+        """
+        (action, detail) of every registered calculator, in registration order; detail is ANY_DETAIL where the calculator ignores it.
+        """
+        return list(self._create_calculator_by_action_and_detail.keys())
+
+    def find(self, action, detail):
+        create_calculator = self._create_calculator_by_action_and_detail.get((action, detail))
+        if create_calculator is None:
+            create_calculator = self._create_calculator_by_action_and_detail.get((action, ANY_DETAIL))
+        return create_calculator
+
+    def create_calculator(self, variable_lookup_row: Series) -> Calculator:
+        derived_variables_logger.debug("Creating calculator for lookup row:\n%s", variable_lookup_row)
+        create_calculator = self.find(variable_lookup_row["action"], variable_lookup_row["detail"])
+        if create_calculator is None:
+            return CalculatorNull(variable_lookup_row)
+        return create_calculator(variable_lookup_row)
 
-        super().print_output_message(f"result: {result}")
-        return PostCalculationInstruction.MOVE_TO_NEXT_VAR__VALUE_RESOLVED, result     
-  
+    def validate(self, df_derived_variables_lookup: DataFrame):
+        """
+        Rejects a lookup with rules whose (action, detail) has no registered calculator, listing all of them,
+        instead of failing with CalculatorNull when such a rule is first evaluated.
+        """
+        unsupported = []
+        for i in df_derived_variables_lookup.index:
+            variable_lookup_row = df_derived_variables_lookup.loc[i]
+            if variable_lookup_row["new_variable"] is None:
+                continue
+            if self.find(variable_lookup_row["action"], variable_lookup_row["detail"]) is None:
+                unsupported.append(f"row {i}: new_variable: {variable_lookup_row['new_variable']}; action: {variable_lookup_row['action']}; detail: {variable_lookup_row['detail']}")
+        if len(unsupported) > 0:
+            raise ValueError(f"Unsupported action and detail in the derived variables lookup: {'; '.join(unsupported)}")
+
+
+calculator_registry = CalculatorRegistry()
+
+calculator_registry.register("recode", ANY_DETAIL, Calculator_Recode)
+calculator_registry.register("recode_2", ANY_DETAIL, Calculator_Recode_2)
+calculator_registry.register("recode_3", ANY_DETAIL, Calculator_Recode_3)
+
+for action in ["conditional", "conditional_2", "conditional_3"]:
+    calculator_registry.register(action, "equal", Calculator__Conditional_Equal)
+    calculator_registry.register(action, "greater_than", Calculator__Conditional_GreaterThan)
+    calculator_registry.register(action, "greater_than_equal", Calculator_Conditional_GreaterThanEqual)
+    calculator_registry.register(action, "less_than", Calculator_Conditional_LessThan)
+    calculator_registry.register(action, "less_than_equal", Calculator_Conditional_LessThanEqual)
+    calculator_registry.register(action, "is_in", Calculator__Conditional_IsIn)
+    calculator_registry.register(action, "between_including", Calculator__Conditional_Between_Including)
+    calculator_registry.register(action, "is_null", Calculator__Conditional_IsNull)
+    calculator_registry.register(action, "equal_string", Calculator__Conditional_EqualString)
+
+for action in ["multi_conditional", "multi_conditional_and", "multi_conditional_and_2", "multi_conditional_and_3"]:
+    calculator_registry.register(action, ANY_DETAIL, Calculator__MultiConditional)
+
+for action in ["sum", "sum_2", "sum_3", "sum_4"]:
+    calculator_registry.register(action, ANY_DETAIL, Calculator_Sum)
+calculator_registry.register("subtraction", ANY_DETAIL, Calculator_Subtraction)
+calculator_registry.register("mean", ANY_DETAIL, Calculator_Mean)
+for max_count_of_missing_values in [2, 3, 4, 5]:
+    calculator_registry.register(f"mean_{max_count_of_missing_values}_or_more", ANY_DETAIL,
+                                 lambda row, n=max_count_of_missing_values: Calculator_Mean_N_Or_More(row, n))
+calculator_registry.register("mean_skipna", ANY_DETAIL, Calculator_Mean_SkipNA)
+calculator_registry.register("merge", ANY_DETAIL, Calculator_Merge)
+calculator_registry.register("product", ANY_DETAIL, Calculator__Product)
+calculator_registry.register(None, ANY_DETAIL, Calculator__None)
+calculator_registry.register("count", ANY_DETAIL, Calculator__Count)
 
-# COMMAND ----------
 
-# DBTITLE 1,Calculator Factory
 class CalculatorFactory:
     @staticmethod
     def create_calculator(variable_lookup_row: tuple) -> Calculator:
-        print(variable_lookup_row)
-        action = variable_lookup_row["action"]
-        detail = variable_lookup_row["detail"]
-        new_var_name = variable_lookup_row["new_variable"]
-
-        if action == "recode":
-            return Calculator_Recode(variable_lookup_row)
-        elif action == "recode_2":
-            return Calculator_Recode_2(variable_lookup_row)
-        elif action == "recode_3":
-            return Calculator_Recode_3(variable_lookup_row)
-        elif action in ["conditional", "conditional_2", "conditional_3"]:
-            if detail == "equal":
-                return Calculator__Conditional_Equal(variable_lookup_row)
-            elif detail == "greater_than":
-                return Calculator__Conditional_GreaterThan(variable_lookup_row)
-            elif detail == "greater_than_equal":
-                return Calculator_Conditional_GreaterThanEqual(variable_lookup_row)
-            elif detail == "less_than":
-                return Calculator_Conditional_LessThan(variable_lookup_row)
-            elif detail == "less_than_equal":
-                return Calculator_Conditional_LessThanEqual(variable_lookup_row)
-            elif detail == "is_in":
-                return Calculator__Conditional_IsIn(variable_lookup_row)
-            elif detail == "between_including":
-                return Calculator__Conditional_Between_Including(variable_lookup_row)
-            elif detail == "is_null":
-                return Calculator__Conditional_IsNull(variable_lookup_row)
-            elif detail == "between_including":
-                return Calculator__Conditional_Between_Including(variable_lookup_row)
-            elif detail == "equal_string":
-                return Calculator__Conditional_EqualString(variable_lookup_row)
-            else:
-                return CalculatorNull(variable_lookup_row)
-        elif action == "multi_conditional":
-            if detail == "equal,equal":
-                return Calculator__MultiConditional_Equal_Equal(variable_lookup_row)
-            elif detail == "equal,greater_than":
-                return Calculator__MultiConditional_Equal_GreaterThan(variable_lookup_row)
-            elif detail == "equal,is_null":
-                return Calculator__MultiConditional_Equal_IsNull(variable_lookup_row)
-            else:
-                return CalculatorNull(variable_lookup_row)
-        elif action == "multi_conditional_and":
-            if detail == "equal,equal":
-                return Calculator__MultiConditionalAnd_Equal_Equal(variable_lookup_row)
-            if detail == "equal,is_null":
-                return Calculator__MultiConditionalAnd_Equal_IsNull(variable_lookup_row)
-            if detail == "less_than,equal":
-                return Calculator__MultiConditionalAnd_LessThan_Equal(variable_lookup_row)
-            elif detail == "is_in,equal,equal":
-                return Calculator__MultiConditionalAnd_IsIn_Equal_Equal(variable_lookup_row)
-            elif detail == "equal,greater_than":
-                return Calculator__MultiConditionalAnd_Equal_GreaterThan(variable_lookup_row)
-            elif detail == "is_in,equal":
-                return Calculator__MultiConditionalAnd_IsIn_Equal(variable_lookup_row)
-            elif detail == "is_in,is_in":
-                return Calculator__MultiConditionalAnd_IsIn_IsIn(variable_lookup_row)
-            elif detail == "greater_than_equal,greater_than":
-                return Calculator__MultiConditionalAnd_GreaterThanEqual_GreaterThan(variable_lookup_row)
-            else:
-                return CalculatorNull(variable_lookup_row)
-        elif action == "multi_conditional_and_2":
-            if detail == "less_than,equal":
-                return Calculator__MultiConditionalAnd_LessThan_Equal(variable_lookup_row)
-            elif detail == "equal,equal,equal,equal":
-                return Calculator__MultiConditionalAnd_Equal4(variable_lookup_row)
-            elif detail == "greater_than_equal,greater_than":
-                return Calculator__MultiConditionalAnd_GreaterThanEqual_GreaterThan(variable_lookup_row)
-            elif detail == "equal,less_than,less_than":
-                return Calculator__MultiConditionalAnd_Equal_LessThan_LessThen(variable_lookup_row)
-            else:
-                return CalculatorNull(variable_lookup_row)
-        elif action == "multi_conditional_and_3":
-            if detail == "equal,equal":
-                return Calculator__MultiConditional_Equal_Equal(variable_lookup_row)
-            elif detail == "equal,greater_than":
-                return Calculator__MultiConditional_Equal_GreaterThan(variable_lookup_row)
-            elif detail == "equal,greater_than_equal":
-                return Calculator__MultiConditionalAnd_Equal_GreaterThanEqual(variable_lookup_row)
-            elif detail == "equal,less_than":
-                return Calculator__MultiConditionalAnd_Equal_LessThan(variable_lookup_row)
-            elif detail == "equal,is_null":
-                return Calculator__MultiConditional_Equal_IsNull(variable_lookup_row)
-            elif detail == "less_than,greater_than_equal":
-                return Calculator__MultiConditionalAnd_LessThan_GreaterThanEqual(variable_lookup_row)
-            elif detail == "less_than,less_than":
-                return Calculator__MultiConditionalAnd_LessThan_LessThan(variable_lookup_row)
-            elif detail == "equal,equal,equal":
-                return Calculator__MultiConditionalAnd_Equal_Equal_Equal(variable_lookup_row)
-            elif detail == "less_than,equal":
-                return Calculator__MultiConditionalAnd_LessThan_Equal(variable_lookup_row)
-            else:
-                return CalculatorNull(variable_lookup_row)
-        elif action in ["sum", "sum_2", "sum_3", "sum_4"]:
-            return Calculator_Sum(variable_lookup_row)
-        elif action == "subtraction":
-            return Calculator_Subtraction(variable_lookup_row)
-        elif action == "mean":
-            return Calculator_Mean(variable_lookup_row)
-        elif action == "mean_2_or_more":
-            return Calculator_Mean_N_Or_More(variable_lookup_row, 2)
-        elif action == "mean_3_or_more":
-            return Calculator_Mean_N_Or_More(variable_lookup_row, 3)
-        elif action == "mean_4_or_more":
-            return Calculator_Mean_N_Or_More(variable_lookup_row, 4)
-        elif action == "mean_5_or_more":
-            return Calculator_Mean_N_Or_More(variable_lookup_row, 5)
-        elif action == "mean_skipna":
-            return Calculator_Mean_SkipNA(variable_lookup_row)
-        elif action == "merge":
-            return Calculator_Merge(variable_lookup_row)
-        elif action == "product":
-            return Calculator__Product(variable_lookup_row)
-        elif action is None:
-            return Calculator__None(variable_lookup_row)
-        elif action == "count":
-            return Calculator__Count(variable_lookup_row)
+        return calculator_registry.create_calculator(variable_lookup_row)
+
+
+# COMMAND ----------
+
+# DBTITLE 1,Calculator Result Cache
+from collections import OrderedDict
+
+
+class CalculatorResultCache:
+    """
+    Bounded LRU memo of calculator evaluations, keyed by (rule, values of the rule's source keys): answers come from small domains
+    (Likert scales, yes/no, a few multi-select options), so most responses repeat the inputs of an earlier one for a given rule.
+    A result only depends on the values of the rule's source keys (a missing key is part of the key), so a cached result is the one evaluating would return.
+    Values are told apart by type as the calculators do (1, 1.0, True and "1" are different keys); evaluations whose values cannot be hashed,
+    and evaluations that raise, are not cached. Traced responses are always evaluated.
+    Caching is enabled per rule: for every rule by default, or only for the rules of new_variables and/or of calculator_classes.
+    Multi-key calculators (means, sums) gain the most from a hit; a rule whose inputs rarely repeat (free text) only pays for the lookups.
+    """
+    _missing = object()
+
+    def __init__(self, max_size: int = 100000, new_variables: set = None, calculator_classes: tuple = None):
+        self.max_size = max_size
+        self.new_variables = set(new_variables) if new_variables is not None else None
+        self.calculator_classes = tuple(calculator_classes) if calculator_classes is not None else None
+        self._results = OrderedDict()
+        self._source_keys_by_calculator = {}
+        self._stats_by_calculator = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def is_enabled_for(self, calculator) -> bool:
+        if isinstance(calculator, (CalculatorNull, CalculatorPassthrough, CalculatorAllDone)):
+            return False
+        if self.new_variables is not None and calculator.new_var_name not in self.new_variables:
+            return False
+        return self.calculator_classes is None or isinstance(calculator, self.calculator_classes)
+
+    def enable(self, calculator):
+        """
+        Caches the results of calculator, if enabled for it.
+        """
+        if self.is_enabled_for(calculator):
+            self._source_keys_by_calculator[calculator] = tuple(calculator.source_keys)
+            self._stats_by_calculator[calculator] = [0, 0]
+            calculator.result_cache = self
+
+    @staticmethod
+    def _key_value(value):
+        value_type = type(value)
+        if value_type is str:
+            return value
+        if value_type is float:
+            # repr tells 0.0 from -0.0, which compare equal but are formatted differently
+            return float, repr(value)
+        if value_type is list:
+            return list, tuple(CalculatorResultCache._key_value(x) for x in value)
+        return value_type, value
+
+    def produce_new_var(self, calculator, row_response: tuple) -> (PostCalculationInstruction, str):
+        values = row_response["values"]
+        if type(values) is DictResponseValues:
+            # the dictionary itself: a hit has to stay cheaper than the evaluations it saves
+            values = values._values
+        get = values.get
+        missing = CalculatorResultCache._missing
+        key = [calculator]
+        for source_key in self._source_keys_by_calculator[calculator]:
+            value = get(source_key, missing)
+            key.append(value if type(value) is str or value is missing else CalculatorResultCache._key_value(value))
+        key = tuple(key)
+        stats = self._stats_by_calculator[calculator]
+        try:
+            result = self._results.get(key)
+        except TypeError:
+            return calculator.produce_new_var_uncached(row_response)
+        if result is not None:
+            self._results.move_to_end(key)
+            self.hits += 1
+            stats[0] += 1
+            return result
+        self.misses += 1
+        stats[1] += 1
+        result = calculator.produce_new_var_uncached(row_response)
+        self._results[key] = result
+        if len(self._results) > self.max_size:
+            self._results.popitem(last=False)
+            self.evictions += 1
+        return result
+
+    def clear(self):
+        self._results.clear()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        for rule_stats in self._stats_by_calculator.values():
+            rule_stats[:] = [0, 0]
+
+    def stats(self) -> dict:
+        """
+        Hits, misses and hit rate, overall and per rule (rules by decreasing number of hits).
+        """
+        lookups = self.hits + self.misses
+        rules = [{"new_variable": calculator.new_var_name, "calculator": type(calculator).__name__, "hits": hits, "misses": misses,
+                  "hit_rate": hits / (hits + misses) if hits + misses > 0 else None}
+                 for calculator, (hits, misses) in sorted(self._stats_by_calculator.items(), key=lambda x: -x[1][0])]
+        return {"max_size": self.max_size, "size": len(self._results), "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else None, "evictions": self.evictions, "rules": rules}
+
+# COMMAND ----------
+
+# DBTITLE 1,Rule Plan
+class RuleScheduling(Enum):
+    PASS_NUMBER = 1
+    DEPENDENCY_GRAPH = 2
+
+
+class RulePlan:
+    """
+    Compiled form of the derived variables lookup dataframe.
+    The lookup is grouped by (pass_number, new_variable) and a Calculator is created for every rule only once,
+    so the same plan can be evaluated against any number of responses without filtering the dataframe again.
+    Within a group, rules keep the order of the lookup dataframe index.
+
+    With RuleScheduling.PASS_NUMBER, variables are evaluated pass by pass, as ordered by the hand-assigned pass numbers.
+    With RuleScheduling.DEPENDENCY_GRAPH, the order is inferred from the source keys of the rules instead: a variable depends on every
+    derived variable its rules read. The graph is sorted topologically once and every variable is evaluated exactly once, in a single pass,
+    with all its rules in (pass_number, index) order; CalculatorPassthrough rules are dropped as they only exist to defer to a later pass.
+    Cycles, and source keys that are neither derived variables nor in known_source_keys (when given), are reported here, at compile time,
+    as are rules whose (action, detail) has no calculator in the registry.
+
+    With a result_cache, the results of the rules it is enabled for are memoized across the responses the plan is evaluated against.
+    """
+    def __init__(self, df_derived_variables_lookup: DataFrame, rule_scheduling: RuleScheduling = RuleScheduling.PASS_NUMBER, known_source_keys: set = None,
+                 tracer: DerivedVariablesTracer = None, registry: CalculatorRegistry = None, result_cache: CalculatorResultCache = None):
+        registry = registry if registry is not None else calculator_registry
+        registry.validate(df_derived_variables_lookup)
+        var_names = df_derived_variables_lookup["new_variable"].unique()
+        self._var_names = [x for x in var_names if x is not None]
+        self._max_pass_number = max(set(df_derived_variables_lookup["pass_number"]))
+        self._rule_scheduling = rule_scheduling
+        self._tracer = tracer if tracer is not None else DerivedVariablesTracer()
+        self._rules_by_pass_and_var = {}
+        self._dependencies_by_var = {}
+        self._dependency_levels = []
+        self._passes = []
+
+        for i in df_derived_variables_lookup.index:
+            variable_lookup_row = df_derived_variables_lookup.loc[i]
+            var_name = variable_lookup_row["new_variable"]
+            pass_number = variable_lookup_row["pass_number"]
+            if var_name is None or pass_number < 0 or pass_number > self._max_pass_number:
+                continue
+
+            calculator = registry.create_calculator(variable_lookup_row)
+            if calculator is None:
+                raise Exception(f"action: {variable_lookup_row['action']}; detail: {variable_lookup_row['detail']}; pass_number: {pass_number}")
+            calculator.tracer = self._tracer
+            if result_cache is not None:
+                result_cache.enable(calculator)
+            self._rules_by_pass_and_var.setdefault((pass_number, var_name), []).append(calculator)
+
+        if rule_scheduling == RuleScheduling.PASS_NUMBER:
+            for pass_number in range(0, self._max_pass_number + 1):
+                var_blocks = [(var_name, self._rules_by_pass_and_var[(pass_number, var_name)])
+                              for var_name in self._var_names if (pass_number, var_name) in self._rules_by_pass_and_var]
+                self._passes.append((pass_number, var_blocks))
+        elif rule_scheduling == RuleScheduling.DEPENDENCY_GRAPH:
+            rules_by_var = {}
+            for pass_number in range(0, self._max_pass_number + 1):
+                for var_name in self._var_names:
+                    for calculator in self._rules_by_pass_and_var.get((pass_number, var_name), []):
+                        if not isinstance(calculator, CalculatorPassthrough):
+                            rules_by_var.setdefault(var_name, []).append(calculator)
+            self._dependencies_by_var = self._build_dependencies(rules_by_var, known_source_keys)
+            self._dependency_levels = self._sort_topologically(self._dependencies_by_var)
+            var_blocks = [(var_name, rules_by_var[var_name]) for level in self._dependency_levels for var_name in level if var_name in rules_by_var]
+            self._passes.append((0, var_blocks))
         else:
-            return CalculatorNull(variable_lookup_row)
+            raise ValueError(f"Unsupported case: RuleScheduling = {rule_scheduling}")
+
+    def _build_dependencies(self, rules_by_var: dict, known_source_keys: set) -> dict:
+        derived_var_names = set(self._var_names)
+        dependencies_by_var = {var_name: [] for var_name in self._var_names}
+        unknown_keys = []
+        for var_name, calculators in rules_by_var.items():
+            for calculator in calculators:
+                for key in calculator.source_keys:
+                    if key in derived_var_names:
+                        # a rule reading its own variable sees the value the response came with
+                        if key != var_name and key not in dependencies_by_var[var_name]:
+                            dependencies_by_var[var_name].append(key)
+                    elif known_source_keys is not None and key not in known_source_keys:
+                        unknown_keys.append(f"{var_name} <- {key}")
+        if len(unknown_keys) > 0:
+            raise ValueError(f"Derived variables reference unknown keys: {'; '.join(unknown_keys)}")
+        return dependencies_by_var
+
+    def _sort_topologically(self, dependencies_by_var: dict) -> list:
+        """
+        Kahn's algorithm, one level at a time: variables within a level don't depend on each other and keep the lookup order.
+        """
+        remaining = {var_name: set(dependencies) for var_name, dependencies in dependencies_by_var.items()}
+        levels = []
+        while len(remaining) > 0:
+            level = [var_name for var_name in self._var_names if var_name in remaining and len(remaining[var_name]) == 0]
+            if len(level) == 0:
+                cycle = [f"{var_name} -> {', '.join(sorted(dependencies))}" for var_name, dependencies in remaining.items()]
+                raise ValueError(f"Derived variables depend on each other in a cycle: {'; '.join(cycle)}")
+            for var_name in level:
+                del remaining[var_name]
+            for dependencies in remaining.values():
+                dependencies.difference_update(level)
+            levels.append(level)
+        return levels
+
+    @property
+    def var_names(self) -> list:
+        return self._var_names
+
+    @property
+    def max_pass_number(self) -> int:
+        return self._max_pass_number
+
+    @property
+    def rule_scheduling(self) -> RuleScheduling:
+        return self._rule_scheduling
+
+    @property
+    def tracer(self) -> DerivedVariablesTracer:
+        """
+        Tracer shared by all the calculators of the plan.
+        """
+        return self._tracer
+
+    @property
+    def passes(self) -> list:
+        """
+        List of (pass_number, [(new_variable, [Calculator, ...]), ...]) in evaluation order.
+        With RuleScheduling.DEPENDENCY_GRAPH there is a single pass, 0, holding the variables in topological order.
+        """
+        return self._passes
+
+    @property
+    def dependencies(self) -> dict:
+        """
+        Derived variables each derived variable reads (RuleScheduling.DEPENDENCY_GRAPH only).
+        """
+        return self._dependencies_by_var
+
+    @property
+    def dependency_levels(self) -> list:
+        """
+        Topological levels of the dependency graph (RuleScheduling.DEPENDENCY_GRAPH only).
+        Variables of the same level only depend on earlier levels, so they can be evaluated independently of each other.
+        """
+        return self._dependency_levels
+
+    def rules(self, pass_number: int, var_name: str) -> list:
+        return self._rules_by_pass_and_var.get((pass_number, var_name), [])
 
+    def calculators(self):
+        for calculators in self._rules_by_pass_and_var.values():
+            yield from calculators
@@ -0,0 +1,683 @@
+# Databricks notebook source
+# MAGIC %md # Derived Variables Calculator Vectorized Engine
+
+# COMMAND ----------
+
+# MAGIC %md ## Overview
+# MAGIC This notebook contains an alternative batch engine for the Derived Variables Calculator:
+# MAGIC - response columns: responses of a whole survey batch held as one column per question key, with typed views converted once per value,
+# MAGIC   read by the vectorized evaluators as arrays and by the reference calculators through ResponseColumnsRowValues
+# MAGIC - vectorized evaluators: each rule is evaluated as masked array operations across all the rows of a batch
+# MAGIC - batch calculator: applies the rule plan passes to the response columns
+# MAGIC
+# MAGIC The row-by-row engine in derived_variables_calculator_engine remains the reference implementation.
+# MAGIC Calculators without a vectorized evaluator, and rows a vectorized evaluator cannot reproduce exactly (e.g. values that make the reference calculator raise),
+# MAGIC are evaluated with the reference calculator, row by row.
+# MAGIC
+# MAGIC This notebook expects derived_variables_calculator_engine to be run first.
+
+# COMMAND ----------
+
+# DBTITLE 1,Response Columns
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+
+class ResponseColumns:
+    """
+    Response table of a batch of survey responses: every question key is mapped to a column index once, and a column holds the raw values
+    of the key in an object ndarray, plus a mask of the rows where the key is present (missing keys are not values).
+    Typed views of a column (strings, floats, ...) hold the values converted once into typed ndarrays, with a mask of the rows where
+    the conversion succeeded. A view is filled lazily, a row at a time for the scalar calculators (through row_values) or all the rows at once
+    for the vectorized evaluators, and every raw value is converted at most once per view; assigning to rows only resets those rows of the views.
+    """
+    def __init__(self, n_rows: int):
+        self._n_rows = n_rows
+        self._column_indexes = {}
+        self._keys = []
+        self._columns = []
+        self._present = []
+        self._views = []
+
+    @staticmethod
+    def from_response_dictionaries(list_of_response_dictionaries: list):
+        n_rows = len(list_of_response_dictionaries)
+        response_columns = ResponseColumns(n_rows)
+        # the columns are collected as lists, and copied to arrays once
+        column_values = {}
+        column_rows = {}
+        for i, response_dict in enumerate(list_of_response_dictionaries):
+            for key, value in response_dict["values"].items():
+                values = column_values.get(key)
+                if values is None:
+                    values = column_values[key] = [None] * n_rows
+                    column_rows[key] = []
+                values[i] = value
+                column_rows[key].append(i)
+        for key, values in column_values.items():
+            column_index = response_columns._add_column(key)
+            response_columns._columns[column_index] = np.fromiter(values, dtype=object, count=n_rows)
+            response_columns._present[column_index][column_rows[key]] = True
+        return response_columns
+
+    @staticmethod
+    def from_dataframe(df_responses: DataFrame):
+        """
+        Builds response columns from a dataframe with one column per question key.
+        Cells holding None or NaN are treated as keys missing from the response.
+        """
+        response_columns = ResponseColumns(len(df_responses.index))
+        for key in df_responses.columns:
+            column_index = response_columns._add_column(key)
+            response_columns._columns[column_index] = df_responses[key].to_numpy(dtype=object, copy=True)
+            response_columns._present[column_index] = ~pd.isna(df_responses[key]).to_numpy()
+        return response_columns
+
+    @property
+    def n_rows(self) -> int:
+        return self._n_rows
+
+    def keys(self):
+        return self._keys
+
+    def column_index(self, key) -> int:
+        """
+        Index of the column of key; None when no response has the key.
+        """
+        return self._column_indexes.get(key)
+
+    def _add_column(self, key) -> int:
+        column_index = len(self._keys)
+        self._column_indexes[key] = column_index
+        self._keys.append(key)
+        self._columns.append(np.full(self._n_rows, None, dtype=object))
+        self._present.append(np.zeros(self._n_rows, dtype=bool))
+        self._views.append({})
+        return column_index
+
+    def values(self, key) -> np.ndarray:
+        column_index = self._column_indexes.get(key)
+        if column_index is None:
+            return np.full(self._n_rows, None, dtype=object)
+        return self._columns[column_index]
+
+    def present(self, key) -> np.ndarray:
+        column_index = self._column_indexes.get(key)
+        if column_index is None:
+            return np.zeros(self._n_rows, dtype=bool)
+        return self._present[column_index]
+
+    def is_present(self, key, i: int) -> bool:
+        column_index = self._column_indexes.get(key)
+        return column_index is not None and bool(self._present[column_index][i])
+
+    def assign(self, key, rows: np.ndarray, values: np.ndarray):
+        column_index = self._column_indexes.get(key)
+        if column_index is None:
+            column_index = self._add_column(key)
+        self._columns[column_index][rows] = values
+        self._present[column_index][rows] = True
+        # the last array of every view marks its rows already converted
+        for view in self._views[column_index].values():
+            view[-1][rows] = False
+
+    def assign_value(self, key, i: int, value):
+        """
+        assign for a single row, as done by the scalar calculators.
+        """
+        column_index = self._column_indexes.get(key)
+        if column_index is None:
+            column_index = self._add_column(key)
+        self._columns[column_index][i] = value
+        self._present[column_index][i] = True
+        for view in self._views[column_index].values():
+            view[-1][i] = False
+
+    def row_values(self, i: int):
+        return ResponseColumnsRowValues(self, i)
+
+    def update_response_dictionaries(self, list_of_response_dictionaries: list, keys: list):
+        """
+        Writes the values of the given keys back into the "values" dictionaries of the responses the columns were built from.
+        """
+        for key in keys:
+            column_index = self._column_indexes.get(key)
+            if column_index is None:
+                continue
+            rows = np.flatnonzero(self._present[column_index])
+            for i, value in zip(rows.tolist(), self._columns[column_index][rows].tolist()):
+                list_of_response_dictionaries[i]["values"][key] = value
+
+    # ===============================================================================
+    # Typed views
+    # ===============================================================================
+
+    @staticmethod
+    def _numeric_string(x) -> int:
+        if not str(x).isnumeric():
+            raise ValueError(x)
+        return int(str(x))
+
+    # view name: (conversion, dtype, default); a value the conversion raises for is not converted
+    _view_conversions = {
+        "strings": (str, object, ""),
+        "floats_of_strings": (lambda x: float(str(x)), np.float64, 0),
+        "floats": (float, np.float64, 0),
+        "ints": (int, object, 0),
+        "numeric_strings": (_numeric_string.__func__, object, 0),
+        "lists_of_floats": (Calculator.convert_str_to_list, object, None),
+    }
+
+    def _view_arrays(self, column_index: int, view_name: str):
+        views = self._views[column_index]
+        if view_name not in views:
+            convert, dtype, default = self._view_conversions[view_name]
+            views[view_name] = (np.full(self._n_rows, default, dtype=dtype), np.zeros(self._n_rows, dtype=bool), np.zeros(self._n_rows, dtype=bool))
+        return views[view_name]
+
+    def _view(self, key, view_name: str) -> (np.ndarray, np.ndarray):
+        """
+        Converts every present value of the column not converted yet; returns (converted values, mask of rows where the conversion succeeded).
+        Values that make the conversion raise are left to the reference calculators, which raise the same way.
+        """
+        column_index = self._column_indexes.get(key)
+        if column_index is None:
+            convert, dtype, default = self._view_conversions[view_name]
+            return np.full(self._n_rows, default, dtype=dtype), np.zeros(self._n_rows, dtype=bool)
+        converted, is_converted, is_parsed = self._view_arrays(column_index, view_name)
+        rows = np.flatnonzero(self._present[column_index] & ~is_parsed)
+        if len(rows) > 0:
+            convert = self._view_conversions[view_name][0]
+            converted_rows = []
+            converted_values = []
+            for i, value in zip(rows.tolist(), self._columns[column_index][rows].tolist()):
+                try:
+                    converted_values.append(convert(value))
+                except Exception:
+                    continue
+                converted_rows.append(i)
+            converted[converted_rows] = np.fromiter(converted_values, dtype=converted.dtype, count=len(converted_values))
+            is_converted[rows] = False
+            is_converted[converted_rows] = True
+            is_parsed[rows] = True
+        return converted, is_converted
+
+    def view_value(self, key, view_name: str, i: int) -> (bool, object):
+        """
+        (True, converted value) of row i of a view, converting the raw value if it was not yet; (False, None) when the conversion fails.
+        Raises KeyError when the row has no value for key.
+        """
+        column_index = self._column_indexes.get(key)
+        if column_index is None or not self._present[column_index][i]:
+            raise KeyError(key)
+        converted, is_converted, is_parsed = self._view_arrays(column_index, view_name)
+        if not is_parsed[i]:
+            try:
+                converted[i] = self._view_conversions[view_name][0](self._columns[column_index][i])
+                is_converted[i] = True
+            except Exception:
+                is_converted[i] = False
+            is_parsed[i] = True
+        if not is_converted[i]:
+            return False, None
+        value = converted[i]
+        return True, value.item() if isinstance(value, np.generic) else value
+
+    def strings(self, key) -> np.ndarray:
+        """str(value) of every row, as used by the reference calculators before comparing."""
+        return self._view(key, "strings")[0]
+
+    def floats_of_strings(self, key) -> (np.ndarray, np.ndarray):
+        """float(str(value)), i.e. the conversion guarded by Calculator.isfloat(str(value))."""
+        return self._view(key, "floats_of_strings")
+
+    def floats(self, key) -> (np.ndarray, np.ndarray):
+        """float(value) without going through str()."""
+        return self._view(key, "floats")
+
+    def ints(self, key) -> (np.ndarray, np.ndarray):
+        """int(value), as used by Calculator_Mean_N_Or_More, as Python ints."""
+        return self._view(key, "ints")
+
+    def numeric_strings(self, key) -> (np.ndarray, np.ndarray):
+        """int(str(value)) for values where str(value).isnumeric(), as used by the recode calculators."""
+        return self._view(key, "numeric_strings")
+
+    def lists_of_floats(self, key) -> (np.ndarray, np.ndarray):
+        """The items of a value as floats (via Calculator.convert_str_to_list), as added by Calculator_Sum."""
+        return self._view(key, "lists_of_floats")
+
+    def multi_select_items(self, key) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Items Calculator_Sum adds for a value, as the row of a float matrix padded with zeros, the count of items of every row,
+        and mask of the rows where converting the value succeeded. The column is split at once by MultiSelectValueParser.split_column.
+        """
+        column_index = self._column_indexes.get(key)
+        if column_index is None:
+            return np.zeros((self._n_rows, 0), dtype=np.float64), np.zeros(self._n_rows, dtype=np.int64), np.zeros(self._n_rows, dtype=bool)
+        views = self._views[column_index]
+        if "multi_select_items" not in views:
+            views["multi_select_items"] = (np.zeros((self._n_rows, 0), dtype=np.float64), np.zeros(self._n_rows, dtype=np.int64),
+                                           np.zeros(self._n_rows, dtype=bool), np.zeros(self._n_rows, dtype=bool))
+        items, counts, is_converted, is_split = views["multi_select_items"]
+        rows = np.flatnonzero(self._present[column_index] & ~is_split)
+        if len(rows) > 0:
+            row_items, counts[rows], is_converted[rows] = default_multi_select_value_parser.split_column(self._columns[column_index][rows])
+            if row_items.shape[1] > items.shape[1]:
+                items = np.hstack([items, np.zeros((self._n_rows, row_items.shape[1] - items.shape[1]), dtype=np.float64)])
+                views["multi_select_items"] = (items, counts, is_converted, is_split)
+            items[rows] = 0
+            items[rows, :row_items.shape[1]] = row_items
+            is_split[rows] = True
+        return items, counts, is_converted
+
+
+class ResponseColumnsRowValues(TypedResponseValues):
+    """
+    One row of ResponseColumns shaped like row_response["values"], used to run reference calculators on a batch:
+    the typed accessors read the views of the table, so a raw value is converted once for all the rules reading it,
+    and values set on the row are assigned to the table.
+    """
+    def __init__(self, response_columns: ResponseColumns, i: int):
+        self._response_columns = response_columns
+        self._i = i
+
+    def __getitem__(self, key):
+        if not self._response_columns.is_present(key, self._i):
+            raise KeyError(key)
+        return self._response_columns.values(key)[self._i]
+
+    def __setitem__(self, key, value):
+        self._response_columns.assign_value(key, self._i, value)
+
+    def __contains__(self, key):
+        return self._response_columns.is_present(key, self._i)
+
+    def __iter__(self):
+        return (key for key in self._response_columns.keys() if self._response_columns.is_present(key, self._i))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def _typed_value(self, key, view_name: str, convert_untyped):
+        is_converted, value = self._response_columns.view_value(key, view_name, self._i)
+        if is_converted:
+            return value
+        # the conversion failed: redo it on the raw value, to raise (or return) exactly what TypedResponseValues does
+        return convert_untyped(self, key)
+
+    def string_value(self, key) -> str:
+        return self._typed_value(key, "strings", TypedResponseValues.string_value)
+
+    def float_of_string_value(self, key) -> float:
+        return self._typed_value(key, "floats_of_strings", TypedResponseValues.float_of_string_value)
+
+    def float_value(self, key) -> float:
+        return self._typed_value(key, "floats", TypedResponseValues.float_value)
+
+    def int_value(self, key) -> int:
+        return self._typed_value(key, "ints", TypedResponseValues.int_value)
+
+    def numeric_string_value(self, key) -> int:
+        return self._typed_value(key, "numeric_strings", TypedResponseValues.numeric_string_value)
+
+    def list_of_floats_value(self, key) -> list:
+        return self._typed_value(key, "lists_of_floats", TypedResponseValues.list_of_floats_value)
+
+# COMMAND ----------
+
+# DBTITLE 1,Vectorized Evaluators
+RESOLVED = PostCalculationInstruction.MOVE_TO_NEXT_VAR__VALUE_RESOLVED.value
+CONDITIONS_NOT_MET = PostCalculationInstruction.MOVE_TO_NEXT_RULE__KEYS_EXIST_CONDITIONS_NOT_MET.value
+UNDERLYING_DATA_NOT_FOUND = PostCalculationInstruction.MOVE_TO_NEXT_VAR__UNDERLYING_DATA_NOT_FOUND.value
+CALCULATE_ON_THE_NEXT_PASS = PostCalculationInstruction.MOVE_TO_NEXT_VAR__WILL_ATTEMPT_TO_CALCULATE_ON_THE_NEXT_PASS.value
+ALL_DONE = PostCalculationInstruction.STOP__ALL_DONE.value
+
+
+class VectorizedCalculatorEvaluator:
+    """
+    Evaluates one Calculator for a set of rows of ResponseColumns.
+    Every evaluator returns (instructions, values): an int8 array of PostCalculationInstruction values and an object array of resolved values,
+    both aligned with rows. Rows marked as fallback by an evaluator are evaluated with the reference calculator.
+    """
+
+    # ===============================================================================
+    # Utility methods
+    # ===============================================================================
+
+    @staticmethod
+    def new_result(n: int) -> (np.ndarray, np.ndarray):
+        return np.full(n, CONDITIONS_NOT_MET, dtype=np.int8), np.full(n, "", dtype=object)
+
+    @staticmethod
+    def apply_condition(calculator: Calculator, instructions: np.ndarray, values: np.ndarray, is_evaluated: np.ndarray, is_condition_met: np.ndarray):
+        """Resolves rows where the condition is met to new_var_value and the other evaluated rows as Calculator.handle_else_value does."""
+        is_met = is_evaluated & is_condition_met
+        instructions[is_met] = RESOLVED
+        values[is_met] = calculator.new_var_value
+        is_not_met = is_evaluated & ~is_condition_met
+        if is_not_met.any():
+            else_instruction, else_value = calculator.handle_else_value()
+            instructions[is_not_met] = else_instruction.value
+            values[is_not_met] = else_value
+
+    @staticmethod
+    def is_exactly_summed(key_values: np.ndarray, n_values: int) -> np.ndarray:
+        """
+        Mask of the values that n_values of can be summed exactly in float64: integers of at most 2 ** 53 / n_values.
+        A mean of such values is rounded once by the division, as statistics.mean (which sums exact fractions) rounds it;
+        means of other values are left to the reference calculator.
+        """
+        key_values = key_values.astype(np.float64)
+        return np.isfinite(key_values) & (np.floor(key_values) == key_values) & (np.abs(key_values) <= 2.0 ** 53 / max(n_values, 1))
+
+    @staticmethod
+    def evaluate_with_reference_calculator(calculator: Calculator, response_columns: ResponseColumns, rows: np.ndarray,
+                                           instructions: np.ndarray, values: np.ndarray, is_fallback: np.ndarray):
+        for j in np.flatnonzero(is_fallback):
+            instruction, value = calculator.produce_new_var({"values": response_columns.row_values(rows[j])})
+            instructions[j] = instruction.value
+            values[j] = value
+
+    @staticmethod
+    def evaluate(calculator: Calculator, response_columns: ResponseColumns, rows: np.ndarray) -> (np.ndarray, np.ndarray):
+        instructions, values = VectorizedCalculatorEvaluator.new_result(len(rows))
+        evaluator = VectorizedCalculatorEvaluator.evaluators.get(type(calculator))
+        if evaluator is None:
+            is_fallback = np.ones(len(rows), dtype=bool)
+        else:
+            is_fallback = evaluator(calculator, response_columns, rows, instructions, values)
+        if is_fallback is not None and is_fallback.any():
+            VectorizedCalculatorEvaluator.evaluate_with_reference_calculator(calculator, response_columns, rows, instructions, values, is_fallback)
+        return instructions, values
+
+    # ===============================================================================
+    # Evaluators
+    # ===============================================================================
+
+    @staticmethod
+    def evaluate_numeric_conditions(calculator, response_columns, rows, instructions, values):
+        is_present = np.ones(len(rows), dtype=bool)
+        is_numeric = np.ones(len(rows), dtype=bool)
+        is_condition_met = np.ones(len(rows), dtype=bool)
+        for key_name, value_name, compare in VectorizedCalculatorEvaluator.numeric_conditions[type(calculator)]:
+            key = getattr(calculator, key_name)
+            is_present &= response_columns.present(key)[rows]
+            actual_values, is_float = response_columns.floats_of_strings(key)
+            value_to_compare_with = getattr(calculator.rule, value_name)
+            if value_to_compare_with is None:
+                is_numeric[:] = False
+                continue
+            is_numeric &= is_float[rows]
+            is_condition_met &= compare(actual_values[rows], value_to_compare_with)
+        instructions[~(is_present & is_numeric)] = UNDERLYING_DATA_NOT_FOUND
+        VectorizedCalculatorEvaluator.apply_condition(calculator, instructions, values, is_present & is_numeric, is_condition_met)
+
+    @staticmethod
+    def evaluate_multi_conditional(calculator, response_columns, rows, instructions, values):
+        is_evaluable, is_condition_met = calculator.predicate.evaluate_columns(response_columns, rows)
+        instructions[~is_evaluable] = UNDERLYING_DATA_NOT_FOUND
+        VectorizedCalculatorEvaluator.apply_condition(calculator, instructions, values, is_evaluable, is_condition_met)
+
+    @staticmethod
+    def evaluate_is_in(calculator, response_columns, rows, instructions, values):
+        is_present = response_columns.present(calculator.key_a)[rows]
+        list_to_use_for_comparison = np.array(list(calculator.rule.values_a), dtype=object)
+        is_condition_met = np.isin(response_columns.strings(calculator.key_a)[rows], list_to_use_for_comparison)
+        instructions[~is_present] = UNDERLYING_DATA_NOT_FOUND
+        VectorizedCalculatorEvaluator.apply_condition(calculator, instructions, values, is_present, is_condition_met)
+
+    @staticmethod
+    def evaluate_equal_string(calculator, response_columns, rows, instructions, values):
+        is_present = response_columns.present(calculator.key_a)[rows]
+        value_to_compare_with = calculator.value_a
+        is_condition_met = np.fromiter((x == value_to_compare_with for x in response_columns.values(calculator.key_a)[rows]), dtype=bool, count=len(rows))
+        instructions[~is_present] = UNDERLYING_DATA_NOT_FOUND
+        VectorizedCalculatorEvaluator.apply_condition(calculator, instructions, values, is_present, is_condition_met)
+
+    @staticmethod
+    def evaluate_between_including(calculator, response_columns, rows, instructions, values):
+        is_present = response_columns.present(calculator.key_a)[rows]
+        actual_values = response_columns.strings(calculator.key_a)[rows]
+        is_condition_met = is_present.copy()
+        is_condition_met[is_present] = (actual_values[is_present] >= calculator.rule.str_value_a) & (actual_values[is_present] <= calculator.rule.str_value_a2)
+        instructions[~is_present] = UNDERLYING_DATA_NOT_FOUND
+        VectorizedCalculatorEvaluator.apply_condition(calculator, instructions, values, is_present, is_condition_met)
+
+    @staticmethod
+    def evaluate_is_null(calculator, response_columns, rows, instructions, values):
+        # str(value) is never None, so the reference calculator always falls through to the else value
+        is_present = response_columns.present(calculator.key_a)[rows]
+        instructions[~is_present] = UNDERLYING_DATA_NOT_FOUND
+        VectorizedCalculatorEvaluator.apply_condition(calculator, instructions, values, is_present, np.zeros(len(rows), dtype=bool))
+
+    @staticmethod
+    def evaluate_product(calculator, response_columns, rows, instructions, values):
+        is_present = response_columns.present(calculator.key_a)[rows]
+        actual_values, is_float = response_columns.floats_of_strings(calculator.key_a)
+        value_to_multiply_by = calculator.rule.float_value_a
+        instructions[:] = RESOLVED
+        instructions[~is_present] = UNDERLYING_DATA_NOT_FOUND
+        if value_to_multiply_by is not None:
+            is_multiplied = is_present & is_float[rows]
+            values[is_multiplied] = (actual_values[rows][is_multiplied] * value_to_multiply_by).tolist()
+
+    @staticmethod
+    def evaluate_count(calculator, response_columns, rows, instructions, values):
+        is_present = response_columns.present(calculator.key_a)[rows]
+        instructions[:] = RESOLVED
+        instructions[~is_present] = UNDERLYING_DATA_NOT_FOUND
+        actual_values = response_columns.strings(calculator.key_a)[rows][is_present].astype(str)
+        values[is_present] = (np.char.count(actual_values, ",") + 1).tolist()
+
+    @staticmethod
+    def evaluate_merge(calculator, response_columns, rows, instructions, values):
+        is_present = response_columns.present(calculator.key_a)[rows] & response_columns.present(calculator.key_b)[rows]
+        instructions[:] = RESOLVED
+        instructions[~is_present] = UNDERLYING_DATA_NOT_FOUND
+        values[is_present] = response_columns.strings(calculator.key_a)[rows][is_present] + response_columns.strings(calculator.key_b)[rows][is_present]
+
+    @staticmethod
+    def evaluate_none(calculator, response_columns, rows, instructions, values):
+        is_present = response_columns.present(calculator.key_a)[rows]
+        instructions[:] = RESOLVED
+        instructions[~is_present] = UNDERLYING_DATA_NOT_FOUND
+        values[is_present] = response_columns.strings(calculator.key_a)[rows][is_present]
+
+    @staticmethod
+    def evaluate_recode(calculator, response_columns, rows, instructions, values):
+        is_present = response_columns.present(calculator.key_a)[rows]
+        actual_values, is_numeric = response_columns.numeric_strings(calculator.key_a)
+        is_recoded = is_present & is_numeric[rows]
+        instructions[:] = RESOLVED
+        instructions[~is_present] = UNDERLYING_DATA_NOT_FOUND
+        values[is_recoded] = 6 - actual_values[rows][is_recoded]
+        return is_present & ~is_recoded
+
+    @staticmethod
+    def evaluate_subtraction(calculator, response_columns, rows, instructions, values):
+        # float(value_1) is taken before value_2 is looked up, so a non-float value_1 raises in the reference even when value_2 is missing
+        is_present_1 = response_columns.present(calculator.key_a)[rows]
+        is_present_2 = response_columns.present(calculator.key_b)[rows]
+        values_1, is_float_1 = response_columns.floats(calculator.key_a)
+        values_2, is_float_2 = response_columns.floats(calculator.key_b)
+        is_fallback = (is_present_1 & ~is_float_1[rows]) | (is_present_1 & is_float_1[rows] & is_present_2 & ~is_float_2[rows])
+        is_subtracted = is_present_1 & is_present_2 & is_float_1[rows] & is_float_2[rows]
+        instructions[:] = UNDERLYING_DATA_NOT_FOUND
+        instructions[is_subtracted] = RESOLVED
+        values[is_subtracted] = (values_1[rows][is_subtracted] - values_2[rows][is_subtracted]).tolist()
+        return is_fallback
+
+    @staticmethod
+    def evaluate_mean(calculator, response_columns, rows, instructions, values):
+        # keys are read in order: a missing key resolves to UNDERLYING_DATA_NOT_FOUND unless an earlier value already made the reference raise
+        is_undecided = np.ones(len(rows), dtype=bool)
+        is_fallback = np.zeros(len(rows), dtype=bool)
+        totals = np.zeros(len(rows), dtype=np.float64)
+        list_of_keys_to_use_for_mean = calculator.rule.keys_a
+        for key in list_of_keys_to_use_for_mean:
+            is_present = response_columns.present(key)[rows]
+            key_values, is_float = response_columns.floats(key)
+            instructions[is_undecided & ~is_present] = UNDERLYING_DATA_NOT_FOUND
+            is_undecided &= is_present
+            is_fallback |= is_undecided & ~is_float[rows]
+            is_undecided &= is_float[rows]
+            is_inexact = is_undecided & ~VectorizedCalculatorEvaluator.is_exactly_summed(key_values[rows], len(list_of_keys_to_use_for_mean))
+            is_fallback |= is_inexact
+            is_undecided &= ~is_inexact
+            totals[is_undecided] += key_values[rows][is_undecided]
+        instructions[is_undecided] = RESOLVED
+        values[is_undecided] = (totals[is_undecided] / len(list_of_keys_to_use_for_mean)).tolist()
+        return is_fallback
+
+    @staticmethod
+    def evaluate_mean_n_or_more(calculator, response_columns, rows, instructions, values):
+        is_fallback = np.zeros(len(rows), dtype=bool)
+        totals = np.zeros(len(rows), dtype=np.float64)
+        counts = np.zeros(len(rows), dtype=np.int64)
+        list_of_keys_to_use_for_mean = calculator.rule.keys_a
+        for key in list_of_keys_to_use_for_mean:
+            is_value = response_columns.present(key)[rows] & np.fromiter((x is not None for x in response_columns.values(key)[rows]), dtype=bool, count=len(rows))
+            key_values, is_int = response_columns.ints(key)
+            is_fallback |= is_value & ~is_int[rows]
+            is_value &= is_int[rows]
+            # ints too large for a float64 are compared before being converted
+            is_small = np.fromiter((abs(x) <= 2 ** 53 // len(list_of_keys_to_use_for_mean) for x in key_values[rows]), dtype=bool, count=len(rows))
+            is_fallback |= is_value & ~is_small
+            is_value &= is_small
+            totals[is_value] += key_values[rows][is_value].astype(np.float64)
+            counts[is_value] += 1
+        instructions[:] = RESOLVED
+        is_mean = (len(list_of_keys_to_use_for_mean) - counts) < calculator._max_count_of_missing_values
+        is_fallback |= is_mean & (counts == 0)
+        is_mean &= ~is_fallback
+        # statistics.mean of ints returns an int when the mean is a whole number
+        is_whole = is_mean & (np.remainder(totals, np.maximum(counts, 1)) == 0)
+        values[is_whole] = (totals[is_whole] // counts[is_whole]).astype(np.int64).tolist()
+        is_fraction = is_mean & ~is_whole
+        values[is_fraction] = (totals[is_fraction] / counts[is_fraction]).tolist()
+        return is_fallback
+
+    @staticmethod
+    def evaluate_mean_skipna(calculator, response_columns, rows, instructions, values):
+        is_undecided = np.ones(len(rows), dtype=bool)
+        is_fallback = np.zeros(len(rows), dtype=bool)
+        totals = np.zeros(len(rows), dtype=np.float64)
+        counts = np.zeros(len(rows), dtype=np.int64)
+        for key in calculator.rule.keys_a:
+            is_present = response_columns.present(key)[rows]
+            instructions[is_undecided & ~is_present] = UNDERLYING_DATA_NOT_FOUND
+            is_undecided &= is_present
+            is_numeric = np.fromiter((x.isnumeric() for x in response_columns.strings(key)[rows]), dtype=bool, count=len(rows))
+            is_not_numeric = is_undecided & ~is_numeric
+            instructions[is_not_numeric] = RESOLVED
+            values[is_not_numeric] = ""
+            is_undecided &= is_numeric
+            key_values, is_float = response_columns.floats(key)
+            is_fallback |= is_undecided & ~is_float[rows]
+            is_undecided &= is_float[rows]
+            is_inexact = is_undecided & ~VectorizedCalculatorEvaluator.is_exactly_summed(key_values[rows], len(calculator.rule.keys_a))
+            is_fallback |= is_inexact
+            is_undecided &= ~is_inexact
+            totals[is_undecided] += key_values[rows][is_undecided]
+            counts[is_undecided] += 1
+        instructions[is_undecided] = RESOLVED
+        is_mean = is_undecided & (counts > 0)
+        values[is_mean] = (totals[is_mean] / counts[is_mean]).tolist()
+        return is_fallback
+
+    @staticmethod
+    def evaluate_sum(calculator, response_columns, rows, instructions, values):
+        is_fallback = np.zeros(len(rows), dtype=bool)
+        totals = np.zeros(len(rows), dtype=np.float64)
+        counts = np.zeros(len(rows), dtype=np.int64)
+        for key in calculator.rule.unique_keys_a:
+            is_present = response_columns.present(key)[rows]
+            key_items, key_counts, is_converted = response_columns.multi_select_items(key)
+            is_fallback |= is_present & ~is_converted[rows]
+            is_added = is_present & is_converted[rows]
+            row_items = key_items[rows]
+            row_counts = key_counts[rows]
+            # one item at a time, in the order of the reference sum(values_to_add), so that the float sums are the same to the last digit
+            for j in range(row_items.shape[1]):
+                is_item_added = is_added & (row_counts > j)
+                totals[is_item_added] += row_items[is_item_added, j]
+            counts[is_added] += row_counts[is_added]
+        instructions[:] = RESOLVED
+        is_sum = counts > 0
+        values[is_sum] = totals[is_sum].tolist()
+        return is_fallback
+
+
+VectorizedCalculatorEvaluator.numeric_conditions = {
+    Calculator__Conditional_Equal: [("key_a", "float_value_a", np.equal)],
+    Calculator__Conditional_GreaterThan: [("key_a", "float_value_a", np.greater)],
+    Calculator_Conditional_GreaterThanEqual: [("key_a", "float_value_a", np.greater_equal)],
+    Calculator_Conditional_LessThan: [("key_a", "float_value_a", np.less)],
+    Calculator_Conditional_LessThanEqual: [("key_a", "float_value_a", np.less_equal)],
+}
+
+VectorizedCalculatorEvaluator.evaluators = {
+    **{calculator_class: VectorizedCalculatorEvaluator.evaluate_numeric_conditions for calculator_class in VectorizedCalculatorEvaluator.numeric_conditions},
+    Calculator__MultiConditional: VectorizedCalculatorEvaluator.evaluate_multi_conditional,
+    Calculator__Conditional_IsIn: VectorizedCalculatorEvaluator.evaluate_is_in,
+    Calculator__Conditional_EqualString: VectorizedCalculatorEvaluator.evaluate_equal_string,
+    Calculator__Conditional_Between_Including: VectorizedCalculatorEvaluator.evaluate_between_including,
+    Calculator__Conditional_IsNull: VectorizedCalculatorEvaluator.evaluate_is_null,
+    Calculator__Product: VectorizedCalculatorEvaluator.evaluate_product,
+    Calculator__Count: VectorizedCalculatorEvaluator.evaluate_count,
+    Calculator_Merge: VectorizedCalculatorEvaluator.evaluate_merge,
+    Calculator__None: VectorizedCalculatorEvaluator.evaluate_none,
+    Calculator_Recode: VectorizedCalculatorEvaluator.evaluate_recode,
+    Calculator_Recode_2: VectorizedCalculatorEvaluator.evaluate_recode,
+    Calculator_Recode_3: VectorizedCalculatorEvaluator.evaluate_recode,
+    Calculator_Subtraction: VectorizedCalculatorEvaluator.evaluate_subtraction,
+    Calculator_Mean: VectorizedCalculatorEvaluator.evaluate_mean,
+    Calculator_Mean_N_Or_More: VectorizedCalculatorEvaluator.evaluate_mean_n_or_more,
+    Calculator_Mean_SkipNA: VectorizedCalculatorEvaluator.evaluate_mean_skipna,
+    Calculator_Sum: VectorizedCalculatorEvaluator.evaluate_sum,
+}
+
+# COMMAND ----------
+
+# DBTITLE 1,Batch Calculator
+class BatchSurveyDerivedVariablesCalculator:
+    """
+    Applies a RulePlan to all the rows of ResponseColumns at once, keeping the PostCalculationInstruction semantics of
+    SingleResponseSurveyDerivedVariablesCalculator for every row:
+    a row leaves a variable's block of rules once a value is resolved, the underlying data is not found (the variable is skipped on later passes),
+    or the calculation is deferred to the next pass; a row stops being processed altogether on STOP__ALL_DONE.
+    Evaluations are not traced; use the row-by-row engine to explain the result of a single response.
+    """
+    def __init__(self, rule_plan: RulePlan, response_columns: ResponseColumns):
+        self.rule_plan = rule_plan
+        self.response_columns = response_columns
+
+    def produce_derived_variables(self):
+        self.rule_plan.tracer.end_response()
+        n_rows = self.response_columns.n_rows
+        is_stopped = np.zeros(n_rows, dtype=bool)
+        is_not_found_by_var_name = {}
+
+        for pass_number, var_blocks in self.rule_plan.passes:
+            for var_name, calculators in var_blocks:
+                is_not_found = is_not_found_by_var_name.setdefault(var_name, np.zeros(n_rows, dtype=bool))
+                is_pending = ~is_stopped & ~is_not_found
+
+                for calculator in calculators:
+                    rows = np.flatnonzero(is_pending)
+                    if len(rows) == 0:
+                        break
+
+                    instructions, values = VectorizedCalculatorEvaluator.evaluate(calculator, self.response_columns, rows)
+
+                    is_resolved = instructions == RESOLVED
+                    self.response_columns.assign(calculator.new_var_name, rows[is_resolved], values[is_resolved])
+                    is_not_found[rows[instructions == UNDERLYING_DATA_NOT_FOUND]] = True
+                    is_stopped[rows[instructions == ALL_DONE]] = True
+                    is_pending[rows[instructions != CONDITIONS_NOT_MET]] = False
+
+                    is_unsupported = ~np.isin(instructions, [RESOLVED, CONDITIONS_NOT_MET, UNDERLYING_DATA_NOT_FOUND, CALCULATE_ON_THE_NEXT_PASS, ALL_DONE])
+                    if is_unsupported.any():
+                        raise ValueError(f"Unsupported case: PostCalculationInstruction  = {instructions[is_unsupported][0]}")
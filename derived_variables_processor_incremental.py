@@ -0,0 +1,104 @@
+# Databricks notebook source
+# MAGIC %md # Derived variables processor, incremental
+
+# COMMAND ----------
+
+# MAGIC %md ## Flow:
+# MAGIC - connect to database, resolve namespace
+# MAGIC - resolve arguments
+# MAGIC - read the responses exported by get_survey_responses for process_timestamp: with a continuation token, only the responses new or changed since the previous export
+# MAGIC - produce the derived variables of these responses only, streamed from the file in batches so that memory use does not depend on the size of the export
+# MAGIC - upsert them by response id into the survey's derived variables table
+# MAGIC
+# MAGIC The table is created from a full export (made without a continuation token), never from an incremental one, which would miss the older responses:
+# MAGIC - when the export of process_timestamp is a full one (is_full_export), from its responses
+# MAGIC - otherwise, from the full export at seed_json_path, before the responses of process_timestamp are upserted; without one, the notebook fails
+# MAGIC
+# MAGIC The rows of older responses are not recalculated here: after changing the lookup, drop the table and create it again from a full export (seed_json_path).
+# MAGIC The upsert fails when the derived variables of the lookup no longer match the columns of the table, rather than leaving older rows without the new variables.
+
+# COMMAND ----------
+
+# DBTITLE 1,connect to database, resolve namespace
+# MAGIC %run ./../../../../includes/configuration
+
+# COMMAND ----------
+
+# MAGIC %run ./derived_variables_calculator
+
+# COMMAND ----------
+
+spark.sql(f"USE {namespace}_system;")
+
+# COMMAND ----------
+
+# DBTITLE 1,resolve arguments
+dbutils.widgets.removeAll()
+
+dbutils.widgets.text('aws_bucket_name','nuro-databricks')
+aws_bucket_name = getArgument('aws_bucket_name')
+
+dbutils.widgets.text('mount_name','surveys-qualtrics-s3')
+mount_name = getArgument('mount_name')
+
+dbutils.widgets.text('survey_id','')
+survey_id = getArgument('survey_id')
+
+dbutils.widgets.text('process_timestamp','')
+process_timestamp = getArgument('process_timestamp')
+
+# lookup flatfile (csv), relative to the mount
+dbutils.widgets.text('derived_variables_lookup_path', f'surveys/qualtrics/derived_variables_lookup/{survey_id}.csv')
+derived_variables_lookup_path = getArgument('derived_variables_lookup_path')
+
+dbutils.widgets.text('derived_variables_table', f'surveys_qualtrics_derived_variables_{survey_id}')
+derived_variables_table = getArgument('derived_variables_table')
+
+dbutils.widgets.text('batch_size','10000')
+batch_size = int(getArgument('batch_size'))
+
+# 'true' when the export of process_timestamp was made without a continuation token, i.e. holds all the responses of the survey
+dbutils.widgets.text('is_full_export','false')
+is_full_export = getArgument('is_full_export').lower() == 'true'
+
+# full export (relative to the mount, e.g. the survey's first export) to create the table from when it does not exist yet
+dbutils.widgets.text('seed_json_path','')
+seed_json_path = getArgument('seed_json_path')
+
+# vars:
+mount_path = '/mnt/' + mount_name
+s3_path = f'surveys/qualtrics/{namespace}/{process_timestamp}/{survey_id}'
+response_id_column = 'responseId'
+
+# COMMAND ----------
+
+# DBTITLE 1,read the lookup
+df_derived_variables_lookup = read_derived_variables_lookup_csv(f'/dbfs{mount_path}/{derived_variables_lookup_path}')
+
+# COMMAND ----------
+
+# DBTITLE 1,produce the derived variables of the exported responses batch by batch, upsert them by response id
+# only the derived variables of the batches are kept: one response id and a few strings per response
+# the lookup is compiled once for all the batches
+rule_plan = RulePlan(df_derived_variables_lookup)
+
+def upsert_derived_variables_of_export(json_path, is_full_export):
+  responses = SurveyResponsesJsonStreamReader(json_path)
+  pdf_batches = [IncrementalSurveyDerivedVariablesCalculator.produce_delta_derived_variables_dataframe_using_rule_plan(rule_plan, batch, response_id_column)
+                 for batch in responses.batches(batch_size)]
+  print(f'{sum(len(x) for x in pdf_batches)} responses processed from {json_path}')
+  if(len(pdf_batches) > 0):
+    pdf_delta = pd.concat(pdf_batches, ignore_index=True).drop_duplicates(response_id_column, keep='last')
+  else:
+    # a full export without responses still creates the (empty) table, for the incremental exports that follow
+    pdf_delta = pd.DataFrame(columns=[response_id_column] + rule_plan.var_names)
+  if(len(pdf_delta) > 0 or is_full_export):
+    sdf_delta = spark.createDataFrame(pdf_delta, StructType([StructField(x, StringType(), True) for x in pdf_delta.columns]))
+    IncrementalSurveyDerivedVariablesCalculator.upsert_spark_table(sdf_delta, derived_variables_table, response_id_column, is_full_export=is_full_export)
+
+if(not is_full_export and not spark.catalog.tableExists(derived_variables_table)):
+  if(seed_json_path == ''):
+    raise Exception(f'{derived_variables_table} does not exist and the export of {process_timestamp} is incremental: set seed_json_path to a full export of the survey')
+  upsert_derived_variables_of_export(f'/dbfs{mount_path}/{seed_json_path}', True)
+
+upsert_derived_variables_of_export(f'/dbfs{mount_path}/{s3_path}/survey_responses.json', is_full_export)
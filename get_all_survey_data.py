@@ -4,11 +4,26 @@
 # COMMAND ----------
 
 # MAGIC %md ## flow description
+# MAGIC - connect to database, resolve namespace
 # MAGIC - set constants, vars, resolve secrets
 # MAGIC - ensure drive mount
 # MAGIC - generate timestamp
 # MAGIC - find all the surveys that are active or unfinished
-# MAGIC - for each survey get schema, metadata, questions, latest responses and store the data in S3
+# MAGIC - for each survey get schema, metadata, questions and store the data in S3
+# MAGIC - meanwhile, export the latest responses of all the surveys concurrently from this notebook and stream them to S3
+# MAGIC - commit the new continuation token of every survey as soon as its responses file is written; a failed run is resumed by running it again
+# MAGIC   with its process_timestamp in resume_process_timestamp
+# MAGIC - compact the continuation tokens table, keeping the latest tokens of every survey
+# MAGIC - produce the derived variables: from the full JSON files, or, in incremental mode, from the exported responses only, upserted by response id
+# MAGIC - convert the exported responses and their derived variables to Parquet, partitioned by survey and process_timestamp
+
+# COMMAND ----------
+
+# MAGIC %run ../../../../includes/configuration
+
+# COMMAND ----------
+
+spark.sql(f"USE {namespace}_system;")
 
 # COMMAND ----------
 
@@ -16,6 +31,10 @@
 
 # COMMAND ----------
 
+# MAGIC %run ./qualtrics_export_orchestrator
+
+# COMMAND ----------
+
 # MAGIC %md ## set constants, vars, resolve secrets
 
 # COMMAND ----------
@@ -32,7 +51,21 @@ access_key = dbutils.secrets.get(scope='qualtrics', key = 'aws_access_key')
 secret_key = dbutils.secrets.get(scope='qualtrics', key = 'aws_secret_key')
 encoded_secret_key = secret_key.replace('/','%2F')
 
-api_route = '/API/v3/surveys'
+# concurrent Qualtrics API calls and downloads, API calls per second and retries of failed API calls, across all the surveys
+max_concurrent_requests = 32
+max_requests_per_second = 10
+max_retries_per_run = 200
+
+# continuation tokens kept per survey when the tokens table is compacted
+continuation_tokens_to_keep = 5
+
+# True to produce the derived variables of the exported responses only and upsert them into the survey's derived variables table;
+# the table is created from the survey's first (full) export, or from the full export at seed_json_path of derived_variables_processor_incremental,
+# which is also how it is recalculated (once dropped) after changing a lookup
+incremental_derived_variables = False
+
+# True to convert the exported responses, and their derived variables, to the Parquet datasets read by later stages
+convert_to_parquet = True
 
 # COMMAND ----------
 
@@ -45,12 +78,17 @@ if(not any(mount.mountPoint == mount_path for mount in dbutils.fs.mounts())):
 
 # COMMAND ----------
 
-# MAGIC %md ## generate process_timestamp
+# MAGIC %md ## generate process_timestamp, or resume the run of resume_process_timestamp
 
 # COMMAND ----------
 
 from datetime import datetime
-process_timestamp = datetime.now().strftime('%Y%m%d %H%M%S')
+
+dbutils.widgets.text('resume_process_timestamp','')
+process_timestamp = getArgument('resume_process_timestamp')
+if(process_timestamp == ''):
+  process_timestamp = datetime.now().strftime('%Y%m%d %H%M%S')
+print(process_timestamp)
 
 # COMMAND ----------
 
@@ -58,49 +96,88 @@ process_timestamp = datetime.now().strftime('%Y%m%d %H%M%S')
 
 # COMMAND ----------
 
-# get surveys
+# list the surveys page by page: active_surveys fills up as the pages are fetched, and surveys_listed is set once the last page was read
+
+import threading
+
+qualtrics_client = QualtricsClient(hostname, token, rate_limiter=TokenBucketRateLimiter(max_requests_per_second),
+                                   retry_policy=RetryPolicy(retry_budget=RetryBudget(max_retries_per_run)))
+active_surveys = []
+surveys_listed = threading.Event()
+
+def list_active_surveys():
+  try:
+    for survey in qualtrics_client.iter_surveys(active_only=True):
+      active_surveys.append(survey)
+      yield survey
+  finally:
+    surveys_listed.set()
+
+# COMMAND ----------
 
-import http.client
-import json
+# get the latest continuation token of all the surveys with one query, and pass it to the export of every active survey as it is listed
 
-conn = http.client.HTTPSConnection(hostname)
-payload = ''
-headers = {
-  'Content-Type': 'application/json',
-  'X-API-TOKEN': token
-}
-conn.request('GET', api_route, payload, headers)
-res = conn.getresponse()
-data_response = res.read()
-data_response_decoded = data_response.decode('utf-8')
-conn.close()
-surveys = json.loads(data_response_decoded)
+checkpoint_store = SparkCheckpointStore(spark)
+continuation_tokens = checkpoint_store.get_continuation_tokens()
 
+def get_survey_exports(surveys):
+  for survey in surveys:
+    yield SurveyExport(survey['id'], continuation_tokens.get(survey['id'], ''))
 
 # COMMAND ----------
 
-notebooks = []
-for survey in surveys['result']['elements']:
-  if(survey['isActive']==True):
-    notebooks.append(NotebookData('./get_survey_schema',0,{'aws_bucket_name': aws_bucket_name, 'mount_name': mount_name, 'survey_id': survey['id'],'process_timestamp': process_timestamp}))    
-    notebooks.append(NotebookData('./get_survey_responses',0,{'aws_bucket_name': aws_bucket_name, 'mount_name': mount_name, 'survey_id': survey['id'],'process_timestamp': process_timestamp})) 
+# export the responses from this notebook, starting with the first page of surveys while the next pages are listed,
+# and get schemas in parallel notebooks once all the surveys are listed
+from concurrent.futures import ThreadPoolExecutor
 
 # notebooks = [
-#   NotebookData('./get_survey_schema',0,{'aws_bucket_name': aws_bucket_name, 'mount_name': mount_name, 'survey_id': 'SV_bO9FIxRtot01PXE','process_timestamp': process_timestamp}),
-#   NotebookData('./get_survey_responses',0,{'aws_bucket_name': aws_bucket_name, 'mount_name': mount_name, 'survey_id': 'SV_bO9FIxRtot01PXE','process_timestamp': process_timestamp})
+#   NotebookData('./get_survey_schema',0,{'aws_bucket_name': aws_bucket_name, 'mount_name': mount_name, 'survey_id': 'SV_bO9FIxRtot01PXE','process_timestamp': process_timestamp})
 # ]
 
-res = parallelNotebooks(notebooks,8)
+survey_export_orchestrator = SurveyExportOrchestrator(qualtrics_client, ExportFileStorage('/dbfs'), f'{mount_path}/surveys/qualtrics/{namespace}/{process_timestamp}',
+                                                      max_concurrency=max_concurrent_requests, checkpoint_store=checkpoint_store, run_id=process_timestamp)
+with ThreadPoolExecutor(max_workers=1) as executor:
+  survey_exports_future = executor.submit(survey_export_orchestrator.run, get_survey_exports(list_active_surveys()))
+  # the export may fail before it starts listing the surveys, and surveys_listed would never be set: stop waiting once it is done, raising its error
+  while(not surveys_listed.wait(5) and not survey_exports_future.done()):
+    pass
+  if(not surveys_listed.is_set()):
+    survey_exports_future.result()
+  notebooks = []
+  for survey in active_surveys:
+    notebooks.append(NotebookData('./get_survey_schema',0,{'aws_bucket_name': aws_bucket_name, 'mount_name': mount_name, 'survey_id': survey['id'],'process_timestamp': process_timestamp}))
+  res = parallelNotebooks(notebooks,8)
+  survey_export_results = survey_exports_future.result()
+qualtrics_client.close()
+
+# COMMAND ----------
+
+# the new continuation tokens are already committed: compact the older ones, then fail on the first error
+
+for survey_export_result in survey_export_results:
+  print(survey_export_result)
+checkpoint_store.compact_continuation_tokens(continuation_tokens_to_keep)
+
 for r in res.done:
   if r.exception() is not None:
     raise r.exception()
+for survey_export_result in survey_export_results:
+  if(survey_export_result.error is not None):
+    raise survey_export_result.error
 
 # COMMAND ----------
 
 notebooks_ext = []
-for survey in surveys['result']['elements']:
-  if(survey['isActive']==True):
+for survey in active_surveys:
+  if(incremental_derived_variables):
+    # the export of a survey without a continuation token holds all its responses
+    is_full_export = str(continuation_tokens.get(survey['id'], '') == '').lower()
+    notebooks_ext.append(NotebookData('./derived_variables_processor_incremental',0,{'aws_bucket_name': aws_bucket_name, 'mount_name': mount_name, 'survey_id': survey['id'],'process_timestamp': process_timestamp,
+                                                                                       'is_full_export': is_full_export}))
+  else:
     notebooks_ext.append(NotebookData('./derived_variables_processor_using_full_json_file_s3',0,{'aws_bucket_name': aws_bucket_name, 'survey_id': survey['id'],'process_timestamp': process_timestamp}))    
+  if(convert_to_parquet):
+    notebooks_ext.append(NotebookData('./convert_survey_responses_to_parquet',0,{'mount_name': mount_name, 'survey_id': survey['id'],'process_timestamp': process_timestamp}))
 
 # notebooks_ext = [
 #   NotebookData('./derived_variables_processor_using_full_json_file_s3',0,{'aws_bucket_name': aws_bucket_name, 'survey_id': 'SV_bO9FIxRtot01PXE','process_timestamp': process_timestamp})]
@@ -0,0 +1,749 @@
+# Databricks notebook source
+# MAGIC %md # Qualtrics API Client
+
+# COMMAND ----------
+
+# MAGIC %md ## Overview
+# MAGIC This notebook contains the pieces shared by the notebooks calling the Qualtrics API, such as:
+# MAGIC - export file storage (files written through the local file API: `/dbfs` on Databricks, any local directory in tests), written to a temporary file renamed once complete
+# MAGIC - streaming download of export files, copied to storage in fixed-size chunks without holding the file in memory
+# MAGIC - streaming decompression of compressed (zip) exports, unzipped while they are downloaded
+# MAGIC - Qualtrics client: keep-alive connection pool with a per-host connection limit, headers and JSON parsing in one place, typed errors
+# MAGIC - rate limiting and retries: token bucket shared by all the threads using a client, classified retries (429, 5xx) within a per-run retry budget
+# MAGIC - export progress polling: next poll scheduled from percentComplete, exponential backoff with jitter, overall deadline
+
+# COMMAND ----------
+
+# DBTITLE 1,Export file storage
+import asyncio
+import email.utils
+import http.client
+import json
+import logging
+import os
+import random
+import struct
+import threading
+import time
+import urllib.parse
+import uuid
+import zlib
+
+qualtrics_logger = logging.getLogger("qualtrics_api_client")
+
+
+class AtomicFileWriter:
+    """
+    Writes to a temporary file next to local_path, which replaces local_path only when the writer is closed without error, after being flushed
+    and fsynced: local_path either does not exist or holds a complete file. On error, the temporary file is removed.
+    """
+    def __init__(self, local_path: str):
+        self.local_path = local_path
+        self.temp_path = f"{local_path}.{uuid.uuid4().hex}.tmp"
+        self._file = open(self.temp_path, "wb")
+
+    def write(self, data: bytes) -> int:
+        return self._file.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+        return False
+
+    def commit(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self.temp_path, self.local_path)
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+
+class ExportFileStorage:
+    """
+    Writes export files through the local file API under root_dir: '/dbfs' on Databricks, so that '/mnt/...' paths land on the mounted bucket,
+    or any local directory as a stand-in in tests. Files are written with AtomicFileWriter: a failed download never leaves a partial file behind.
+    """
+    def __init__(self, root_dir: str = "/dbfs"):
+        self.root_dir = root_dir
+
+    def local_path(self, path: str) -> str:
+        if path.startswith("dbfs:"):
+            path = path[len("dbfs:"):]
+        return os.path.join(self.root_dir, path.lstrip("/"))
+
+    def open_for_write(self, path: str) -> AtomicFileWriter:
+        local_path = self.local_path(path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        return AtomicFileWriter(local_path)
+
+
+# COMMAND ----------
+
+# DBTITLE 1,Streaming download
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class ZipMemberStreamReader:
+    """
+    File-like reader of the first member of a zip archive, read from a non-seekable stream such as an HTTP response.
+    zipfile needs the central directory at the end of the archive, hence a seekable file: this reader parses the local file header instead
+    and inflates the member as the compressed bytes arrive, so neither the archive nor the member is held in memory.
+    Qualtrics compressed exports hold a single file. The CRC-32 of the member is checked at its end, and the rest of the archive is read and discarded.
+    """
+    _local_file_header = struct.Struct("<4sHHHHHIIIHH")
+    _local_file_header_signature = b"PK\x03\x04"
+    _data_descriptor_signature = b"PK\x07\x08"
+    _has_data_descriptor_flag = 0x08
+
+    def __init__(self, source, chunk_size: int = DOWNLOAD_CHUNK_SIZE):
+        self._source = source
+        self._chunk_size = chunk_size
+        self.compressed_bytes = 0
+        self._crc = 0
+        self._is_eof = False
+
+        header = self._read_exactly(self._local_file_header.size)
+        signature, _, flags, method, _, _, crc, compressed_size, _, name_length, extra_length = self._local_file_header.unpack(header)
+        if signature != self._local_file_header_signature:
+            raise ValueError("Export file is not a zip archive")
+        self.member_name = self._read_exactly(name_length).decode("utf-8", errors="replace")
+        self._read_exactly(extra_length)
+        self._has_data_descriptor = bool(flags & self._has_data_descriptor_flag)
+        self._expected_crc = None if self._has_data_descriptor else crc
+        if method == zlib.DEFLATED:
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        elif method == 0 and not self._has_data_descriptor:
+            self._decompressor = None
+            self._stored_bytes_left = compressed_size
+        else:
+            raise ValueError(f"Unsupported zip member {self.member_name}: compression method {method}, flags {flags}")
+
+    def _read_source(self, size: int) -> bytes:
+        chunk = self._source.read(size)
+        self.compressed_bytes += len(chunk)
+        return chunk
+
+    def _read_exactly(self, size: int, data: bytes = b"") -> bytes:
+        while len(data) < size:
+            chunk = self._read_source(size - len(data))
+            if not chunk:
+                raise EOFError("Zip archive is truncated")
+            data += chunk
+        return data
+
+    def _finish_member(self, unused_data: bytes):
+        if self._has_data_descriptor:
+            data_descriptor = self._read_exactly(8, unused_data)
+            crc_offset = 4 if data_descriptor[:4] == self._data_descriptor_signature else 0
+            self._expected_crc = struct.unpack("<I", self._read_exactly(crc_offset + 4, data_descriptor)[crc_offset:crc_offset + 4])[0]
+        if self._crc != self._expected_crc:
+            raise ValueError(f"CRC-32 of zip member {self.member_name} does not match")
+        while self._read_source(self._chunk_size):
+            pass
+        self._is_eof = True
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Returns up to size inflated bytes (all the remaining ones when size is negative), b"" at the end of the member.
+        """
+        chunks = []
+        n_bytes = 0
+        while not self._is_eof and (size < 0 or n_bytes < size):
+            max_length = size - n_bytes if size >= 0 else 0
+            if self._decompressor is None:
+                to_read = self._stored_bytes_left if max_length == 0 else min(max_length, self._stored_bytes_left)
+                chunk = self._read_exactly(to_read) if to_read > 0 else b""
+                self._stored_bytes_left -= len(chunk)
+                if self._stored_bytes_left == 0:
+                    self._crc = zlib.crc32(chunk, self._crc)
+                    self._finish_member(b"")
+                    chunks.append(chunk)
+                    n_bytes += len(chunk)
+                    break
+            else:
+                compressed = self._decompressor.unconsumed_tail or self._read_source(self._chunk_size)
+                if not compressed:
+                    raise EOFError("Zip archive is truncated")
+                chunk = self._decompressor.decompress(compressed, max_length)
+                if self._decompressor.eof:
+                    self._crc = zlib.crc32(chunk, self._crc)
+                    self._finish_member(self._decompressor.unused_data)
+                    chunks.append(chunk)
+                    n_bytes += len(chunk)
+                    break
+            self._crc = zlib.crc32(chunk, self._crc)
+            chunks.append(chunk)
+            n_bytes += len(chunk)
+        return b"".join(chunks)
+
+
+class DownloadStats:
+    def __init__(self, path: str, total_bytes: int, seconds: float, compressed_bytes: int = None):
+        self.path = path
+        self.total_bytes = total_bytes
+        self.seconds = seconds
+        self.compressed_bytes = compressed_bytes
+
+    @property
+    def bytes_per_sec(self) -> float:
+        return self.total_bytes / self.seconds if self.seconds > 0 else float(self.total_bytes)
+
+    def __str__(self):
+        transferred = f" ({self.compressed_bytes} bytes compressed)" if self.compressed_bytes is not None else ""
+        return f"{self.path}: {self.total_bytes} bytes{transferred} in {self.seconds:.2f} s ({self.bytes_per_sec / 1024 / 1024:.2f} MB/s)"
+
+
+def download_to_storage(response, storage: ExportFileStorage, path: str, chunk_size: int = DOWNLOAD_CHUNK_SIZE, unzip: bool = False) -> DownloadStats:
+    """
+    Copies the body of an HTTP response (anything with read(size)) to path in chunk_size pieces: the body is neither buffered as a whole nor decoded.
+    With unzip, the body is a zip archive (an export requested with "compress": true) and its single file is written, inflated on the fly.
+    """
+    source = ZipMemberStreamReader(response, chunk_size) if unzip else response
+    total_bytes = 0
+    start = time.perf_counter()
+    with storage.open_for_write(path) as target:
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            target.write(chunk)
+            total_bytes += len(chunk)
+    download_stats = DownloadStats(path, total_bytes, time.perf_counter() - start, source.compressed_bytes if unzip else None)
+    qualtrics_logger.info("Downloaded %s", download_stats)
+    return download_stats
+
+
+# COMMAND ----------
+
+# DBTITLE 1,Qualtrics client
+class QualtricsApiError(Exception):
+    """
+    A Qualtrics API call failed. error_message is meta.error.errorMessage of the response when there is one;
+    status is the HTTP status code and http_status the meta.httpStatus of the response (e.g. '400 - Bad Request').
+    """
+    def __init__(self, error_message: str, status: int = None, http_status: str = None, retry_after: str = None):
+        super().__init__(error_message)
+        self.error_message = error_message
+        self.status = status
+        self.http_status = http_status
+        self.retry_after = retry_after
+
+
+class QualtricsClientError(QualtricsApiError):
+    """4xx: the request itself is wrong, sending it again does not help."""
+
+
+class QualtricsRateLimitError(QualtricsClientError):
+    """429: too many requests; retry_after holds the Retry-After header when the response has one."""
+
+
+class QualtricsServerError(QualtricsApiError):
+    """5xx: Qualtrics failed to handle a valid request."""
+
+
+class QualtricsConnectionError(QualtricsApiError):
+    """The request could not be sent or its response could not be read."""
+
+
+class QualtricsConnectError(QualtricsConnectionError):
+    """The connection could not be opened: the request was not sent at all."""
+
+
+class QualtricsExportTimeoutError(QualtricsApiError):
+    """The export file was not ready before the polling deadline."""
+
+
+class QualtricsExportFailedError(QualtricsApiError):
+    """Qualtrics reported the export as failed."""
+
+
+def qualtrics_api_error(error_message: str, status: int, http_status: str = None, retry_after: str = None) -> QualtricsApiError:
+    if status == 429:
+        return QualtricsRateLimitError(error_message, status, http_status, retry_after)
+    if 400 <= status < 500:
+        return QualtricsClientError(error_message, status, http_status, retry_after)
+    if status >= 500:
+        return QualtricsServerError(error_message, status, http_status, retry_after)
+    return QualtricsApiError(error_message, status, http_status, retry_after)
+
+
+class HTTPSConnectionPool:
+    """
+    Keep-alive HTTPS connections to one host, with at most max_connections in use at a time (acquire blocks until one is released).
+    A connection goes back to the pool only when its response was read to the end and the server did not ask to close it,
+    and at most max_connections idle connections are kept (new connections opened for non-idempotent requests would otherwise pile up).
+    connection_class can be set to http.client.HTTPConnection to talk to a local mock server in tests.
+    """
+    def __init__(self, host: str, max_connections: int = 8, timeout: float = 60, connection_class=http.client.HTTPSConnection):
+        self.host = host
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.connection_class = connection_class
+        self.connections_opened = 0
+        self._idle_connections = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_connections)
+
+    def acquire(self, is_reuse_allowed: bool = True) -> (http.client.HTTPSConnection, bool):
+        """
+        Returns (connection, is_reused): an idle connection when there is one (and is_reuse_allowed), a new one otherwise.
+        """
+        self._slots.acquire()
+        with self._lock:
+            if is_reuse_allowed and len(self._idle_connections) > 0:
+                return self._idle_connections.pop(), True
+            self.connections_opened += 1
+        return self.connection_class(self.host, timeout=self.timeout), False
+
+    def release(self, connection: http.client.HTTPSConnection, is_reusable: bool):
+        if is_reusable:
+            with self._lock:
+                is_kept = len(self._idle_connections) < self.max_connections
+                if is_kept:
+                    self._idle_connections.append(connection)
+            if not is_kept:
+                connection.close()
+        else:
+            connection.close()
+        self._slots.release()
+
+    def close(self):
+        with self._lock:
+            for connection in self._idle_connections:
+                connection.close()
+            self._idle_connections = []
+
+
+class QualtricsClient:
+    """
+    Client of the Qualtrics v3 API sharing keep-alive connections between calls, so that a survey's list/export/poll/download steps
+    pay for one TCP+TLS handshake instead of one per request.
+    Every call builds the same headers and parses the JSON response in one place; failures raise QualtricsApiError subclasses
+    (QualtricsClientError, QualtricsRateLimitError, QualtricsServerError, QualtricsConnectionError).
+    The client can be shared by threads: at most max_connections_per_host requests are in flight per host, and all the requests go through
+    rate_limiter (when given), so that the limit holds across every worker sharing the client.
+    Failed requests are retried as classified by retry_policy (RetryPolicy() by default: 429 and 5xx are retried, other 4xx fail fast).
+    Requests whose method is not idempotent (POST: starting an export) are only retried when Qualtrics cannot have handled them, see RetryPolicy.
+    """
+    surveys_route = "/API/v3/surveys"
+    idempotent_methods = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")
+
+    def __init__(self, hostname: str, token: str, max_connections_per_host: int = 8, timeout: float = 60, connection_class=http.client.HTTPSConnection,
+                 rate_limiter=None, retry_policy=None):
+        self.hostname = hostname
+        self._token = token
+        self.max_connections_per_host = max_connections_per_host
+        self.timeout = timeout
+        self.connection_class = connection_class
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self._pools_lock:
+            for pool in self._pools.values():
+                pool.close()
+
+    def pool(self, host: str = None) -> HTTPSConnectionPool:
+        host = host if host is not None else self.hostname
+        with self._pools_lock:
+            if host not in self._pools:
+                self._pools[host] = HTTPSConnectionPool(host, self.max_connections_per_host, self.timeout, self.connection_class)
+            return self._pools[host]
+
+    def headers(self) -> dict:
+        return {
+            'Content-Type': 'application/json',
+            'X-API-TOKEN': self._token
+        }
+
+    @staticmethod
+    def export_responses_route(survey_id: str) -> str:
+        return f"{QualtricsClient.surveys_route}/{survey_id}/export-responses"
+
+    # ===============================================================================
+    # Requests
+    # ===============================================================================
+
+    def _send(self, method: str, route: str, body: str) -> (HTTPSConnectionPool, http.client.HTTPSConnection, http.client.HTTPResponse):
+        """
+        Sends the request on a pooled connection; the caller reads the response and releases the connection.
+        An idle connection may have been closed by the server in the meantime: the request is then sent again once on a new connection.
+        A request whose method is not idempotent is always sent on a new connection instead, as it cannot be sent again safely;
+        failing to open the connection raises QualtricsConnectError, the request was then not sent.
+        """
+        pool = self.pool()
+        is_idempotent = method in self.idempotent_methods
+        while True:
+            connection, is_reused = pool.acquire(is_reuse_allowed=is_idempotent)
+            if connection.sock is None:
+                try:
+                    connection.connect()
+                except (OSError, http.client.HTTPException) as e:
+                    pool.release(connection, False)
+                    raise QualtricsConnectError(f"{method} {route} failed to connect: {e}") from e
+            try:
+                connection.request(method, route, body, self.headers())
+                return pool, connection, connection.getresponse()
+            except (OSError, http.client.HTTPException) as e:
+                pool.release(connection, False)
+                if is_reused and isinstance(e, (ConnectionResetError, BrokenPipeError, http.client.RemoteDisconnected)):
+                    qualtrics_logger.debug("Idle connection to %s was closed, sending %s %s on a new connection", pool.host, method, route)
+                    continue
+                raise QualtricsConnectionError(f"{method} {route} failed: {e}") from e
+
+    @staticmethod
+    def _parse(response: http.client.HTTPResponse, data: bytes) -> dict:
+        try:
+            json_response = json.loads(data)
+        except ValueError:
+            json_response = None
+        meta = json_response.get('meta', {}) if isinstance(json_response, dict) else {}
+        http_status = meta.get('httpStatus')
+        if response.status >= 400 or (http_status is not None and http_status != '200 - OK') or json_response is None:
+            error_message = meta.get('error', {}).get('errorMessage') or f"{response.status} {response.reason}"
+            raise qualtrics_api_error(error_message, response.status, http_status, response.getheader('Retry-After'))
+        return json_response
+
+    def _with_retries(self, method: str, route: str, send_once):
+        """
+        Calls send_once, after waiting for the rate limiter, until it succeeds or retry_policy gives up.
+        A 429 pauses the rate limiter for the Retry-After delay, so that every worker sharing it backs off, not only this one.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            try:
+                return send_once()
+            except QualtricsApiError as e:
+                delay = self.retry_policy.retry_delay(e, attempt, method in self.idempotent_methods)
+                if delay is None:
+                    raise
+                qualtrics_logger.warning("%s %s failed (attempt %s): %s; retrying in %.1f s", method, route, attempt, e, delay)
+                if isinstance(e, QualtricsRateLimitError) and self.rate_limiter is not None:
+                    self.rate_limiter.pause(delay)
+                else:
+                    self.retry_policy.sleep(delay)
+
+    def request_json(self, method: str, route: str, payload: dict = None) -> dict:
+        """
+        Sends payload (if any) as JSON and returns the parsed JSON response, whose meta.httpStatus must be '200 - OK'.
+        """
+        body = json.dumps(payload) if payload is not None else ''
+        return self._with_retries(method, route, lambda: self._request_json_once(method, route, body))
+
+    def _request_json_once(self, method: str, route: str, body: str) -> dict:
+        pool, connection, response = self._send(method, route, body)
+        try:
+            data = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            pool.release(connection, False)
+            raise QualtricsConnectionError(f"{method} {route} failed: {e}") from e
+        pool.release(connection, not response.will_close)
+        return self._parse(response, data)
+
+    def download_file(self, route: str, storage: ExportFileStorage, path: str, unzip: bool = False) -> DownloadStats:
+        """
+        Streams the body of GET route to path (see download_to_storage); the connection is reused once the body was read to the end.
+        A retried download writes the file again from the start.
+        """
+        return self._with_retries('GET', route, lambda: self._download_file_once(route, storage, path, unzip))
+
+    def _download_file_once(self, route: str, storage: ExportFileStorage, path: str, unzip: bool) -> DownloadStats:
+        pool, connection, response = self._send('GET', route, '')
+        is_reusable = False
+        try:
+            if response.status != 200:
+                self._parse(response, response.read())
+                raise qualtrics_api_error(f"{response.status} {response.reason}", response.status)
+            download_stats = download_to_storage(response, storage, path, unzip=unzip)
+            is_reusable = response.isclosed() and not response.will_close
+            return download_stats
+        except (OSError, http.client.HTTPException) as e:
+            raise QualtricsConnectionError(f"GET {route} failed: {e}") from e
+        finally:
+            pool.release(connection, is_reusable)
+
+    # ===============================================================================
+    # Qualtrics API
+    # ===============================================================================
+
+    def list_surveys(self) -> dict:
+        """
+        Returns the first page of surveys only; use iter_surveys to list all of them.
+        """
+        return self.request_json('GET', self.surveys_route)
+
+    def iter_survey_pages(self):
+        """
+        Yields the elements of every page of surveys, following nextPage, fetching a page only once the previous one was consumed.
+        """
+        route = self.surveys_route
+        while route:
+            result = self.request_json('GET', route)['result']
+            yield result['elements']
+            next_page = result.get('nextPage')
+            if not next_page:
+                return
+            next_page = urllib.parse.urlsplit(next_page)
+            route = next_page.path + ('?' + next_page.query if next_page.query else '')
+
+    def iter_surveys(self, active_only: bool = False):
+        """
+        Yields the surveys of all the pages (only the active ones when active_only), as the pages are fetched.
+        """
+        for surveys in self.iter_survey_pages():
+            for survey in surveys:
+                if not active_only or survey['isActive']:
+                    yield survey
+
+    def start_response_export(self, survey_id: str, payload: dict) -> str:
+        """
+        Starts the export of survey_id's responses; returns its progress id.
+        """
+        return self.request_json('POST', self.export_responses_route(survey_id), payload)['result']['progressId']
+
+    def get_response_export_progress(self, survey_id: str, progress_id: str) -> dict:
+        """
+        Returns the result of the progress check: status, percentComplete, and fileId (plus continuationToken when requested) once complete.
+        """
+        return self.request_json('GET', f"{self.export_responses_route(survey_id)}/{progress_id}")['result']
+
+    def download_response_export(self, survey_id: str, file_id: str, storage: ExportFileStorage, path: str, unzip: bool = False) -> DownloadStats:
+        return self.download_file(f"{self.export_responses_route(survey_id)}/{file_id}/file", storage, path, unzip)
+
+
+# COMMAND ----------
+
+# DBTITLE 1,Rate limiting and retries
+class TokenBucketRateLimiter:
+    """
+    Token bucket holding up to burst tokens, refilled at rate tokens per second; every request takes one token.
+    Thread-safe: one limiter shared by all the workers of a run keeps their combined request rate under rate.
+    reserve takes a token and returns how long to wait for it, for callers that wait in their own way (e.g. asyncio.sleep); acquire waits with sleep.
+    """
+    def __init__(self, rate: float, burst: float = None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = self.burst
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        if now > self._updated_at:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+
+    def reserve(self) -> float:
+        with self._lock:
+            now = self._clock()
+            self._refill(now)
+            self._tokens -= 1
+            wait = self._updated_at - now
+            if self._tokens < 0:
+                wait += -self._tokens / self.rate
+            return max(0.0, wait)
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            self._sleep(wait)
+
+    def pause(self, seconds: float):
+        """
+        Hands out no token for the next seconds (e.g. the Retry-After of a 429), then resumes at rate, without a burst.
+        """
+        with self._lock:
+            now = self._clock()
+            self._refill(now)
+            if now + seconds > self._updated_at:
+                self._tokens = min(self._tokens, 1.0)
+                self._updated_at = now + seconds
+
+
+class RetryBudget:
+    """
+    Number of retries allowed across all the requests of a run, shared by its workers, so that an outage cannot multiply the load by max_attempts.
+    """
+    def __init__(self, max_retries: int):
+        self.max_retries = max_retries
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            if self.retries >= self.max_retries:
+                return False
+            self.retries += 1
+            return True
+
+
+class RetryPolicy:
+    """
+    Classifies failed requests:
+    - QualtricsRateLimitError (429): retried after its Retry-After delay (seconds or HTTP date), or after the backoff delay without one
+    - QualtricsServerError (5xx) and QualtricsConnectionError: retried after base_delay * 2 ** (attempt - 1), capped at max_delay, +/- jitter
+    - any other error (other 4xx, ...): not retried
+    A request that is not idempotent (a POST starting an export) may have been handled by Qualtrics when it failed with a 5xx or a connection error
+    after being sent, and sending it again would start a second export: it is only retried after QualtricsConnectError (not sent), 429 or 503 (refused).
+    A request is tried at most max_attempts times, and every retry is taken from retry_budget when there is one.
+    """
+    def __init__(self, max_attempts: int = 5, base_delay: float = 1, max_delay: float = 60, jitter: float = 0.1, retry_budget: RetryBudget = None,
+                 sleep=time.sleep):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.retry_budget = retry_budget
+        self.sleep = sleep
+
+    @staticmethod
+    def parse_retry_after(retry_after: str) -> float:
+        """
+        Seconds to wait as given by a Retry-After header; None when there is no header or it cannot be parsed.
+        """
+        if retry_after is None:
+            return None
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def backoff_delay(self, attempt: int) -> float:
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay * (1 + self.jitter * (2 * random.random() - 1))
+
+    def retry_delay(self, error: Exception, attempt: int, is_idempotent: bool = True) -> float:
+        """
+        Seconds to wait before trying again after the attempt-th try failed with error; None when the request must not be retried.
+        """
+        if attempt >= self.max_attempts:
+            return None
+        if not is_idempotent and not (isinstance(error, (QualtricsConnectError, QualtricsRateLimitError)) or getattr(error, 'status', None) == 503):
+            return None
+        if isinstance(error, QualtricsRateLimitError):
+            delay = self.parse_retry_after(error.retry_after)
+            if delay is None:
+                delay = self.backoff_delay(attempt)
+        elif isinstance(error, (QualtricsServerError, QualtricsConnectionError)):
+            delay = self.backoff_delay(attempt)
+        else:
+            return None
+        if self.retry_budget is not None and not self.retry_budget.try_spend():
+            qualtrics_logger.warning("Retry budget of %s retries exhausted", self.retry_budget.max_retries)
+            return None
+        return delay
+
+
+# COMMAND ----------
+
+# DBTITLE 1,Export progress polling
+class ExportProgressPoller:
+    """
+    Polls the progress of a response export until its file is ready.
+    The first poll comes after initial_delay. While Qualtrics reports a percentComplete between 0 and 100, the next poll is scheduled for when
+    the export should complete at the rate observed so far; without a usable percentComplete, the delay grows exponentially by backoff_factor.
+    Delays are kept within [initial_delay, max_delay], spread by +/- jitter (a fraction of the delay) so that concurrent exports don't poll in step,
+    and never go past the deadline: an export still running at the deadline raises QualtricsExportTimeoutError.
+    """
+    def __init__(self, initial_delay: float = 0.5, max_delay: float = 30, backoff_factor: float = 2.0, jitter: float = 0.1, deadline: float = 900,
+                 sleep=time.sleep, clock=time.monotonic):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff_factor = backoff_factor
+        self.jitter = jitter
+        self.deadline = deadline
+        self._sleep = sleep
+        self._clock = clock
+
+    def next_delay(self, attempt: int, percent_complete: float, elapsed: float) -> float:
+        """
+        Delay before the next poll, after attempt polls (0 before the first one) and elapsed seconds since the export was started.
+        """
+        if attempt == 0:
+            delay = self.initial_delay
+        elif percent_complete is not None and 0 < percent_complete < 100:
+            delay = elapsed * (100 - percent_complete) / percent_complete
+        else:
+            delay = self.initial_delay * self.backoff_factor ** attempt
+        delay = min(max(delay, self.initial_delay), self.max_delay)
+        delay *= 1 + self.jitter * (2 * random.random() - 1)
+        return max(0.0, min(delay, self.deadline - elapsed))
+
+    @staticmethod
+    def check_progress(survey_id: str, progress_id: str, export_progress: dict) -> bool:
+        """
+        True when the export file is ready; raises QualtricsExportFailedError when Qualtrics reports the export as failed.
+        """
+        status = export_progress.get('status')
+        if status == 'complete':
+            return True
+        if status == 'failed':
+            raise QualtricsExportFailedError(f"Export {progress_id} of survey {survey_id} failed")
+        return False
+
+    def wait_for_file(self, client: QualtricsClient, survey_id: str, progress_id: str) -> dict:
+        """
+        Returns the result of the last progress check, holding fileId (and continuationToken when requested).
+        """
+        start = self._clock()
+        attempt = 0
+        percent_complete = None
+        while True:
+            elapsed = self._clock() - start
+            if elapsed >= self.deadline:
+                raise QualtricsExportTimeoutError(
+                    f"Export {progress_id} of survey {survey_id} not ready after {elapsed:.0f} s ({attempt} polls, {percent_complete}% complete)")
+            self._sleep(self.next_delay(attempt, percent_complete, elapsed))
+            export_progress = client.get_response_export_progress(survey_id, progress_id)
+            attempt += 1
+            if self.check_progress(survey_id, progress_id, export_progress):
+                qualtrics_logger.info("Export %s of survey %s ready after %.1f s and %s polls", progress_id, survey_id, self._clock() - start, attempt)
+                return export_progress
+            percent_complete = export_progress.get('percentComplete')
+
+    async def wait_for_file_async(self, get_export_progress, survey_id: str, progress_id: str) -> dict:
+        """
+        wait_for_file for asyncio: the waits are asyncio.sleep, and get_export_progress(survey_id, progress_id) is a coroutine function.
+        """
+        start = self._clock()
+        attempt = 0
+        percent_complete = None
+        while True:
+            elapsed = self._clock() - start
+            if elapsed >= self.deadline:
+                raise QualtricsExportTimeoutError(
+                    f"Export {progress_id} of survey {survey_id} not ready after {elapsed:.0f} s ({attempt} polls, {percent_complete}% complete)")
+            await asyncio.sleep(self.next_delay(attempt, percent_complete, elapsed))
+            export_progress = await get_export_progress(survey_id, progress_id)
+            attempt += 1
+            if self.check_progress(survey_id, progress_id, export_progress):
+                qualtrics_logger.info("Export %s of survey %s ready after %.1f s and %s polls", progress_id, survey_id, self._clock() - start, attempt)
+                return export_progress
+            percent_complete = export_progress.get('percentComplete')
@@ -0,0 +1,226 @@
+# Databricks notebook source
+# MAGIC %md # Qualtrics Checkpoint Store
+
+# COMMAND ----------
+
+# MAGIC %md ## Overview
+# MAGIC This notebook keeps track of the continuation tokens of the surveys and of the progress of every survey's export within a run:
+# MAGIC - a new continuation token is committed only once the exported responses file was completely written, never before the download
+# MAGIC - an export whose file was ready but not written (failed download, cancelled run) is resumed from its file id when the run is started again
+# MAGIC   with the same run id: the file is downloaded again, without starting a new export
+# MAGIC - committing is idempotent: resuming a run that already committed a survey's token neither exports it again nor stores the token twice
+# MAGIC - the latest tokens of all the surveys are read with one query at the start of a run, and older tokens are compacted away at its end
+# MAGIC
+# MAGIC SparkCheckpointStore keeps both in tables of the system database; SqliteCheckpointStore is a local stand-in with the same behaviour.
+
+# COMMAND ----------
+
+# DBTITLE 1,Checkpoint store
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+
+
+class ExportCheckpoint:
+    """
+    Progress of a survey's responses export within a run:
+    - EXPORT_READY: the export file file_id is ready on Qualtrics, continuation_token is the token it returned, not committed yet
+    - COMMITTED: the file was written and continuation_token is the survey's current token
+    """
+    EXPORT_READY = 'export_ready'
+    COMMITTED = 'committed'
+
+    def __init__(self, run_id: str, survey_id: str, status: str, file_id: str = None, continuation_token: str = None):
+        self.run_id = run_id
+        self.survey_id = survey_id
+        self.status = status
+        self.file_id = file_id
+        self.continuation_token = continuation_token
+
+    def __str__(self):
+        return f"{self.run_id}/{self.survey_id}: {self.status} (file {self.file_id})"
+
+
+class CheckpointStore(ABC):
+    """
+    Continuation tokens of the surveys, and ExportCheckpoint of the surveys exported by every run. Implementations are thread-safe.
+    """
+
+    @abstractmethod
+    def get_continuation_token(self, survey_id: str) -> str:
+        """
+        Latest committed token of survey_id; '' when there is none.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_continuation_tokens(self) -> dict:
+        """
+        Latest committed token of every survey that has one, by survey id, read at once.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def compact_continuation_tokens(self, tokens_to_keep: int = 1):
+        """
+        Deletes all but the tokens_to_keep latest tokens of every survey.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_checkpoint(self, run_id: str, survey_id: str) -> ExportCheckpoint:
+        """
+        Checkpoint of survey_id in run_id; None when the run did not get a ready export file for it yet.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_checkpoint(self, checkpoint: ExportCheckpoint):
+        raise NotImplementedError
+
+    @abstractmethod
+    def commit(self, checkpoint: ExportCheckpoint):
+        """
+        Stores checkpoint.continuation_token as the survey's token (once, however many times it is committed) and marks the checkpoint COMMITTED.
+        Call only once the exported file is completely written.
+        """
+        raise NotImplementedError
+
+
+class SqliteCheckpointStore(CheckpointStore):
+    """
+    CheckpointStore in a local SQLite database (":memory:" for a throwaway one); continuation tokens and checkpoints are committed in one transaction.
+    """
+    def __init__(self, database_path: str):
+        self._connection = sqlite3.connect(database_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS continuation_tokens (survey_id TEXT, continuation_token TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS export_checkpoints (run_id TEXT, survey_id TEXT, status TEXT, file_id TEXT, continuation_token TEXT, "
+                "updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (run_id, survey_id))")
+
+    def get_continuation_token(self, survey_id: str) -> str:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT continuation_token FROM continuation_tokens WHERE survey_id = ? ORDER BY created_at DESC, rowid DESC LIMIT 1", (survey_id,)).fetchone()
+        return row[0] if row is not None else ''
+
+    def get_continuation_tokens(self) -> dict:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT survey_id, continuation_token FROM (SELECT survey_id, continuation_token, "
+                "row_number() OVER (PARTITION BY survey_id ORDER BY created_at DESC, rowid DESC) AS token_rank FROM continuation_tokens) "
+                "WHERE token_rank = 1").fetchall()
+        return dict(rows)
+
+    def compact_continuation_tokens(self, tokens_to_keep: int = 1):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM continuation_tokens WHERE rowid IN (SELECT rowid FROM (SELECT rowid, "
+                "row_number() OVER (PARTITION BY survey_id ORDER BY created_at DESC, rowid DESC) AS token_rank FROM continuation_tokens) "
+                "WHERE token_rank > ?)", (tokens_to_keep,))
+
+    def get_checkpoint(self, run_id: str, survey_id: str) -> ExportCheckpoint:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT status, file_id, continuation_token FROM export_checkpoints WHERE run_id = ? AND survey_id = ?", (run_id, survey_id)).fetchone()
+        return ExportCheckpoint(run_id, survey_id, *row) if row is not None else None
+
+    def _save_checkpoint(self, checkpoint: ExportCheckpoint):
+        self._connection.execute(
+            "INSERT OR REPLACE INTO export_checkpoints (run_id, survey_id, status, file_id, continuation_token) VALUES (?, ?, ?, ?, ?)",
+            (checkpoint.run_id, checkpoint.survey_id, checkpoint.status, checkpoint.file_id, checkpoint.continuation_token))
+
+    def save_checkpoint(self, checkpoint: ExportCheckpoint):
+        with self._lock, self._connection:
+            self._save_checkpoint(checkpoint)
+
+    def commit(self, checkpoint: ExportCheckpoint):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO continuation_tokens (survey_id, continuation_token) SELECT ?, ? "
+                "WHERE NOT EXISTS (SELECT 1 FROM continuation_tokens WHERE survey_id = ? AND continuation_token = ?)",
+                (checkpoint.survey_id, checkpoint.continuation_token, checkpoint.survey_id, checkpoint.continuation_token))
+            checkpoint.status = ExportCheckpoint.COMMITTED
+            self._save_checkpoint(checkpoint)
+
+
+class SparkCheckpointStore(CheckpointStore):
+    """
+    CheckpointStore in the tables of the current database: continuation tokens in tokens_table (survey_id, continuation_token, created_at),
+    checkpoints in checkpoints_table, both Delta tables, created when missing (a ValueError is raised when an existing one is not a Delta table:
+    the tokens are compacted and the checkpoints merged in place). Queries are parametrized with Python values (spark.sql args, None for NULL),
+    which requires Spark 3.5 (Databricks Runtime 14.0) or later: Spark 3.4 parses args as SQL literal expressions instead.
+    Writes are serialized: concurrent MERGEs into the same small Delta table would conflict with each other.
+    The token is inserted before the checkpoint is marked COMMITTED; a run stopped in between commits it again on resume, which inserts nothing.
+    """
+    def __init__(self, spark_session, tokens_table: str = 'surveys_qualtics_continuation_tokens', checkpoints_table: str = 'surveys_qualtrics_export_checkpoints'):
+        self.spark = spark_session
+        self.tokens_table = tokens_table
+        self.checkpoints_table = checkpoints_table
+        self._lock = threading.Lock()
+        self.spark.sql(f"CREATE TABLE IF NOT EXISTS {self.tokens_table} (survey_id STRING, continuation_token STRING, created_at TIMESTAMP) USING DELTA")
+        self.spark.sql(f"CREATE TABLE IF NOT EXISTS {self.checkpoints_table} "
+                       "(run_id STRING, survey_id STRING, status STRING, file_id STRING, continuation_token STRING, updated_at TIMESTAMP) USING DELTA")
+        self._assert_delta_table(self.tokens_table)
+        self._assert_delta_table(self.checkpoints_table)
+
+    def _assert_delta_table(self, table_name: str):
+        rows = self.spark.sql(f"DESCRIBE TABLE EXTENDED {table_name}").collect()
+        provider = next((row['data_type'] for row in rows if row['col_name'] == 'Provider'), None)
+        if provider is None or provider.lower() != 'delta':
+            raise ValueError(f"{table_name} must be a Delta table, not {provider}")
+
+    def get_continuation_token(self, survey_id: str) -> str:
+        rows = self.spark.sql(f"SELECT continuation_token FROM {self.tokens_table} WHERE survey_id = :survey_id ORDER BY created_at DESC LIMIT 1",
+                              args={'survey_id': survey_id}).collect()
+        return rows[0]['continuation_token'] if len(rows) == 1 else ''
+
+    def get_continuation_tokens(self) -> dict:
+        rows = self.spark.sql(f"SELECT survey_id, max_by(continuation_token, created_at) AS continuation_token FROM {self.tokens_table} GROUP BY survey_id").collect()
+        return {row['survey_id']: row['continuation_token'] for row in rows}
+
+    def compact_continuation_tokens(self, tokens_to_keep: int = 1):
+        # a survey's token is stored once (see commit), so the whole row identifies it even when two tokens have the same created_at
+        with self._lock:
+            self.spark.sql(f"""
+                DELETE FROM {self.tokens_table}
+                WHERE (survey_id, continuation_token, created_at) IN (
+                    SELECT survey_id, continuation_token, created_at
+                    FROM (SELECT *, row_number() OVER (PARTITION BY survey_id ORDER BY created_at DESC) AS token_rank FROM {self.tokens_table})
+                    WHERE token_rank > :tokens_to_keep)
+            """, args={'tokens_to_keep': tokens_to_keep})
+
+    def get_checkpoint(self, run_id: str, survey_id: str) -> ExportCheckpoint:
+        rows = self.spark.sql(f"SELECT status, file_id, continuation_token FROM {self.checkpoints_table} WHERE run_id = :run_id AND survey_id = :survey_id",
+                              args={'run_id': run_id, 'survey_id': survey_id}).collect()
+        if len(rows) == 0:
+            return None
+        return ExportCheckpoint(run_id, survey_id, rows[0]['status'], rows[0]['file_id'], rows[0]['continuation_token'])
+
+    def _save_checkpoint(self, checkpoint: ExportCheckpoint):
+        self.spark.sql(f"""
+            MERGE INTO {self.checkpoints_table} AS target
+            USING (SELECT :run_id AS run_id, :survey_id AS survey_id, :status AS status, :file_id AS file_id,
+                          :continuation_token AS continuation_token, now() AS updated_at) AS source
+            ON target.run_id = source.run_id AND target.survey_id = source.survey_id
+            WHEN MATCHED THEN UPDATE SET *
+            WHEN NOT MATCHED THEN INSERT *
+        """, args={'run_id': checkpoint.run_id, 'survey_id': checkpoint.survey_id, 'status': checkpoint.status, 'file_id': checkpoint.file_id,
+                   'continuation_token': checkpoint.continuation_token})
+
+    def save_checkpoint(self, checkpoint: ExportCheckpoint):
+        with self._lock:
+            self._save_checkpoint(checkpoint)
+
+    def commit(self, checkpoint: ExportCheckpoint):
+        with self._lock:
+            self.spark.sql(f"""
+                INSERT INTO {self.tokens_table}
+                SELECT :survey_id, :continuation_token, now()
+                WHERE NOT EXISTS (SELECT 1 FROM {self.tokens_table} WHERE survey_id = :survey_id AND continuation_token = :continuation_token)
+            """, args={'survey_id': checkpoint.survey_id, 'continuation_token': checkpoint.continuation_token})
+            checkpoint.status = ExportCheckpoint.COMMITTED
+            self._save_checkpoint(checkpoint)
@@ -0,0 +1,194 @@
+# Databricks notebook source
+# MAGIC %md # Qualtrics Export Orchestrator
+
+# COMMAND ----------
+
+# MAGIC %md ## Overview
+# MAGIC This notebook exports the responses of many surveys from a single process, with asyncio:
+# MAGIC - the JSON and CSV exports of every survey are started, polled and downloaded concurrently
+# MAGIC - surveys can be streamed (e.g. from QualtricsClient.iter_surveys): the exports of the first page start while the next pages are listed
+# MAGIC - waiting for exports costs no thread: polls are scheduled with asyncio.sleep, only the API calls themselves run on a thread pool
+# MAGIC - a global concurrency limit caps the API calls and downloads in flight; the rate limit and retries are those of the shared client
+# MAGIC
+# MAGIC It replaces launching one get_survey_responses notebook per survey, which paid notebook startup per survey and was capped at 8 surveys at a time.
+# MAGIC The caller passes the current continuation token of every survey. Given a checkpoint store and a run id, the orchestrator commits every new token
+# MAGIC as soon as the survey's JSON file is written, and a run started again with the same run id resumes the surveys it did not commit;
+# MAGIC without one, the caller stores the new tokens.
+
+# COMMAND ----------
+
+# MAGIC %run ./qualtrics_api_client
+
+# COMMAND ----------
+
+# MAGIC %run ./qualtrics_checkpoint_store
+
+# COMMAND ----------
+
+# DBTITLE 1,Survey export orchestrator
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SurveyExport:
+    """
+    Survey to export: its id and the continuation token of its last export ('' for a full export).
+    """
+    def __init__(self, survey_id: str, continuation_token: str = ''):
+        self.survey_id = survey_id
+        self.continuation_token = continuation_token
+
+
+class SurveyExportResult:
+    """
+    Outcome of a survey's export. error is None when both files were written; continuation_token is then the token to store for the next run
+    (already committed when the orchestrator has a checkpoint store). json_download_stats is None when the JSON file was written by an earlier attempt of the run.
+    """
+    def __init__(self, survey_id: str, continuation_token: str = None, json_download_stats: DownloadStats = None,
+                 csv_download_stats: DownloadStats = None, error: Exception = None):
+        self.survey_id = survey_id
+        self.continuation_token = continuation_token
+        self.json_download_stats = json_download_stats
+        self.csv_download_stats = csv_download_stats
+        self.error = error
+
+    def __str__(self):
+        if self.error is not None:
+            return f"{self.survey_id}: failed: {self.error}"
+        json_download_stats = self.json_download_stats if self.json_download_stats is not None else "JSON file written by an earlier attempt"
+        return f"{self.survey_id}: {json_download_stats}; {self.csv_download_stats}"
+
+
+class SurveyExportOrchestrator:
+    """
+    Exports the responses of many surveys concurrently: for each survey, the JSON export (continued from its token) and the CSV export
+    (mapping metadata row only) are started, polled and streamed to export_root/<survey_id>/ at the same time as every other survey's.
+    At most max_concurrency API calls and downloads are in flight at any time, on as many pooled connections. Every call goes through the client,
+    so the client's TokenBucketRateLimiter and RetryPolicy apply across all the surveys. A failing survey does not stop the others:
+    its SurveyExportResult holds the error.
+    With a checkpoint_store, the JSON export of every survey is checkpointed under run_id once its file is ready, and its token committed once the file
+    is written; surveys already committed by an earlier attempt of run_id are not exported again, and ready files are downloaded without a new export.
+    """
+    json_file_name = 'survey_responses.json'
+    csv_file_name = 'survey_responses.csv'
+
+    def __init__(self, client: QualtricsClient, storage: ExportFileStorage, export_root: str, max_concurrency: int = 32,
+                 compress_exports: bool = True, poller: ExportProgressPoller = None, checkpoint_store: CheckpointStore = None, run_id: str = None):
+        self.client = client
+        self.storage = storage
+        self.export_root = export_root
+        self.max_concurrency = max_concurrency
+        self.compress_exports = compress_exports
+        self.poller = poller if poller is not None else ExportProgressPoller()
+        self.checkpoint_store = checkpoint_store
+        self.run_id = run_id
+        self.client.max_connections_per_host = max(self.client.max_connections_per_host, max_concurrency)
+
+    def run(self, survey_exports) -> list:
+        """
+        Exports the surveys and returns their SurveyExportResult, in the order of survey_exports.
+        survey_exports can be any iterable, including a generator that blocks on API calls: it is consumed on a worker thread, and every survey's export
+        starts as soon as the survey is yielded. If the iterable raises, the exports already started are completed before the error is raised.
+        Can be called whether or not an event loop is already running in the calling thread (as in a notebook).
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.export_surveys(survey_exports))
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(asyncio.run, self.export_surveys(survey_exports)).result()
+
+    async def export_surveys(self, survey_exports) -> list:
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        loop = asyncio.get_running_loop()
+        survey_exports = iter(survey_exports)
+        tasks = []
+        # one more thread than concurrent calls, for consuming survey_exports
+        with ThreadPoolExecutor(max_workers=self.max_concurrency + 1, thread_name_prefix='qualtrics') as executor:
+            self._executor = executor
+            try:
+                while True:
+                    survey_export = await loop.run_in_executor(executor, next, survey_exports, None)
+                    if survey_export is None:
+                        break
+                    tasks.append(asyncio.create_task(self.export_survey(survey_export)))
+            except Exception:
+                await asyncio.gather(*tasks)
+                raise
+            return await asyncio.gather(*tasks)
+
+    async def _call(self, function, *args):
+        """
+        Runs a blocking client call on the thread pool once a concurrency slot is free.
+        """
+        async with self._semaphore:
+            return await self._run_blocking(function, *args)
+
+    async def _run_blocking(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(function, *args))
+
+    async def _get_export_progress(self, survey_id: str, progress_id: str) -> dict:
+        return await self._call(self.client.get_response_export_progress, survey_id, progress_id)
+
+    async def _wait_for_export(self, survey_id: str, payload: dict) -> dict:
+        progress_id = await self._call(self.client.start_response_export, survey_id, payload)
+        return await self.poller.wait_for_file_async(self._get_export_progress, survey_id, progress_id)
+
+    async def _download(self, survey_id: str, file_id: str, file_name: str) -> DownloadStats:
+        return await self._call(self.client.download_response_export, survey_id, file_id, self.storage,
+                                f"{self.export_root}/{survey_id}/{file_name}", self.compress_exports)
+
+    async def _export(self, survey_id: str, payload: dict, file_name: str) -> (dict, DownloadStats):
+        export_progress = await self._wait_for_export(survey_id, payload)
+        return export_progress, await self._download(survey_id, export_progress['fileId'], file_name)
+
+    async def _export_json_with_checkpoints(self, survey_id: str, payload: dict) -> (dict, DownloadStats):
+        """
+        JSON export of survey_id, checkpointed in checkpoint_store: resumed from the ready file of an earlier attempt of the run if there is one
+        (exported again if that file expired), skipped if the earlier attempt committed it; the new token is committed once the file is written.
+        """
+        checkpoint = await self._run_blocking(self.checkpoint_store.get_checkpoint, self.run_id, survey_id)
+        if checkpoint is not None and checkpoint.status == ExportCheckpoint.COMMITTED:
+            qualtrics_logger.info("Export of survey %s already committed by run %s", survey_id, self.run_id)
+            return {'continuationToken': checkpoint.continuation_token}, None
+        download_stats = None
+        if checkpoint is not None:
+            qualtrics_logger.info("Resuming %s", checkpoint)
+            try:
+                download_stats = await self._download(survey_id, checkpoint.file_id, self.json_file_name)
+            except QualtricsClientError as e:
+                qualtrics_logger.warning("File %s of survey %s cannot be downloaded anymore (%s), exporting again", checkpoint.file_id, survey_id, e)
+        if download_stats is None:
+            export_progress = await self._wait_for_export(survey_id, payload)
+            checkpoint = ExportCheckpoint(self.run_id, survey_id, ExportCheckpoint.EXPORT_READY, export_progress['fileId'], export_progress.get('continuationToken'))
+            await self._run_blocking(self.checkpoint_store.save_checkpoint, checkpoint)
+            download_stats = await self._download(survey_id, checkpoint.file_id, self.json_file_name)
+        await self._run_blocking(self.checkpoint_store.commit, checkpoint)
+        return {'continuationToken': checkpoint.continuation_token}, download_stats
+
+    async def export_survey(self, survey_export: SurveyExport) -> SurveyExportResult:
+        json_payload = {'format': 'json', 'compress': self.compress_exports}
+        if survey_export.continuation_token == '':
+            json_payload['allowContinuation'] = True
+        else:
+            json_payload['continuationToken'] = survey_export.continuation_token
+        # Limit 0 since we only want the mapping metadata row
+        csv_payload = {'format': 'csv', 'compress': self.compress_exports, 'limit': 0, 'newlineReplacement': ''}
+
+        if self.checkpoint_store is not None:
+            json_export = self._export_json_with_checkpoints(survey_export.survey_id, json_payload)
+        else:
+            json_export = self._export(survey_export.survey_id, json_payload, self.json_file_name)
+        json_outcome, csv_outcome = await asyncio.gather(
+            json_export,
+            self._export(survey_export.survey_id, csv_payload, self.csv_file_name),
+            return_exceptions=True)
+        for outcome in (json_outcome, csv_outcome):
+            if isinstance(outcome, Exception):
+                qualtrics_logger.error("Export of survey %s failed: %s", survey_export.survey_id, outcome)
+                return SurveyExportResult(survey_export.survey_id, error=outcome)
+        (json_export_progress, json_download_stats), (_, csv_download_stats) = json_outcome, csv_outcome
+        result = SurveyExportResult(survey_export.survey_id, json_export_progress.get('continuationToken'), json_download_stats, csv_download_stats)
+        qualtrics_logger.info("Exported %s", result)
+        return result
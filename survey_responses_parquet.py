@@ -0,0 +1,157 @@
+# Databricks notebook source
+# MAGIC %md # Survey Responses Parquet
+
+# COMMAND ----------
+
+# MAGIC %md ## Overview
+# MAGIC This notebook converts exported survey responses into columnar datasets, so that later stages read only the columns and surveys they need
+# MAGIC instead of parsing the JSON exports again:
+# MAGIC - responses: responseId plus one string column per key of the exported values maps
+# MAGIC - derived_variables: responseId plus one string column per derived variable, as produced by SparkSurveyDerivedVariablesCalculator
+# MAGIC
+# MAGIC Both are Parquet datasets partitioned by survey_id and process_timestamp. The JSON export is first streamed to JSON lines
+# MAGIC (one response per line, in bounded memory), which Spark reads in parallel with a fixed schema: the values as a map of strings, each value kept
+# MAGIC as its exported JSON text (numbers as written, e.g. 1 or 1.0, multi-select arrays as e.g. [1,3], strings as they are).
+# MAGIC The column types are not inferred per export: a key inferred as a long in one export and as a double, or as a string when all null, in the next
+# MAGIC would make the partitions of a survey unreadable together. Every export writes string columns, which readers cast to the types they need.
+# MAGIC The derived variables are not produced from these columns: every line also holds the values of the response as they were exported,
+# MAGIC as a JSON string, so that the calculators see the same values as when reading the export (no nulls for unanswered keys, no ints widened to doubles).
+# MAGIC
+# MAGIC This notebook expects derived_variables_calculator to be run first.
+
+# COMMAND ----------
+
+# DBTITLE 1,Parquet converter
+import os
+from pyspark.sql.functions import explode, lit, map_keys
+
+
+class SurveyResponsesParquetConverter:
+    """
+    Writes the responses of survey_responses.json exports, and their derived variables, to Parquet datasets under parquet_root.
+    Paths are DBFS paths (e.g. '/mnt/...'), read and written by Spark as they are and through the local file API under local_root.
+    Converting a (survey_id, process_timestamp) again replaces its partitions only.
+    """
+    responses_dataset = 'responses'
+    derived_variables_dataset = 'derived_variables'
+    values_json_column = 'values_json'
+    json_lines_schema = 'responseId STRING, values MAP<STRING, STRING>, values_json STRING'
+    partition_columns = ['survey_id', 'process_timestamp']
+
+    def __init__(self, spark_session, parquet_root: str, local_root: str = '/dbfs'):
+        self.spark = spark_session
+        self.parquet_root = parquet_root
+        self.local_root = local_root
+
+    def local_path(self, path: str) -> str:
+        return os.path.join(self.local_root, path.lstrip('/'))
+
+    def dataset_path(self, dataset: str) -> str:
+        return f'{self.parquet_root}/{dataset}'
+
+    def write_json_lines(self, json_path: str, json_lines_path: str) -> int:
+        """
+        Streams the responses of the export json_path to json_lines_path, one {"responseId", "values", "values_json"} object per line,
+        values_json being the values serialized to a JSON string; returns the number of responses.
+        """
+        n_responses = 0
+        with open(self.local_path(json_lines_path), 'w', encoding='utf-8') as f:
+            for response_dict in SurveyResponsesJsonStreamReader(self.local_path(json_path)):
+                response_dict[self.values_json_column] = json.dumps(response_dict['values'])
+                f.write(json.dumps(response_dict))
+                f.write('\n')
+                n_responses += 1
+        return n_responses
+
+    def read_json_lines(self, json_lines_path: str) -> SparkDataFrame:
+        """
+        Reads the json lines with json_lines_schema: Spark keeps the JSON text of every value that is not a string, so nothing depends on the export.
+        """
+        return self.spark.read.schema(self.json_lines_schema).json(json_lines_path)
+
+    def responses_spark_dataframe(self, sdf_responses: SparkDataFrame) -> SparkDataFrame:
+        """
+        responseId plus one string column per key of the values maps of the responses read from the json lines, keys in sorted order.
+        """
+        keys = sorted(row['key'] for row in sdf_responses.select(explode(map_keys(col('values'))).alias('key')).distinct().collect())
+        return sdf_responses.select(col('responseId'), *[col('values').getItem(key).alias(key) for key in keys])
+
+    def _write(self, sdf: SparkDataFrame, dataset: str, survey_id: str, process_timestamp: str):
+        sdf = sdf.withColumn('survey_id', lit(survey_id)).withColumn('process_timestamp', lit(process_timestamp))
+        sdf.write.mode('overwrite').option('partitionOverwriteMode', 'dynamic').partitionBy(*self.partition_columns).parquet(self.dataset_path(dataset))
+
+    def derived_variables_spark_dataframe(self, sdf_responses: SparkDataFrame, df_derived_variables_lookup: DataFrame,
+                                          rule_scheduling: RuleScheduling = RuleScheduling.PASS_NUMBER) -> SparkDataFrame:
+        """
+        Derived variables of the responses read from the json lines: produced from the values as exported (values_json), not from the map of strings.
+        """
+        return SparkSurveyDerivedVariablesCalculator.produce_derived_variables_spark_dataframe(
+            df_derived_variables_lookup, sdf_responses.select(col('responseId'), col(self.values_json_column).alias('values')), rule_scheduling=rule_scheduling)
+
+    def convert(self, json_path: str, survey_id: str, process_timestamp: str, df_derived_variables_lookup: DataFrame = None,
+                rule_scheduling: RuleScheduling = RuleScheduling.PASS_NUMBER) -> int:
+        """
+        Writes the responses of the export json_path, and their derived variables when a lookup is given; returns the number of responses.
+        Nothing is written for an export without responses.
+        """
+        json_lines_path = os.path.splitext(json_path)[0] + '.jsonl'
+        n_responses = self.write_json_lines(json_path, json_lines_path)
+        try:
+            if n_responses == 0:
+                return 0
+            sdf_responses = self.read_json_lines(json_lines_path)
+            self._write(self.responses_spark_dataframe(sdf_responses), self.responses_dataset, survey_id, process_timestamp)
+            if df_derived_variables_lookup is not None:
+                sdf_derived_variables = self.derived_variables_spark_dataframe(sdf_responses, df_derived_variables_lookup, rule_scheduling)
+                self._write(sdf_derived_variables, self.derived_variables_dataset, survey_id, process_timestamp)
+            return n_responses
+        finally:
+            os.remove(self.local_path(json_lines_path))
+
+    def compare_with_row_engine(self, json_path: str, df_derived_variables_lookup: DataFrame,
+                                rule_scheduling: RuleScheduling = RuleScheduling.PASS_NUMBER) -> list:
+        """
+        Parity check of the derived variables convert writes for the export json_path against the row-by-row reference engine
+        (SurveyDerivedVariablesCalculator.produce_derived_variables_dataframe_using_rule_plan) on the same file.
+        Returns (response id, new variable, reference value, converted value) for every difference, values compared as the strings written.
+        Both outputs are collected to the driver: meant for a sample export, not for a full survey.
+        """
+        rule_plan = RulePlan(df_derived_variables_lookup, rule_scheduling)
+        df_reference = SurveyDerivedVariablesCalculator.produce_derived_variables_dataframe_using_rule_plan(
+            rule_plan, list(SurveyResponsesJsonStreamReader(self.local_path(json_path))))
+        if len(df_reference) == 0:
+            return []
+
+        json_lines_path = os.path.splitext(json_path)[0] + '.jsonl'
+        self.write_json_lines(json_path, json_lines_path)
+        try:
+            sdf_responses = self.read_json_lines(json_lines_path)
+            pdf_converted = self.derived_variables_spark_dataframe(sdf_responses, df_derived_variables_lookup, rule_scheduling).toPandas()
+        finally:
+            os.remove(self.local_path(json_lines_path))
+        pdf_converted = pdf_converted.astype(object).where(pdf_converted.notna(), None)
+        converted_by_response_id = {row['responseId']: row for row in pdf_converted.to_dict('records')}
+
+        differences = []
+        for response_id, values in zip(df_reference['responseId'], df_reference['values']):
+            converted_row = converted_by_response_id.get(response_id, {})
+            for var_name in rule_plan.var_names:
+                reference_value = str(values[var_name]) if var_name in values else None
+                converted_value = converted_row.get(var_name)
+                if reference_value != converted_value:
+                    differences.append((response_id, var_name, reference_value, converted_value))
+        return differences
+
+    def read(self, dataset: str, survey_id: str, columns: list = None, process_timestamps: list = None) -> SparkDataFrame:
+        """
+        Reads the columns (all of them when None) of survey_id's partitions of dataset, of process_timestamps only when given.
+        Only the partitions of the survey are listed, and only the selected columns are read from the files.
+        Columns of the responses dataset are strings in every partition, so that merging the schemas of the exports never conflicts.
+        """
+        dataset_path = self.dataset_path(dataset)
+        sdf = self.spark.read.option('basePath', dataset_path).option('mergeSchema', 'true').parquet(f'{dataset_path}/survey_id={survey_id}')
+        if process_timestamps is not None:
+            sdf = sdf.where(col('process_timestamp').isin(process_timestamps))
+        if columns is not None:
+            sdf = sdf.select(*columns)
+        return sdf